@@ -0,0 +1,364 @@
+"""
+Benchmarks of the Super Simple Stock Market Engine
+
+Startup: every command line switch but --serve is run as a fresh process, both as a script (python3 engine.py) and as a
+module (python3 -m engine, which loads the cached bytecode of engine.py), in a scratch directory holding the sample data,
+a few trades of three stocks and the input files of the batch commands (--client talks to a server started there), and
+the median and fastest wall times are written out as json together with whether numpy had to be imported.
+
+Engine: histories of trades are generated over synthetic stocks for every number of trades and of stocks given, and
+main_data, calculate_dividend_yield, p_to_e_ratio, trade_record, volume_weighted_stock_price and gbce_all_share_index
+are called on each. Their throughput, p50 and p99 latencies and peak memory (as traced by tracemalloc) are written out as
+json, which can be saved and later given as the baseline of another run: the p50 latencies are then compared and the
+run fails when an entry point got slower than the tolerance allows.
+
+Example:
+`python3 bench_engine.py startup --repeats 50`
+`python3 bench_engine.py engine --trades 1000,100000,10000000 --symbols 5,500,5000 --output baseline.json`
+`python3 bench_engine.py engine --baseline baseline.json --tolerance 0.2`
+"""
+import contextlib
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import engine
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# The command lines timed by the startup benchmark, after the program: every switch but --serve, whose server runs
+# until it is stopped (--client is timed against one)
+STARTUP_COMMANDS = (
+    ['--d', 'POP', '149'],
+    ['--pe', 'POP', '140'],
+    ['--tr', 'ALE', '12', 'SELL', '22.8'],
+    ['--vwsp', 'ALE'],
+    ['--asi', '.'],
+    ['--asi-live', '.'],
+    ['--price-file', 'prices.csv'],
+    ['--client', 'engine.sock', '--d', 'POP', '149'],
+    ['--migrate', '.'],
+    ['--tr-batch', 'trades.csv'],
+    ['--vwsp-stream'],
+    ['--bars', '1m'],
+    ['--sim', 'TEA,POP,ALE', '100', '42'],
+    ['--d', 'h'],
+)
+
+# The files the commands reading the standard input are given
+STARTUP_STDIN = {'--vwsp-stream': 'trades.csv'}
+
+# Prints whether numpy was imported once the command line has run, so the benchmark can tell the cheap paths apart
+_NUMPY_PROBE = ("import sys, runpy; sys.argv = ['engine.py'] + sys.argv[1:]\n"
+                "try:\n"
+                "    runpy.run_module('engine', run_name='__main__')\n"
+                "except SystemExit:\n"
+                "    pass\n"
+                "sys.stderr.write('numpy imported: {}\\n'.format('numpy' in sys.modules))\n")
+
+
+def _scratch_directory():
+    # The sample stock data is copied so the trade records written by the benchmark stay out of the repository
+    directory = tempfile.mkdtemp(prefix='bench_engine_')
+    shutil.copy(os.path.join(HERE, 'sample_data_gbce.json'), directory)
+    shutil.copy(os.path.join(HERE, 'engine.py'), directory)
+    return directory
+
+
+def _startup_fixtures(directory):
+    # A few trades of three stocks, so the queries have something to read, and the input files of the batch commands
+    with open(os.path.join(directory, 'trades.csv'), 'w') as fileobj:
+        fileobj.write('Stock,Quantity,Indicator,Price\n')
+        for position in range(30):
+            fileobj.write('{},{},{},{}\n'.format(('TEA', 'POP', 'ALE')[position % 3], position + 1,
+                                                 ('BUY', 'SELL')[position % 2], 10.0 + position))
+    with open(os.path.join(directory, 'trades.csv'), 'r') as fileobj:
+        engine.record_trades(engine.read_trade_batch(fileobj), directory)
+    with open(os.path.join(directory, 'prices.csv'), 'w') as fileobj:
+        fileobj.write(''.join('{},{}\n'.format(symbol, price) for symbol in ('TEA', 'POP', 'ALE', 'GIN', 'JOE')
+                              for price in (50, 100, 150)))
+
+
+@contextlib.contextmanager
+def _startup_server(directory):
+    # An engine server in the scratch directory for --client, stopped on the way out
+    server = subprocess.Popen([sys.executable, 'engine.py', '--serve', 'engine.sock'], cwd=directory,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        for _ in range(200):
+            if os.path.exists(os.path.join(directory, 'engine.sock')):
+                break
+            time.sleep(0.05)
+        yield server
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def _time_command(command, directory, repeats, stdin=None):
+    timings = []
+    for _ in range(repeats):
+        with open(os.path.join(directory, stdin) if stdin else os.devnull, 'r') as input_file:
+            started = time.perf_counter()
+            subprocess.run(command, cwd=directory, stdin=input_file, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+def startup_benchmark(repeats=20):
+    """
+    Times the start of a fresh engine process for every command line of STARTUP_COMMANDS
+
+    :param repeats: How many times each command line is run
+    :return: A dictionary with the interpreter baseline and, per command line and way of running it, the median and fastest milliseconds and whether numpy was imported
+    """
+    directory = _scratch_directory()
+    try:
+        _startup_fixtures(directory)
+        # The first module run compiles engine.py and caches its bytecode, which the timed runs then load
+        subprocess.run([sys.executable, '-m', 'engine', '--d', 'POP', '149'], cwd=directory, stdout=subprocess.DEVNULL)
+        interpreter = _time_command([sys.executable, '-c', 'pass'], directory, repeats)
+        results = {'interpreter_ms': {'median': statistics.median(interpreter), 'min': min(interpreter)},
+                   'repeats': repeats, 'commands': {}}
+        with _startup_server(directory):
+            for argv in STARTUP_COMMANDS:
+                stdin = STARTUP_STDIN.get(argv[0])
+                with open(os.path.join(directory, stdin) if stdin else os.devnull, 'r') as input_file:
+                    probe = subprocess.run([sys.executable, '-c', _NUMPY_PROBE] + argv, cwd=directory, stdin=input_file,
+                                           stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+                entry = {'numpy_imported': 'numpy imported: True' in probe.stderr}
+                for mode, program in (('script', [sys.executable, 'engine.py']), ('module', [sys.executable, '-m', 'engine'])):
+                    timings = _time_command(program + argv, directory, repeats, stdin)
+                    entry[mode] = {'median_ms': statistics.median(timings), 'min_ms': min(timings)}
+                results['commands'][' '.join(argv)] = entry
+        return results
+    finally:
+        shutil.rmtree(directory)
+
+
+def _percentile(ordered, fraction):
+    # The nearest rank percentile of values already sorted
+    return ordered[min(len(ordered) - 1, max(0, int(math.ceil(fraction * len(ordered))) - 1))]
+
+
+def _reference_records(symbols):
+    # Every fifth stock is Preferred, as in the sample data, and the dividends and par values vary from stock to stock
+    records = []
+    for position, symbol in enumerate(symbols):
+        preferred = position % 5 == 4
+        records.append({'Stock_Symbol': symbol, 'Type': 'Preferred' if preferred else 'Common',
+                        'Last_Dividend': position % 23, 'Fixed_Dividend': 2 if preferred else '',
+                        'Par_Value': 60 + position % 191})
+    return records
+
+
+def _measure(function, arguments, memory=True):
+    """
+    Calls a function once per argument tuple, timing every call, then once more under tracemalloc for its peak memory
+
+    :param function: The entry point of the engine to measure
+    :param arguments: The list of argument tuples, one per call
+    :param memory: Whether the peak memory of a call is measured as well
+    :return: A dictionary with the number of calls, the throughput in calls per second, the p50, p99 and maximum latencies in milliseconds and the peak memory of a call in KiB
+    """
+    latencies = []
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        started = time.perf_counter()
+        for call in arguments:
+            call_started = time.perf_counter_ns()
+            function(*call)
+            latencies.append(time.perf_counter_ns() - call_started)
+        elapsed = time.perf_counter() - started
+        peak = None
+        if memory:
+            tracemalloc.start()
+            try:
+                function(*arguments[0])
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+    latencies.sort()
+    return {'calls': len(latencies), 'ops_per_s': len(latencies) / elapsed if elapsed else None,
+            'p50_ms': _percentile(latencies, 0.5) / 1e6, 'p99_ms': _percentile(latencies, 0.99) / 1e6,
+            'max_ms': latencies[-1] / 1e6, 'peak_kib': peak / 1024 if peak is not None else None}
+
+
+def _uncached(function):
+    # The function with the result cache of the engine cleared before every call
+    def call(*arguments):
+        engine.RESULT_CACHE.clear()
+        return function(*arguments)
+    return call
+
+
+def _engine_scenario(trades, symbol_count, calls, scans, seed):
+    """
+    Generates a history of trades over synthetic stocks in a scratch directory and measures every entry point on it
+
+    :param trades: The number of trades of the history
+    :param symbol_count: The number of stocks of the reference data
+    :param calls: The number of calls of the lookups and pricing functions; a tenth of it for the trade records and the volume weighted stock prices
+    :param scans: The number of calls of gbce_all_share_index, which reads every trade
+    :param seed: The seed of the generated history and of the arguments of the calls
+    :return: A dictionary with the size of the scenario, the time taken to generate it and the measurements keyed by entry point
+    """
+    symbols = ['S{:04d}'.format(position) for position in range(symbol_count)]
+    directory = tempfile.mkdtemp(prefix='bench_engine_')
+    cwd = os.getcwd()
+    registry = engine.STOCK_REGISTRY
+    try:
+        # trade_record writes to the working directory, where the synthetic reference data is read from too
+        os.chdir(directory)
+        with open('sample_data_gbce.json', 'w') as fileobj:
+            json.dump(_reference_records(symbols), fileobj)
+        engine.STOCK_REGISTRY = engine.StockRegistry()
+
+        started = time.perf_counter()
+        engine.simulate_trades(symbols, trades, seed=seed, directory=directory)
+        setup_s = time.perf_counter() - started
+        traded = engine.trade_symbols(directory)
+
+        generator = random.Random(seed)
+        lookups = [(generator.choice(symbols),) for _ in range(calls)]
+        priced = [(symbol, round(generator.uniform(1, 200), 2)) for (symbol,) in lookups]
+        recorded = [(generator.choice(symbols), generator.randint(1, 1000), generator.choice(('BUY', 'SELL')),
+                     round(generator.uniform(1, 200), 2)) for _ in range(max(1, calls // 10))]
+        queried = [(generator.choice(traded), directory) for _ in range(max(1, calls // 10))]
+
+        results = {}
+        results['main_data'] = _measure(engine.main_data, lookups)
+        results['calculate_dividend_yield'] = _measure(engine.calculate_dividend_yield, priced)
+        results['p_to_e_ratio'] = _measure(engine.p_to_e_ratio, priced)
+        # The first query of a stock builds the column file of its journal, the later ones only map it; the result
+        # cache is cleared before each query so the calculation itself is measured, then the repeated query
+        results['volume_weighted_stock_price'] = _measure(_uncached(engine.volume_weighted_stock_price), queried)
+        results['volume_weighted_stock_price_cached'] = _measure(engine.volume_weighted_stock_price, queried)
+        results['gbce_all_share_index'] = _measure(_uncached(engine.gbce_all_share_index), [(directory,)] * scans)
+        results['gbce_all_share_index']['trades_per_s'] = results['gbce_all_share_index']['ops_per_s'] * trades
+        results['gbce_all_share_index_cached'] = _measure(engine.gbce_all_share_index, [(directory,)] * max(scans, calls // 10))
+        # Trades are recorded last, as they grow the history the other entry points read
+        results['trade_record'] = _measure(engine.trade_record, recorded)
+        return {'trades': trades, 'symbols': symbol_count, 'setup_s': setup_s, 'results': results}
+    finally:
+        engine.STOCK_REGISTRY = registry
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+
+
+def engine_benchmark(trades=(1000, 100000), symbols=(5, 50), calls=1000, scans=3, seed=42):
+    """
+    Measures main_data, calculate_dividend_yield, p_to_e_ratio, trade_record, volume_weighted_stock_price and
+    gbce_all_share_index on generated histories of every number of trades and of stocks given
+
+    :param trades: The numbers of trades of the histories
+    :param symbols: The numbers of stocks of the histories
+    :param calls: The number of calls of the cheap entry points per history
+    :param scans: The number of calls of gbce_all_share_index per history
+    :param seed: The seed of the generated histories
+    :return: A dictionary with the environment and one entry per history in scenarios
+    """
+    import numpy
+    results = {'environment': {'python': platform.python_version(), 'numpy': numpy.__version__,
+                               'machine': platform.machine(), 'cpus': os.cpu_count()},
+               'calls': calls, 'scans': scans, 'seed': seed, 'scenarios': []}
+    for trade_count in trades:
+        for symbol_count in symbols:
+            results['scenarios'].append(_engine_scenario(trade_count, symbol_count, calls, scans, seed))
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance=0.2):
+    """
+    Compares the p50 latencies of the entry points to those of a baseline run of the same scenarios
+
+    :param results: The results of engine_benchmark()
+    :param baseline: The results of an earlier run of engine_benchmark()
+    :param tolerance: How much slower than the baseline an entry point can be, 0.2 for 20%, before it counts as a regression
+    :return: A list of dictionaries with the scenario, the entry point, both p50 latencies, their ratio and the verdict faster, unchanged or slower
+    """
+    earlier = {(scenario['trades'], scenario['symbols']): scenario['results'] for scenario in baseline.get('scenarios', [])}
+    comparison = []
+    for scenario in results['scenarios']:
+        baseline_results = earlier.get((scenario['trades'], scenario['symbols']))
+        if baseline_results is None:
+            continue
+        for name, measured in sorted(scenario['results'].items()):
+            if name not in baseline_results or not baseline_results[name]['p50_ms']:
+                continue
+            ratio = measured['p50_ms'] / baseline_results[name]['p50_ms']
+            if ratio > 1 + tolerance:
+                verdict = 'slower'
+            elif ratio < 1 / (1 + tolerance):
+                verdict = 'faster'
+            else:
+                verdict = 'unchanged'
+            comparison.append({'trades': scenario['trades'], 'symbols': scenario['symbols'], 'function': name,
+                               'p50_ms': measured['p50_ms'], 'baseline_p50_ms': baseline_results[name]['p50_ms'],
+                               'ratio': ratio, 'verdict': verdict})
+    return comparison
+
+
+def _sizes(text):
+    return [int(float(size)) for size in text.split(',')]
+
+
+def main(argv=None):
+    """
+    Runs the benchmark named on the command line and prints its results as json
+
+    :param argv: The command line, program name first, sys.argv by default
+    :return: Nothing, exits with status 1 when an entry point got slower than the baseline allows
+    """
+    import argparse
+
+    if argv is None:
+        argv = sys.argv
+    parser = argparse.ArgumentParser(prog='bench_engine.py', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    benchmarks = parser.add_subparsers(dest='benchmark')
+    benchmarks.required = True
+    startup = benchmarks.add_parser('startup', help='The start of a fresh engine process for every command line switch but --serve')
+    startup.add_argument('--repeats', type=int, default=20, help='The runs of each command line')
+    engine_parser = benchmarks.add_parser('engine', help='The entry points of the engine on generated histories of trades')
+    engine_parser.add_argument('--trades', type=_sizes, default=[1000, 100000],
+                               help='The comma separated numbers of trades of the histories, 1000,100000 by default')
+    engine_parser.add_argument('--symbols', type=_sizes, default=[5, 50],
+                               help='The comma separated numbers of stocks of the histories, 5,50 by default')
+    engine_parser.add_argument('--calls', type=int, default=1000, help='The calls of the cheap entry points per history')
+    engine_parser.add_argument('--scans', type=int, default=3, help='The calls of gbce_all_share_index per history')
+    engine_parser.add_argument('--seed', type=int, default=42, help='The seed of the generated histories')
+    engine_parser.add_argument('--baseline', help='The json results of an earlier run to compare against')
+    engine_parser.add_argument('--tolerance', type=float, default=0.2,
+                               help='The slowdown of a p50 latency over the baseline counted as a regression, 0.2 by default')
+    for benchmark_parser in (startup, engine_parser):
+        benchmark_parser.add_argument('--output', help='The file the json results are written to, besides the standard output')
+    arguments = parser.parse_args(argv[1:])
+
+    if arguments.benchmark == 'startup':
+        results = startup_benchmark(arguments.repeats)
+    else:
+        results = engine_benchmark(arguments.trades, arguments.symbols, arguments.calls, arguments.scans, arguments.seed)
+        if arguments.baseline:
+            with open(arguments.baseline, 'r') as fileobj:
+                results['comparison'] = compare_to_baseline(results, json.load(fileobj), arguments.tolerance)
+    text = json.dumps(results, indent=2)
+    print(text)
+    if arguments.output:
+        with open(arguments.output, 'w') as fileobj:
+            fileobj.write(text + '\n')
+    if any(entry['verdict'] == 'slower' for entry in results.get('comparison', [])):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
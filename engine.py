@@ -9,48 +9,270 @@ This is a standalone script which emulates a simple stock market.
 
 # ======================================================================
 # Library Declarations as needed
-import copy
+# Only light modules are imported here; NumPy is imported the first time it is used, and the modules needed by a
+# single command (the server, the client, the pools of the All Share Index) are imported by that command, so a
+# simple command does not pay for them when the engine starts
+import atexit
+import bisect
+import collections
+import csv
 import datetime
+import functools
+import importlib
+import itertools
 import json
-import random
+import math
 import os
-import operator
-import functools
-import numpy as np
+import struct
 import sys
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # Without fcntl (on Windows) the journals are only locked between the threads of one process
+    fcntl = None
+
+
+class _LazyModule(object):
+    # Stands in for a module until one of its attributes is first used, then imports it and takes its place among the
+    # globals of the engine, so later uses cost nothing more than a direct import
+
+    def __init__(self, name, alias):
+        self._name = name
+        self._alias = alias
+
+    def __getattr__(self, attribute):
+        module = importlib.import_module(self._name)
+        globals()[self._alias] = module
+        return getattr(module, attribute)
+
+
+np = _LazyModule('numpy', 'np')
+
+
+class EngineStats(object):
+    """
+    This class gathers the time spent in each stage of the hot paths of the engine and counters of the work done there
+    (bytes read, records parsed, records in the window, cache hits and misses)
+
+    The engine only reaches it through the module global _STATS, which is None while the statistics are disabled, so a
+    disabled engine pays one global lookup per instrumented function and nothing else.
+    """
+
+    def __init__(self, profile=False):
+        """
+        :param profile: Whether the engine is run under cProfile as well
+        """
+        self._lock = threading.Lock()
+        self.timers = collections.defaultdict(lambda: [0, 0])
+        self.counters = collections.Counter()
+        self.profiler = None
+        if profile:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def lap(self, stage, started_ns):
+        """
+        This method adds the time since started_ns to a stage
+
+        :param stage: The name of the stage
+        :param started_ns: The time.perf_counter_ns() at the start of the stage
+        :return: The time.perf_counter_ns() now, the start of the next stage
+        """
+        now_ns = time.perf_counter_ns()
+        with self._lock:
+            timer = self.timers[stage]
+            timer[0] += 1
+            timer[1] += now_ns - started_ns
+        return now_ns
+
+    def count(self, counter, amount=1):
+        """
+        This method adds an amount to a counter
+
+        :param counter: The name of the counter
+        :param amount: How much is added
+        """
+        with self._lock:
+            self.counters[counter] += amount
+
+    def snapshot(self, profile_top=20):
+        """
+        :param profile_top: How many functions of the profile are given, the slowest first by cumulative time
+        :return: A dictionary of the stages with their calls and total and mean milliseconds, of the counters and,
+                 when profiling, of the functions taking the most cumulative time
+        """
+        with self._lock:
+            timers = {stage: {'calls': calls, 'total_ms': total_ns / 1e6, 'mean_ms': total_ns / 1e6 / calls}
+                      for stage, (calls, total_ns) in sorted(self.timers.items())}
+            snapshot = {'timers': timers, 'counters': dict(sorted(self.counters.items()))}
+        if self.profiler is not None:
+            import pstats
+            profile = pstats.Stats(self.profiler).stats
+            slowest = sorted(profile.items(), key=lambda item: item[1][3], reverse=True)[:profile_top]
+            snapshot['profile'] = [{'function': '{}:{}({})'.format(*function), 'calls': calls,
+                                    'total_ms': total * 1e3, 'cumulative_ms': cumulative * 1e3}
+                                   for function, (_, calls, total, cumulative, _) in slowest]
+        return snapshot
+
+
+# The statistics of this process, None while they are disabled
+_STATS = None
+
+
+def enable_stats(profile=False):
+    """
+    This function starts gathering the statistics of the engine; it keeps the statistics gathered so far if they are
+    already enabled
+
+    :param profile: Whether the engine is run under cProfile as well
+    :return: The EngineStats gathering them
+    """
+    global _STATS
+    if _STATS is None:
+        _STATS = EngineStats(profile)
+    return _STATS
+
+
+def disable_stats():
+    """
+    This function stops gathering the statistics of the engine
+
+    :return: The statistics gathered until now as given by get_stats(), None if they were not enabled
+    """
+    global _STATS
+    stats, _STATS = _STATS, None
+    if stats is None:
+        return None
+    if stats.profiler is not None:
+        stats.profiler.disable()
+    return stats.snapshot()
+
+
+def get_stats():
+    """
+    :return: The statistics gathered so far as given by EngineStats.snapshot(), None if they are not enabled
+    """
+    stats = _STATS
+    return stats.snapshot() if stats is not None else None
+
+
+def reset_stats():
+    """
+    This function clears the statistics gathered so far, if they are enabled, profile included
+    """
+    global _STATS
+    stats = _STATS
+    if stats is not None:
+        if stats.profiler is not None:
+            stats.profiler.disable()
+        _STATS = EngineStats(stats.profiler is not None)
 
 
 # ======================================================================
 
 
+class StockRegistry(object):
+    """
+    This class holds the table of the example stock data in memory, keyed by the stock symbol, so that it is read only once
+
+    The table is reloaded from the file only when the modification time of the file changes. A table can also be injected
+    from memory with the load() method, in which case the file is not consulted at all.
+    """
+
+    def __init__(self, path='sample_data_gbce.json'):
+        """
+        :param path: The path to the json file holding the example stock data
+        """
+        self.path = path
+        self._table = None
+        self._mtime = None
+
+    def load(self, records):
+        """
+        This method injects the reference table from memory instead of reading it from the file
+
+        :param records: An iterable of dictionaries in the format of sample_data_gbce.json
+        :return: Nothing, the registry is filled in place
+        """
+        self._table = {di['Stock_Symbol']: di for di in records if 'Stock_Symbol' in di}
+        # An injected table is never reloaded from the file
+        self.path = None
+        self._mtime = None
+
+    def refresh(self):
+        """
+        This method reloads the reference table from the file if the file has been modified since it was last read
+
+        :return: Nothing, raises IOError if the file cannot be read
+        """
+        if self.path is None:
+            return
+        stats = _STATS
+        path_stat = os.stat(self.path)
+        if self._table is not None and path_stat.st_mtime_ns == self._mtime:
+            if stats is not None:
+                stats.count('registry.hits')
+            return
+        if stats is not None:
+            started = time.perf_counter_ns()
+        with open(self.path) as stock_market_data:
+            example_stock_data = json.load(stock_market_data)
+        self._table = {di['Stock_Symbol']: di for di in example_stock_data if 'Stock_Symbol' in di}
+        self._mtime = path_stat.st_mtime_ns
+        if stats is not None:
+            stats.lap('registry.load', started)
+            stats.count('registry.misses')
+            stats.count('registry.bytes_read', path_stat.st_size)
+
+    def get(self, symbol):
+        """
+        This method looks up a stock symbol in the reference table
+
+        :param symbol: The stock symbol the user is interested in investigating
+        :return: The row of the reference table for the symbol, raises KeyError if the symbol is unknown
+        """
+        self.refresh()
+        return self._table[symbol]
+
+    def symbols(self):
+        """
+        :return: The list of stock symbols in the reference table
+        """
+        self.refresh()
+        return list(self._table)
+
+
+# The registry shared by all the functions below
+STOCK_REGISTRY = StockRegistry()
+
+
 def main_data(symbol):
     """
-    This function merely reads the table of the example stock data provided with the task
+    This function merely looks up the table of the example stock data provided with the task
 
     :param symbol: The stock symbol the user is interested in investigating
     :return: Returns the locator for further seeking in the example data table given
     """
-    # We import the json file where the sample data has been written
+    stats = _STATS
+    if stats is not None:
+        started = time.perf_counter_ns()
+    # We take the table from the registry which only reads the json file when it has changed
     try:
-        with open('sample_data_gbce.json') as stock_market_data:
-            example_stock_data = json.load(stock_market_data)
-        # We create a locator for the rest of the functions to use which helps point to the stock the user needs
+        locator = STOCK_REGISTRY.get(symbol)
     except IOError:
         print(
             'Error! The file sample_data_gbce.json has not been found. It is requred for the program to run correctly. Please put it back in the folder where the script is located!\n')
         return False
-
-    # We check if the stock symbol exists in the database
-    list_of_symbols = [di['Stock_Symbol'] for di in example_stock_data if 'Stock_Symbol' in di]
-
     # Otherwise we sound an alarm:
-    if symbol not in list_of_symbols:
+    except KeyError:
         raise ValueError('Stock symbol not in database')
-        return False
-
-    #We test if the stock symbol is within the provided data..
-    locator = next(item for item in example_stock_data if item["Stock_Symbol"] == symbol)
 
+    if stats is not None:
+        stats.lap('main_data', started)
     # We output the locator
     return locator
 
@@ -140,20 +362,913 @@ def p_to_e_ratio(symbol, price):
     # And return the P/e ratio
 
 
-def trade_record(symbol, quantity_of_shares, movement, price):
+def _reference_columns(symbols):
+    # We look each distinct stock up once and spread its reference data over the array of symbols
+    distinct, positions = np.unique(symbols, return_inverse=True)
+    preferred = np.empty(len(distinct), dtype=bool)
+    last_dividend = np.empty(len(distinct), dtype=np.float64)
+    fixed_dividend = np.empty(len(distinct), dtype=np.float64)
+    par_value = np.empty(len(distinct), dtype=np.float64)
+    for position, symbol in enumerate(distinct.tolist()):
+        locator = main_data(symbol)
+        if not locator:
+            raise ValueError(
+                'Error! The locator could not be found. The file sample_data_gbce.json is probably missing. It is requred for the program to run correctly. Please put it back in the folder where the script is located!\n')
+        if locator['Type'] not in ('Preferred', 'Common'):
+            raise ValueError(
+                'Not proper type of stock! Stock is {} and it should be either Preferred or Common'.format(locator['Type']))
+        preferred[position] = locator['Type'] == 'Preferred'
+        last_dividend[position] = float(locator['Last_Dividend'] or 0)
+        fixed_dividend[position] = float(locator['Fixed_Dividend'] or 0)
+        par_value[position] = float(locator['Par_Value'] or 0)
+    positions = positions.reshape(np.shape(symbols))
+    return preferred[positions], last_dividend[positions], fixed_dividend[positions], par_value[positions]
+
+
+def _pricing_arrays(symbols, prices):
+    # Safety measures to ensure what has been passed will be the proper type, broadcasting symbols against prices
+    symbols, prices = np.broadcast_arrays(np.asarray(symbols, dtype=str), np.asarray(prices, dtype=np.float64))
+    # Some sanity checks
+    if (prices < 0).any():
+        raise ValueError("The user needs to enter a positive price")
+    return symbols, prices
+
+
+def dividend_yield_array(symbols, prices):
     """
-    This function aims to emulate the recording of a trade. The recorded trade will be outputed on the screen. A file with the respective stock symbol will be created with a recorded trade as well in the json format, named
+    This function calculates the Dividend Yield for many stocks and prices at once, with the formulas of
+    calculate_dividend_yield() applied to whole arrays. The reference data of each distinct stock is looked up once.
+
+    Symbols and prices are broadcast against each other, so a grid of every stock by every candidate price is
+    calculated with np.array(symbols)[:, None] and np.array(prices)[None, :].
+
+    :param symbols: A stock symbol or an array (or sequence) of stock symbols
+    :param prices: A price or an array (or sequence) of prices
+    :return: An array of the dividend yields in percent, rounded to 2 digits; NaN where the price is 0
+    """
+    symbols, prices = _pricing_arrays(symbols, prices)
+    preferred, last_dividend, fixed_dividend, par_value = _reference_columns(symbols)
+    # Preferred: (Fixed Dividend * Par Value) / Price, Common: Last Dividend / Price
+    dividend = np.where(preferred, fixed_dividend * par_value, last_dividend)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dividend_yield = np.round(dividend / prices * 100, 2)
+    dividend_yield[prices == 0] = np.nan
+    return dividend_yield
+
+
+def p_to_e_ratio_array(symbols, prices):
+    """
+    This function calculates the P/E ratio for many stocks and prices at once, with the formula of p_to_e_ratio()
+    applied to whole arrays. Symbols and prices are broadcast against each other as in dividend_yield_array().
+
+    :param symbols: A stock symbol or an array (or sequence) of stock symbols
+    :param prices: A price or an array (or sequence) of prices
+    :return: An array of the P/E ratios, rounded to 2 digits; NaN where the last dividend of the stock is 0
+    """
+    symbols, prices = _pricing_arrays(symbols, prices)
+    last_dividend = _reference_columns(symbols)[1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p_e_ratio = np.round(prices / last_dividend, 2)
+    p_e_ratio[last_dividend == 0] = np.nan
+    return p_e_ratio
+
+
+def price_file(input_path, output_path=None):
+    """
+    This function calculates the Dividend Yield and the P/E ratio of every line of a CSV file of stock symbols and
+    prices (with an optional Stock,Price header) and writes them to a CSV file, all in one go
+
+    :param input_path: The CSV file to read, - for the standard input
+    :param output_path: The CSV file to write, the standard output by default
+    :return: The number of lines priced
+    """
+    input_file = sys.stdin if input_path == '-' else open(input_path, 'r')
+    try:
+        rows = [row for row in csv.reader(input_file) if row]
+    finally:
+        if input_file is not sys.stdin:
+            input_file.close()
+    if rows and rows[0][0] == 'Stock':
+        rows = rows[1:]
+    symbols = [row[0] for row in rows]
+    prices = np.asarray([row[1] for row in rows], dtype=np.float64)
+    dividend_yields = dividend_yield_array(symbols, prices).tolist()
+    p_e_ratios = p_to_e_ratio_array(symbols, prices).tolist()
+
+    output_file = sys.stdout if output_path is None else open(output_path, 'w', newline='')
+    try:
+        writer = csv.writer(output_file)
+        writer.writerow(['Stock', 'Price', 'Dividend_Yield', 'PE_Ratio'])
+        writer.writerows(zip(symbols, prices.tolist(), dividend_yields, p_e_ratios))
+    finally:
+        if output_file is not sys.stdout:
+            output_file.close()
+    return len(rows)
+
+
+def journal_path(symbol, directory=None):
+    """
+    This function gives the path to the append-only trade journal of a stock
+
+    :param symbol: The stock symbol the user is interested in investigating
+    :param directory: The directory holding the trade records, the current working directory by default
+    :return: The path to the file trade_<SYMBOL>.jsonl
+    """
+    return os.path.join(directory or os.getcwd(), "trade_{}.jsonl".format(symbol))
+
+
+def legacy_path(symbol, directory=None):
+    """
+    This function gives the path to the legacy json trade records file of a stock, which holds its trades recorded
+    before the journals (see migrate_trade_files)
+
+    :param symbol: The stock symbol the user is interested in investigating
+    :param directory: The directory holding the trade records, the current working directory by default
+    :return: The path to the file trade_<SYMBOL>.json
+    """
+    return os.path.join(directory or os.getcwd(), "trade_{}.json".format(symbol))
+
+
+@functools.lru_cache(maxsize=4096)
+def _timestamp_second_to_epoch_ns(second):
+    moment = datetime.datetime.strptime(second.replace('/', '-'), '%Y-%m-%d %H:%M:%S')
+    return int(time.mktime(moment.timetuple())) * 10 ** 9
+
+
+def timestamp_to_epoch_ns(timestamp):
+    """
+    This function converts the Timestamp string of a trade record (local time, Year-Month-Day Hours:Minutes:Seconds,
+    optionally followed by a fraction of a second) to integer nanoseconds since the epoch
+
+    :param timestamp: The Timestamp string of a trade record
+    :return: The timestamp in nanoseconds since the epoch
+    """
+    # The trades of a legacy file come in bursts within the same second, so each second is only parsed once
+    second, _, fraction = timestamp.partition('.')
+    epoch_ns = _timestamp_second_to_epoch_ns(second)
+    if fraction:
+        epoch_ns += int(fraction[:9].ljust(9, '0'))
+    return epoch_ns
+
+
+def datetime_to_epoch_ns(moment):
+    """
+    :param moment: A naive datetime in local time
+    :return: The datetime in nanoseconds since the epoch
+    """
+    return int(time.mktime(moment.timetuple())) * 10 ** 9 + moment.microsecond * 1000
+
+
+@functools.lru_cache(maxsize=4096)
+def _second_to_timestamp(seconds):
+    return datetime.datetime.fromtimestamp(seconds).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def epoch_ns_to_timestamp(epoch_ns):
+    """
+    This function converts nanoseconds since the epoch to the Timestamp string of the trade records (local time)
+
+    :param epoch_ns: The time in nanoseconds since the epoch
+    :return: The Timestamp string, Year-Month-Day Hours:Minutes:Seconds
+    """
+    # Trades come in bursts within the same second, so the formatting of each second is remembered
+    return _second_to_timestamp(epoch_ns // 10 ** 9)
+
+
+def trade_epoch_ns(record):
+    """
+    This function gives the time of a trade record as nanoseconds since the epoch. Records written before the journals
+    carried the Epoch_ns field have their Timestamp string parsed instead.
+
+    :param record: The trade as a dictionary
+    :return: The time of the trade in nanoseconds since the epoch
+    """
+    epoch_ns = record.get('Epoch_ns')
+    if epoch_ns is None:
+        epoch_ns = timestamp_to_epoch_ns(record['Timestamp'])
+    return epoch_ns
+
+
+# A trade in the fixed width binary encoding: time in nanoseconds since the epoch, price, quantity of shares and side
+# (1 for BUY, -1 for SELL), 25 bytes laid out exactly as a row of trade_dtype() in the column files
+_TRADE_ROW = struct.Struct('<qdqb')
+
+
+class Trade(object):
+    """
+    This class holds one trade in memory without a dictionary per trade: its fields live in __slots__, which takes a
+    fraction of the memory of the trade record dictionaries. It converts to and from the json trade records and to and
+    from the fixed width binary rows of the column files; the stock symbol is not part of a row, as every journal and
+    column file holds the trades of a single stock.
+    """
+
+    __slots__ = ('stock', 'quantity', 'indicator', 'price', 'epoch_ns', 'seq')
+
+    def __init__(self, stock, quantity, indicator, price, epoch_ns, seq=None):
+        """
+        :param stock: The stock symbol
+        :param quantity: The quantity of shares
+        :param indicator: BUY or SELL
+        :param price: The price of the trade
+        :param epoch_ns: The time of the trade in nanoseconds since the epoch
+        :param seq: The sequence number of the trade in the journal of its stock, None until it is recorded
+        """
+        self.stock = stock
+        self.quantity = quantity
+        self.indicator = indicator
+        self.price = price
+        self.epoch_ns = epoch_ns
+        self.seq = seq
+
+    @classmethod
+    def from_record(cls, record):
+        """
+        :param record: A trade record as a dictionary (Stock, Timestamp, Quantity, Indicator, Price and optionally Epoch_ns)
+        :return: The Trade of the record
+        """
+        return cls(str(record['Stock']), int(record['Quantity']), str(record['Indicator']), float(record['Price']),
+                   trade_epoch_ns(record), record.get('Seq'))
+
+    def to_record(self):
+        """
+        :return: The trade as a dictionary in the format of the trade records, its Timestamp taken from its time
+        """
+        record = {'Stock': self.stock, 'Timestamp': epoch_ns_to_timestamp(self.epoch_ns), 'Quantity': self.quantity,
+                  'Indicator': self.indicator, 'Price': self.price, 'Epoch_ns': self.epoch_ns}
+        if self.seq is not None:
+            record['Seq'] = self.seq
+        return record
+
+    @classmethod
+    def unpack_from(cls, stock, buffer, offset=0, seq=None):
+        """
+        :param stock: The stock symbol of the trade, which the binary row does not hold
+        :param buffer: A bytes-like object holding binary rows, such as a memoryview of a memory mapped column file
+        :param offset: Where the row starts in the buffer
+        :param seq: The sequence number of the trade, which is its row in the column file plus one
+        :return: The Trade of the row
+        """
+        epoch_ns, price, quantity, side = _TRADE_ROW.unpack_from(buffer, offset)
+        return cls(stock, quantity, 'BUY' if side == 1 else 'SELL', price, epoch_ns, seq)
+
+    def pack(self):
+        """
+        :return: The trade as a binary row of _TRADE_ROW.size bytes
+        """
+        return _TRADE_ROW.pack(self.epoch_ns, self.price, self.quantity, 1 if self.indicator == 'BUY' else -1)
+
+    def __eq__(self, other):
+        if not isinstance(other, Trade):
+            return NotImplemented
+        return all(getattr(self, field) == getattr(other, field) for field in self.__slots__)
+
+    def __repr__(self):
+        return 'Trade({!r}, {!r}, {!r}, {!r}, {!r}, {!r})'.format(self.stock, self.quantity, self.indicator, self.price,
+                                                               self.epoch_ns, self.seq)
+
+
+# A compact encoder shared by the journals, so no encoder is built per record
+_JOURNAL_ENCODER = json.JSONEncoder(separators=(',', ':'))
+
+# Every entry of a journal index is the pair (newest trade time before the offset, byte offset in the journal)
+_INDEX_ENTRY = struct.Struct('<qq')
+# The time standing for "before any trade" in the index
+_NO_TRADES = -2 ** 63
+# An index entry is added every time this many bytes have been appended to the journal since the last one
+INDEX_BLOCK_BYTES = 64 * 1024
+
+
+def index_path(path):
+    """
+    :param path: The path to a trade journal
+    :return: The path to the sparse time index of the journal
+    """
+    return path + '.idx'
+
+
+def read_journal_index(path):
+    """
+    This function reads the sparse time index of a journal. Each entry (time_ns, offset) guarantees that every trade
+    before the byte offset in the journal happened at or before time_ns, so the times never decrease along the index
+    even when trades were recorded out of order.
+
+    :param path: The path to the trade journal
+    :return: Two lists, the times in nanoseconds and the byte offsets of the entries (empty if there is no index)
+    """
+    try:
+        with open(index_path(path), 'rb') as index_file:
+            data = index_file.read()
+    except IOError:
+        return [], []
+    # A partially written last entry is ignored
+    data = data[:len(data) - len(data) % _INDEX_ENTRY.size]
+    times = []
+    offsets = []
+    for time_ns, offset in _INDEX_ENTRY.iter_unpack(data):
+        times.append(time_ns)
+        offsets.append(offset)
+    return times, offsets
+
+
+class _JournalLock(object):
+    # A lock on the journal of one stock, held across the threads of this process by a reentrant lock and across
+    # processes by an advisory lock on a lock file next to the journal, taken once however deeply it is re-entered
+
+    def __init__(self, path):
+        self.path = path + '.lock'
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._lock_file = None
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        if self._depth == 0:
+            try:
+                self._lock_file = open(self.path, 'a')
+                if fcntl is not None:
+                    fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+            except BaseException:
+                if self._lock_file is not None:
+                    self._lock_file.close()
+                    self._lock_file = None
+                self._thread_lock.release()
+                raise
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self._depth -= 1
+        if self._depth == 0:
+            # Closing the lock file releases the advisory lock
+            self._lock_file.close()
+            self._lock_file = None
+        self._thread_lock.release()
+
+
+_JOURNAL_LOCKS = {}
+_JOURNAL_LOCKS_GUARD = threading.Lock()
+
+
+def journal_lock(path):
+    """
+    This function gives the lock serializing the writers of a journal (and of its index and column files), across the
+    threads of this process and across processes. Writers of different stocks hold different locks and run in
+    parallel. The lock can be re-entered by the thread holding it.
+
+    :param path: The path to the trade journal
+    :return: The lock, to be used in a with statement
+    """
+    key = os.path.abspath(path)
+    with _JOURNAL_LOCKS_GUARD:
+        lock = _JOURNAL_LOCKS.get(key)
+        if lock is None:
+            lock = _JOURNAL_LOCKS[key] = _JournalLock(key)
+    return lock
+
+
+class TradeJournal(object):
+    """
+    This class appends trades to the journal of a stock, one json record per line, so recording a trade costs the same
+    regardless of how many trades have been recorded before. The journal is locked with journal_lock() while it is open.
+
+    Every record carries the time of the trade as integer nanoseconds since the epoch (Epoch_ns) and its sequence number
+    in the journal (Seq), which is its line in the journal, so trades of the same nanosecond keep the order in which
+    they were recorded. Next to the journal a
+    sparse index is kept with one entry per INDEX_BLOCK_BYTES of journal, which lets a time window query seek straight
+    to the first block that can hold trades in the window (see iter_trades).
+
+    With fsync_every set to N the journal is synced to disk once every N records (and when it is closed) instead of after
+    every record; with the default of 0 the operating system decides when the data reaches the disk.
+    """
+
+    def __init__(self, path, fsync_every=0):
+        """
+        :param path: The path to the journal file, created if it does not exist
+        :param fsync_every: The number of records after which the journal is synced to disk, 0 to never sync explicitly
+        """
+        self.path = path
+        self.fsync_every = fsync_every
+        self._unsynced = 0
+        # The journal is locked for as long as it is open, so writers of the same stock never interleave
+        self._lock = journal_lock(path)
+        self._lock.__enter__()
+        try:
+            self._open()
+        except BaseException:
+            self._lock.__exit__(None, None, None)
+            raise
+
+    def _open(self):
+        path = self.path
+        self._fileobj = open(path, 'ab')
+        self._offset = self._fileobj.seek(0, os.SEEK_END)
+        # A record whose writing was interrupted is cut off (the journal is locked), so the next record starts a line
+        end = self._end_of_last_line()
+        if end != self._offset:
+            self._fileobj.truncate(end)
+            self._offset = end
+        # Where the journal ended when it was opened
+        self.start_offset = self._offset
+
+        # The newest trade time before the end of the journal is only known once we have written the journal from an
+        # index entry onwards ourselves, or have read the block after the last entry back (at most once per block)
+        times, offsets = read_journal_index(path)
+        if offsets and offsets[-1] <= self._offset:
+            self._block_start = offsets[-1]
+            self._block_time = times[-1]
+        else:
+            self._block_start = 0
+            self._block_time = _NO_TRADES
+        self._newest = self._block_time if self._offset == self._block_start else None
+        self._index_file = None
+        self._seq = self._last_seq()
+
+    def _end_of_last_line(self):
+        # Where the last complete line of the journal ends
+        if not self._offset:
+            return 0
+        with open(self.path, 'rb') as journal:
+            journal.seek(self._offset - 1)
+            if journal.read(1) == b'\n':
+                return self._offset
+            end = self._offset
+            while end:
+                start = max(0, end - 4096)
+                journal.seek(start)
+                newline = journal.read(end - start).rfind(b'\n')
+                if newline >= 0:
+                    return start + newline + 1
+                end = start
+        return 0
+
+    def _last_seq(self):
+        # The sequence number of the last record is read from the last line; a journal written before the records
+        # carried one has its lines counted, once, as the records appended from then on carry theirs
+        if not self._offset:
+            return 0
+        with open(self.path, 'rb') as journal:
+            tail_start = max(0, self._offset - 4096)
+            journal.seek(tail_start)
+            tail = journal.read(self._offset - tail_start)
+            end = tail.rfind(b'\n')
+            start = tail.rfind(b'\n', 0, max(end, 0)) + 1
+            if end > 0 and (start or not tail_start):
+                seq = json.loads(tail[start:end]).get('Seq')
+                if seq is not None:
+                    return seq
+            journal.seek(0)
+            return sum(chunk.count(b'\n') for chunk in iter(functools.partial(journal.read, 1 << 20), b''))
+
+    def _newest_in_block(self):
+        # We read back the part of the block after the last index entry
+        self._fileobj.flush()
+        newest = self._block_time
+        with open(self.path, 'rb') as journal:
+            journal.seek(self._block_start)
+            for line in journal.read(self._offset - self._block_start).splitlines():
+                if line:
+                    newest = max(newest, trade_epoch_ns(json.loads(line)))
+        return newest
+
+    def _encode(self, record):
+        # We stamp the record with its time in nanoseconds and, when a block is full, add an index entry in front of it
+        if isinstance(record, Trade):
+            record = record.to_record()
+        epoch_ns = trade_epoch_ns(record)
+        self._seq += 1
+        if self._offset - self._block_start >= INDEX_BLOCK_BYTES:
+            if self._newest is None:
+                self._newest = self._newest_in_block()
+            if self._index_file is None:
+                self._index_file = open(index_path(self.path), 'ab')
+            self._index_file.write(_INDEX_ENTRY.pack(self._newest, self._offset))
+            self._block_start = self._offset
+            self._block_time = self._newest
+        if self._newest is not None:
+            self._newest = max(self._newest, epoch_ns)
+        if record.get('Epoch_ns') is None or 'Seq' in record:
+            text = _JOURNAL_ENCODER.encode(dict(record, Epoch_ns=epoch_ns, Seq=self._seq))
+        else:
+            # The sequence number is added to the encoded record, which spares a copy of the record
+            text = '{},"Seq":{}}}'.format(_JOURNAL_ENCODER.encode(record)[:-1], self._seq)
+        line = (text + '\n').encode('utf-8')
+        self._offset += len(line)
+        return line
+
+    @property
+    def offset(self):
+        """
+        :return: Where the journal ends with the records appended so far
+        """
+        return self._offset
+
+    def append(self, record):
+        """
+        :param record: The trade as a Trade or a dictionary in the format of the trade records (Stock, Timestamp, Quantity, Indicator, Price)
+        :return: Nothing, the record is appended to the journal
+        """
+        self._fileobj.write(self._encode(record))
+        self._unsynced += 1
+        if self.fsync_every and self._unsynced >= self.fsync_every:
+            self.sync()
+
+    def extend(self, records):
+        """
+        :param records: An iterable of trades as Trade objects or dictionaries
+        :return: Nothing, the records are appended to the journal through one buffered file
+        """
+        write = self._fileobj.write
+        count = 0
+        for record in records:
+            write(self._encode(record))
+            count += 1
+        self._unsynced += count
+        if self.fsync_every and self._unsynced >= self.fsync_every:
+            self.sync()
+
+    def sync(self):
+        """
+        This method forces the records appended so far to the disk
+        """
+        self._fileobj.flush()
+        os.fsync(self._fileobj.fileno())
+        if self._index_file is not None:
+            self._index_file.flush()
+            os.fsync(self._index_file.fileno())
+        self._unsynced = 0
+
+    def close(self):
+        if self._fileobj.closed:
+            return
+        if self.fsync_every and self._unsynced:
+            self.sync()
+        # The journal is closed before its index so an index entry never points past the end of the journal
+        try:
+            self._fileobj.close()
+            if self._index_file is not None:
+                self._index_file.close()
+        finally:
+            self._lock.__exit__(None, None, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_trade_file(path, after_ns=None):
+    """
+    This function streams the trades back from a trade record file, either a journal (.jsonl) or a legacy json array (.json)
+
+    :param path: The path to the trade record file
+    :param after_ns: If given, only the trades which happened strictly after this time (nanoseconds since the epoch)
+                     are returned; for a journal the reading starts at the block given by its index
+    :return: A generator of the trades as dictionaries
+    """
+    if path.endswith('.jsonl'):
+        start = 0
+        if after_ns is not None:
+            # The last index entry whose trades before it all happened at or before after_ns
+            times, offsets = read_journal_index(path)
+            position = bisect.bisect_right(times, after_ns)
+            if position:
+                start = offsets[position - 1]
+        with open(path, 'rb') as journal:
+            if start > os.fstat(journal.fileno()).st_size:
+                start = 0
+            journal.seek(start)
+            for line in journal:
+                # A line without its newline is a record whose writing was interrupted, so it is skipped
+                if not line.endswith(b'\n'):
+                    break
+                record = json.loads(line)
+                if after_ns is None or trade_epoch_ns(record) > after_ns:
+                    yield record
+    else:
+        with open(path, 'r') as fileobj:
+            for record in json.load(fileobj):
+                if after_ns is None or trade_epoch_ns(record) > after_ns:
+                    yield record
+
+
+def iter_trades(symbol, directory=None, after_ns=None):
+    """
+    This function streams back the trades recorded for a stock, in the order they were recorded
+
+    Trades left in a legacy trade_<SYMBOL>.json file which has not been migrated yet are read before the journal.
+
+    :param symbol: The stock symbol the user is interested in investigating
+    :param directory: The directory holding the trade records, the current working directory by default
+    :param after_ns: If given, only the trades which happened strictly after this time (nanoseconds since the epoch)
+                     are returned, reading only the part of the journal which can hold them
+    :return: A generator of the trades as dictionaries
+    """
+    legacy = legacy_path(symbol, directory)
+    journal = journal_path(symbol, directory)
+    for path in (legacy, journal):
+        if os.path.isfile(path):
+            for record in read_trade_file(path, after_ns):
+                yield record
+
+
+def migrate_trade_files(directory=None):
+    """
+    This function converts the legacy trade_<SYMBOL>.json files of a directory to journals, one shot
+
+    The trades of the legacy file are put in front of any trades already in the journal and the legacy file is removed.
+
+    :param directory: The directory holding the trade records, the current working directory by default
+    :return: A dictionary of the stock symbols migrated and the number of trades taken from each legacy file
+    """
+    directory = directory or os.getcwd()
+    migrated = {}
+    for file_name in sorted(os.listdir(directory)):
+        if not (file_name.startswith('trade_') and file_name.endswith('.json')):
+            continue
+        symbol = file_name[len('trade_'):-len('.json')]
+        legacy = legacy_path(symbol, directory)
+        journal = journal_path(symbol, directory)
+        with journal_lock(journal):
+            migrated[symbol] = _migrate_trade_file(legacy, journal)
+    return migrated
+
+
+def _migrate_trade_file(legacy, journal):
+    # The journal is locked by the caller
+    with open(legacy, 'r') as fileobj:
+        legacy_trades = json.load(fileobj)
+
+    # We write the merged journal and its index aside and only then swap them in, so an interruption loses nothing
+    temporary = journal + '.migrating'
+    for stale in (temporary, index_path(temporary)):
+        if os.path.exists(stale):
+            os.remove(stale)
+    with TradeJournal(temporary, fsync_every=len(legacy_trades) + 1) as new_journal:
+        new_journal.extend(legacy_trades)
+        if os.path.isfile(journal):
+            new_journal.extend(read_trade_file(journal))
+    # The old index goes first, so a reader never seeks in the new journal with it
+    if os.path.exists(index_path(journal)):
+        os.remove(index_path(journal))
+    os.replace(temporary, journal)
+    if os.path.exists(index_path(temporary)):
+        os.replace(index_path(temporary), index_path(journal))
+    if os.path.exists(temporary + '.lock'):
+        os.remove(temporary + '.lock')
+    os.remove(legacy)
+    return len(legacy_trades)
+
+
+# The columns of the trades as stored in the column files: time in nanoseconds since the epoch, price, quantity of shares
+# and side (1 for BUY, -1 for SELL)
+@functools.lru_cache(maxsize=None)
+def trade_dtype():
+    """
+    :return: The NumPy dtype of the rows of the column files (made on first use so NumPy is only imported when needed)
+    """
+    return np.dtype([('timestamp', '<i8'), ('price', '<f8'), ('quantity', '<i8'), ('side', 'i1')])
+
+TradeColumns = collections.namedtuple('TradeColumns', ['timestamp', 'price', 'quantity', 'side'])
+
+# The header of a column file: the format, the journal bytes and rows it holds, the inode of the journal, the newest
+# trade time, the first row from which the times are in order and the newest time of the rows before it
+_COLUMNS_HEADER = struct.Struct('<8sqqQqqq')
+_COLUMNS_FORMAT = b'GBCECOL2'
+
+# The journal is parsed into the column file this many bytes at a time
+_COLUMNS_CHUNK_BYTES = 16 * 1024 * 1024
+
+
+def columns_path(path):
+    """
+    :param path: The path to a trade journal
+    :return: The path to the column file of the journal
+    """
+    return path + '.cols'
+
+
+def _columns_from_records(records):
+    # We gather the fields of the records into the arrays of the columns
+    timestamps = []
+    prices = []
+    quantities = []
+    sides = []
+    for record in records:
+        timestamps.append(trade_epoch_ns(record))
+        prices.append(record['Price'])
+        quantities.append(record['Quantity'])
+        sides.append(1 if record['Indicator'] == 'BUY' else -1)
+    rows = np.empty(len(timestamps), dtype=trade_dtype())
+    rows['timestamp'] = timestamps
+    rows['price'] = prices
+    rows['quantity'] = quantities
+    rows['side'] = sides
+    return rows
+
+
+def _last_step_back(timestamps, last):
+    # The position of the last of new rows whose time is behind the row before it (last is the time of the row before
+    # the new rows, None when there is none); None when they all follow in time order
+    backwards = np.flatnonzero(timestamps[1:] < timestamps[:-1])
+    if len(backwards):
+        return int(backwards[-1]) + 1
+    if last is not None and timestamps[0] < last:
+        return 0
+    return None
+
+
+def refresh_journal_columns(path):
+    """
+    This function brings the column file of a journal up to date. The column file holds the trades of the journal as
+    fixed width rows of trade_dtype() behind a small header, so it can be memory mapped. As the journal only grows, only
+    the lines appended since the last refresh are parsed; a journal which has been replaced (for example by the
+    migration) has its column file rebuilt.
+
+    The times of the rows are in order from a row on (all of them unless trades were recorded late), and the newest
+    time of the rows before that row is kept, so a time window is found by binary search in the ordered rows and only
+    the rows before them which can hold trades of the window are searched.
+
+    :param path: The path to the trade journal
+    :return: The header of the column file (journal bytes held, rows, inode of the journal, newest trade time, first
+             row of the rows in time order, newest trade time of the rows before it)
+    """
+    with journal_lock(path):
+        return _refresh_journal_columns(path)
+
+
+def _refresh_journal_columns(path):
+    # The journal is locked by the caller
+    journal_stat = os.stat(path)
+    cols = columns_path(path)
+    # A column file of another format, or of a journal which has been replaced, is rebuilt
+    fresh = (0, 0, journal_stat.st_ino, _NO_TRADES, 0, _NO_TRADES)
+    columns_header = fresh
+    if os.path.isfile(cols):
+        with open(cols, 'rb') as column_file:
+            header = column_file.read(_COLUMNS_HEADER.size)
+        if len(header) == _COLUMNS_HEADER.size and header.startswith(_COLUMNS_FORMAT):
+            columns_header = _COLUMNS_HEADER.unpack(header)[1:]
+        if columns_header[2] != journal_stat.st_ino or columns_header[0] > journal_stat.st_size:
+            columns_header = fresh
+    offset, rows, inode, newest, sorted_from, prefix_newest = columns_header
+    stats = _STATS
+    if columns_header is not fresh and offset == journal_stat.st_size:
+        if stats is not None:
+            stats.count('columns.hits')
+        return columns_header
+    if stats is not None:
+        stats.count('columns.misses')
+        started = time.perf_counter_ns()
+
+    # New rows are appended in place, behind the rows the readers have mapped; a rebuilt column file is written aside
+    # and replaces the old one at once, so the memory maps of the old one stay valid
+    if columns_header is fresh:
+        target, mode = '{}.{}.{}.tmp'.format(cols, os.getpid(), threading.get_ident()), 'w+b'
+    else:
+        target, mode = cols, 'r+b'
+    with open(target, mode) as column_file:
+        # The time of the last row, which the new rows follow on
+        last = None
+        if rows:
+            column_file.seek(_COLUMNS_HEADER.size + (rows - 1) * trade_dtype().itemsize)
+            last = struct.unpack('<q', column_file.read(8))[0]
+        # Rows beyond the header count were left by an interrupted refresh and are overwritten
+        column_file.seek(_COLUMNS_HEADER.size + rows * trade_dtype().itemsize)
+        column_file.truncate()
+        with open(path, 'rb') as journal:
+            journal.seek(offset)
+            # The new part of the journal is parsed in chunks, so memory stays bounded however much was appended
+            while offset < journal_stat.st_size:
+                chunk = journal.read(min(_COLUMNS_CHUNK_BYTES, journal_stat.st_size - offset))
+                # Only complete lines are taken, a line still being written is picked up by the next refresh
+                complete = chunk.rfind(b'\n') + 1
+                if not complete:
+                    break
+                journal.seek(offset + complete)
+                lines = chunk[:complete].splitlines()
+                if stats is None:
+                    new_rows = _columns_from_records(json.loads(line) for line in lines if line)
+                else:
+                    # The records are parsed before they are taken to columns (times included), so both are timed
+                    started = stats.lap('columns.read', started)
+                    records = [json.loads(line) for line in lines if line]
+                    started = stats.lap('columns.json_parse', started)
+                    new_rows = _columns_from_records(records)
+                    started = stats.lap('columns.convert', started)
+                    stats.count('columns.bytes_read', complete)
+                    stats.count('columns.records_parsed', len(records))
+                if len(new_rows):
+                    column_file.write(new_rows.tobytes())
+                    timestamps = new_rows['timestamp']
+                    step_back = _last_step_back(timestamps, last)
+                    if step_back is not None:
+                        # The rows in time order now start at the last trade recorded late
+                        sorted_from = rows + step_back
+                        prefix_newest = max(newest, int(timestamps[:step_back].max())) if step_back else newest
+                    newest = max(newest, int(timestamps.max()))
+                    last = int(timestamps[-1])
+                if stats is not None:
+                    started = stats.lap('columns.write', started)
+                offset += complete
+                rows += len(new_rows)
+        column_file.flush()
+        column_file.seek(0)
+        column_file.write(_COLUMNS_HEADER.pack(_COLUMNS_FORMAT, offset, rows, inode, newest, sorted_from, prefix_newest))
+    if target != cols:
+        os.replace(target, cols)
+    return offset, rows, inode, newest, sorted_from, prefix_newest
+
+
+def load_journal_columns(path):
+    """
+    This function gives the trades of a journal as NumPy columns memory mapped from its column file, so even tens of
+    millions of trades are neither iterated in Python nor materialized as objects
+
+    :param path: The path to the trade journal
+    :return: A TradeColumns of arrays (timestamp int64, price float64, quantity int64, side int8) and whether the
+             trades are in time order
+    """
+    columns_header = refresh_journal_columns(path)
+    return _mapped_columns(path, columns_header[1]), columns_header[4] == 0
+
+
+def _mapped_columns(path, rows):
+    # The first rows of the column file of a journal, memory mapped
+    if not rows:
+        table = np.empty(0, dtype=trade_dtype())
+    else:
+        table = np.memmap(columns_path(path), dtype=trade_dtype(), mode='r', offset=_COLUMNS_HEADER.size, shape=(rows,))
+    return TradeColumns(table['timestamp'], table['price'], table['quantity'], table['side'])
+
+
+def load_trade_columns(symbol, directory=None):
+    """
+    This function gives all the trades recorded for a stock as NumPy columns; trades left in a legacy
+    trade_<SYMBOL>.json file come first
+
+    :param symbol: The stock symbol the user is interested in investigating
+    :param directory: The directory holding the trade records, the current working directory by default
+    :return: A TradeColumns of arrays (timestamp int64, price float64, quantity int64, side int8)
+    """
+    legacy = legacy_path(symbol, directory)
+    journal = journal_path(symbol, directory)
+    parts = []
+    if os.path.isfile(legacy):
+        table = _columns_from_records(read_trade_file(legacy))
+        parts.append(TradeColumns(table['timestamp'], table['price'], table['quantity'], table['side']))
+    if os.path.isfile(journal):
+        parts.append(load_journal_columns(journal)[0])
+    if len(parts) == 1:
+        return parts[0]
+    if not parts:
+        table = np.empty(0, dtype=trade_dtype())
+        return TradeColumns(table['timestamp'], table['price'], table['quantity'], table['side'])
+    return TradeColumns(*[np.concatenate(column) for column in zip(*parts)])
+
+
+def iter_binary_trades(symbol, directory=None):
+    """
+    This function streams back the trades of the journal of a stock as Trade objects decoded from its column file.
+    The column file is memory mapped and its rows are unpacked in place through a memoryview, so no copy of the file is
+    made, and NumPy is not used to read it.
+
+    :param symbol: The stock symbol the user is interested in investigating
+    :param directory: The directory holding the trade records, the current working directory by default
+    :return: A generator of the Trade objects, in the order of the journal
+    """
+    import mmap
+
+    journal = journal_path(symbol, directory)
+    if not os.path.isfile(journal):
+        return
+    rows = refresh_journal_columns(journal)[1]
+    if not rows:
+        return
+    with open(columns_path(journal), 'rb') as column_file:
+        with mmap.mmap(column_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            table = view[_COLUMNS_HEADER.size:_COLUMNS_HEADER.size + rows * _TRADE_ROW.size]
+            try:
+                for seq, (epoch_ns, price, quantity, side) in enumerate(_TRADE_ROW.iter_unpack(table), 1):
+                    yield Trade(symbol, quantity, 'BUY' if side == 1 else 'SELL', price, epoch_ns, seq)
+            finally:
+                # The mapping can only be closed once no view of it is left
+                table.release()
+                view.release()
+
+
+def trade_record(symbol, quantity_of_shares, movement, price, store=None):
+    """
+    This function aims to emulate the recording of a trade. The recorded trade will be outputed on the screen. The trade is appended to the journal file with the respective stock symbol, named trade_<SYMBOL>.jsonl, which is created if needed, or written to the trade store given
 
     :param symbol: The stock symbol the user is interested in investigating
     :param quantity_of_shares: Quantity of shares the user has bought
     :param movement: The indicator of the trade - has the user bought or sold the stock
     :param price: The price at which the user has bought the given stock
+    :param store: The TradeStore the trade is written to, by default TRADE_STORE or else the journals of the current working directory
     :return: The function returns a recorded trade.
     """
-    # We initialize variables as needed
-    tradedict = {}
-    list_of_trades = []
-
     # Safety measures to ensure what has been passed will be the proper type
     symbol = str(symbol)
     quantity_of_shares = int(quantity_of_shares)
@@ -167,12 +1282,6 @@ def trade_record(symbol, quantity_of_shares, movement, price):
             "The user needs to enter a positive price")
         return False
 
-    # We take the path to the recorded trade json file so we append to it as needed
-    appendtojson = (os.path.realpath(os.path.join(os.getcwd(), "trade_{}.json".format(symbol))))
-    # We create a timestamp in the format Year-Month-Day Hours:Minutes:Seconds
-    now = datetime.datetime.now()
-    timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
-
     # We make a few sanity checks for the input values
     if quantity_of_shares < 1:
         raise ValueError("Bad number of shares! User cannot buy or sell less than 1 ")
@@ -183,170 +1292,1784 @@ def trade_record(symbol, quantity_of_shares, movement, price):
             "The user needs to either enter BUY or SELL for the respective operation they want to perform  for the record of the trade")
         return False
 
-    if price < 0:
-        raise ValueError(
-            "The user needs to enter a positive price")
+    # We make the trade to be written. Input is taken from the user. The store stamps it with the time in nanoseconds
+    # while it holds the lock of the stock, so the trades of concurrent writers are written in time order
+    trade = Trade(symbol, int(quantity_of_shares), movement, float(price), None)
+
+    # We write the trade to the store; with the journals, the journal of the stock is created if there is none yet
+    store = _trade_store(store)
+    is_new_journal = isinstance(store, JsonTradeStore) and not os.path.isfile(journal_path(symbol, store.directory))
+    try:
+        store.write_trades({symbol: [trade]})
+    except IOError:
+        print('Error! The trade of {} could not be written to {}.'.format(symbol, store))
         return False
+    if is_new_journal:
+        print("File trade_{}.jsonl has been written with the trade information provided by the user!".format(symbol))
 
-    # We fill in the dictionary of the trade to be written. Input is taken from the user.
-    tradedict['Stock'] = symbol
-    tradedict['Timestamp'] = timestamp
-    tradedict['Quantity'] = int(quantity_of_shares)
-    tradedict['Indicator'] = movement
-    tradedict['Price'] = float(price)
+    # Write the trade recorded to a variable so its contents can be shown to the user, with a timestamp in the format Year-Month-Day Hours:Minutes:Seconds
+    timestamp = epoch_ns_to_timestamp(trade.epoch_ns)
+    beautiful = "Stock:{}, Timestamp:{}, Quantity:{}, Indicator:{}, Price:{} ".format(symbol, timestamp,
+                                                                                      quantity_of_shares,
+                                                                                      movement, price)
+    # Return the recorded trade
+    return beautiful
 
-    # We take the contents of the dictionary we just filled and put in a variable for later writing
-    list_of_trades.append(copy.deepcopy(tradedict))
 
-    # If there is already such a file for the respective stock, we open it and append to it
-    if os.path.isfile(appendtojson):
-        try:
-            with open("trade_{}.json".format(symbol), 'r') as fileobj:
-                tradingdata = json.load(fileobj)
-                tradingdata.append(tradedict)
-        except IOError:
-            print('Error! The File trade_{}.json could not be read.'.format(symbol))
-            return False
+def record_trades(trades, directory=None, fsync=False, store=None):
+    """
+    This function records many trades at once. The whole batch is validated before anything is written, the trades are
+    grouped by stock symbol and the journal of each stock is written once (or the batch is written to the trade store
+    in one transaction). Each stock's trades are written in time order; the order of the batch is only kept among the
+    trades of the same time, such as the trades given without a time, which are all stamped with the time of the write.
+
+    :param trades: An iterable of trades, either dictionaries with the keys Stock, Quantity, Indicator, Price (and
+                   optionally Timestamp and/or Epoch_ns), Trade objects or tuples in the order (symbol, quantity of
+                   shares, indicator, price)
+    :param directory: The directory holding the trade records, the current working directory by default
+    :param fsync: Whether each journal is synced to disk once its trades are written
+    :param store: The TradeStore the trades are written to, by default TRADE_STORE or else the journals of the directory
+    :return: A dictionary of the stock symbols and the number of trades recorded for each
+    """
+    # We split the batch into columns in one pass so they can be validated as arrays
+    symbols = []
+    quantities = []
+    indicators = []
+    prices = []
+    timestamps = []
+    epochs = []
+    for trade in trades:
+        if isinstance(trade, dict):
+            symbols.append(str(trade['Stock']))
+            quantities.append(trade['Quantity'])
+            indicators.append(str(trade['Indicator']))
+            prices.append(trade['Price'])
+            timestamps.append(trade.get('Timestamp'))
+            epochs.append(trade.get('Epoch_ns'))
+        elif isinstance(trade, Trade):
+            symbols.append(trade.stock)
+            quantities.append(trade.quantity)
+            indicators.append(trade.indicator)
+            prices.append(trade.price)
+            timestamps.append(None)
+            epochs.append(trade.epoch_ns)
+        else:
+            symbols.append(str(trade[0]))
+            quantities.append(trade[1])
+            indicators.append(str(trade[2]))
+            prices.append(trade[3])
+            timestamps.append(None)
+            epochs.append(None)
+    if not symbols:
+        return {}
 
-        try:
-            with open("trade_{}.json".format(symbol), 'w') as fileob:
-                json.dump(tradingdata, fileob, indent=4)
-        except IOerror:
-            print('Error! The File trade_{}.json could not be written to.'.format(symbol))
-            return False
+    # Safety measures to ensure what has been passed will be the proper type
+    try:
+        quantity_column = np.asarray(quantities, dtype=np.float64)
+        price_column = np.asarray(prices, dtype=np.float64)
+    except ValueError:
+        raise ValueError('The quantities and prices of the trades must be numbers')
+    indicator_column = np.asarray(indicators)
+
+    # Some sanity checks, reporting the first offending trade of the batch
+    bad_price = ~np.isfinite(price_column) | (price_column < 0)
+    if bad_price.any():
+        raise ValueError(
+            "The user needs to enter a positive price (trade {} of the batch)".format(int(np.argmax(bad_price))))
+    bad_quantity = ~np.isfinite(quantity_column) | (quantity_column < 1) | (quantity_column != np.floor(quantity_column))
+    if bad_quantity.any():
+        raise ValueError(
+            "Bad number of shares! User cannot buy or sell less than 1 (trade {} of the batch)".format(int(np.argmax(bad_quantity))))
+    bad_indicator = (indicator_column != 'BUY') & (indicator_column != 'SELL')
+    if bad_indicator.any():
+        raise ValueError(
+            "The user needs to either enter BUY or SELL for the respective operation they want to perform (trade {} of the batch)".format(int(np.argmax(bad_indicator))))
+
+    # Trades with a timestamp of their own have it parsed once here, the others are stamped by the store as it writes them;
+    # the times in nanoseconds read from a CSV are strings, and an empty one is no time
+    for position, epoch_ns in enumerate(epochs):
+        if epoch_ns == '':
+            epoch_ns = epochs[position] = None
+        if epoch_ns is not None:
+            try:
+                epoch_ns = epochs[position] = int(epoch_ns)
+            except (TypeError, ValueError):
+                raise ValueError(
+                    "The time of a trade (Epoch_ns) must be a whole number of nanoseconds (trade {} of the batch)".format(position))
+            timestamps[position] = timestamps[position] or epoch_ns_to_timestamp(epoch_ns)
+        elif timestamps[position]:
+            epochs[position] = timestamp_to_epoch_ns(timestamps[position])
+    quantity_column = quantity_column.astype(np.int64).tolist()
+    price_column = price_column.tolist()
+
+    # We group the trades by stock symbol; the store puts each stock's trades in time order, keeping the order of the
+    # batch only among trades of the same time
+    grouped = {}
+    for position, symbol in enumerate(symbols):
+        grouped.setdefault(symbol, []).append({
+            'Stock': symbol,
+            'Timestamp': timestamps[position] or None,
+            'Quantity': quantity_column[position],
+            'Indicator': indicators[position],
+            'Price': price_column[position],
+            'Epoch_ns': epochs[position],
+        })
+    return _trade_store(store, directory).write_trades(grouped, fsync)
+
+
+def read_trade_batch(fileobj):
+    """
+    This function reads a batch of trades from a file in either the JSONL format (one trade record per line) or the CSV
+    format. The CSV may start with a header naming the columns Stock, Quantity, Indicator, Price (and optionally
+    Timestamp); without a header the columns are taken in that order.
 
-    # If there is no file that contains trades recorded for this particular stock, we create one and write the contents of the list we created above (list_of_trades)
-    if not os.path.isfile(appendtojson):
-        try:
-            with open("trade_{}.json".format(symbol), 'w') as newj:
-                json.dump(list_of_trades, newj, indent=4)
-                print("File trade_{}.json has been written with the trade information provided by the user!".format(symbol))
+    :param fileobj: An open file (or sys.stdin) to read the trades from
+    :return: A generator of the trades, ready to be passed to record_trades()
+    """
+    # Lines are read one at a time so that a trade piped in is handled as soon as it arrives
+    lines = iter(fileobj.readline, '')
+    first_line = ''
+    for first_line in lines:
+        if first_line.strip():
+            break
+    if not first_line.strip():
+        return
+
+    if first_line.lstrip().startswith('{'):
+        yield json.loads(first_line)
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+        return
+
+    rows = csv.reader(itertools.chain([first_line], lines))
+    header = next(rows)
+    if 'Stock' in header:
+        for row in rows:
+            if row:
+                yield dict(zip(header, row))
+    else:
+        yield tuple(header)
+        for row in rows:
+            if row:
+                yield tuple(row)
 
-        except IOError:
-            print('Error! The program attempted to create the file trade_{}.json but did not manage to.'.format(symbol))
-            return False
 
-    # Write the trade recorded to a variable so its contents can be shown to the user
-    beautiful = "Stock:{}, Timestamp:{}, Quantity:{}, Indicator:{}, Price:{} ".format(symbol, timestamp,
-                                                                                      quantity_of_shares,
-                                                                                      movement, price)
-    # Return the recorded trade
-    return beautiful
+def _file_signature(path):
+    # What tells a trade records file apart from its earlier versions: a journal only grows, so its size changes with
+    # every trade, and a replaced file has another inode
+    try:
+        file_stat = os.stat(path)
+    except OSError:
+        return None
+    return file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns
+
 
+def _directory_signature(directory):
+    # The signatures of all the trade records files of a directory
+    directory = directory or os.getcwd()
+    return tuple(sorted((file_name, _file_signature(os.path.join(directory, file_name)))
+                        for file_name in os.listdir(directory)
+                        if file_name.startswith('trade_') and file_name.endswith(('.json', '.jsonl'))))
 
-def volume_weighted_stock_price(symbol):
+
+class ResultCache(object):
+    """
+    This class remembers the results of the queries over the trade records, such as the Volume Weighted Stock Price of
+    a stock or the All Share Index of a directory, so a query repeated between two trades costs a dictionary lookup
+    and a stat of the files instead of reading the trades again
+
+    Every entry is kept with the signature of the files it was computed from (inode, size and modification time) and
+    is only given back while they are unchanged. An entry can also carry the time until which its result holds (the
+    Volume Weighted Stock Price changes when its oldest trade leaves the window), and entries are dropped after ttl
+    seconds in any case, the least recently used first once there are maxsize of them.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60.0):
+        """
+        :param maxsize: The number of results kept at most, 0 to keep none
+        :param ttl: The number of seconds a result is kept at most
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, signature, now_ns=None):
+        """
+        :param key: The query, as the tuple (function, symbol or directory, window)
+        :param signature: The signature of the files the result depends on, as they are now
+        :param now_ns: The time now in nanoseconds since the epoch, for the entries holding until a given time
+        :return: The result remembered for the query, or None if there is none still valid
+        """
+        stats = _STATS
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry_signature, value, expires, valid_until_ns = entry
+                if (entry_signature == signature and time.monotonic() < expires
+                        and (valid_until_ns is None or (now_ns or time.time_ns()) < valid_until_ns)):
+                    self._entries.move_to_end(key)
+                    if stats is not None:
+                        stats.count('cache.hits')
+                    return value
+                del self._entries[key]
+        if stats is not None:
+            stats.count('cache.misses')
+        return None
+
+    def put(self, key, signature, value, valid_until_ns=None):
+        """
+        :param key: The query, as the tuple (function, symbol or directory, window)
+        :param signature: The signature of the files the result was computed from
+        :param value: The result
+        :param valid_until_ns: The time (nanoseconds since the epoch) until which the result holds, if it is bounded
+        """
+        if not self.maxsize:
+            return
+        with self._lock:
+            self._entries[key] = (signature, value, time.monotonic() + self.ttl, valid_until_ns)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """
+        This method forgets all the results
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# The results of the queries of this process
+RESULT_CACHE = ResultCache()
+
+# The window of the Volume Weighted Stock Price
+_VWSP_WINDOW_NS = 15 * 60 * 10 ** 9
+
+
+def volume_weighted_stock_price(symbol, directory=None, store=None):
     """
-    This function takes the recorded trades of the last 15 minutes for a given stock from the local file and calculates the Volume Weighted Stock Price
+    This function takes the recorded trades of the last 15 minutes for a given stock from the local journal and calculates the Volume Weighted Stock Price
+    Nothing is written; trades are recorded with trade_record(), record_trades() or simulated with simulate_trades().
 
     :param symbol: The stock symbol the user is interested in investigating
+    :param directory: The directory holding the trade records, the current working directory by default
+    :param store: The TradeStore the trades are read from, by default TRADE_STORE or else the journals of the directory
     :return: Output is the calculated volume weighted stock price
     """
 
-    # We initialize variables as needed
-    volumes_of_trades = []
-    quantities = []
-
     # Safety measures to ensure what has been passed will be the proper type
     symbol = str(symbol)
+    store = _trade_store(store, directory)
 
-    # We create a time marker to know how long was 15 minutes from 'now'
-    timenow = datetime.datetime.now()
-    delta = datetime.datetime.now() - datetime.timedelta(minutes=15)
-    newdelta = delta.replace(microsecond=0)
-    # The movement can be either BUY or SELL and it is randomly chosen
-    movement_indicator = ['BUY', 'SELL']
+    # We create a time marker, in nanoseconds, to know how long was 15 minutes from 'now'
+    now_ns = time.time_ns()
+    cutoff = now_ns - _VWSP_WINDOW_NS
 
-    # We create 10 random trades for the sake of simulation where the user only gives the symbol initially. These will surely be included among the chosen trades of last 15 minutes.
-    # We call the trade_record() function and instruct it to take random prices, random trade indicator, and random quantity
-    for _ in range(100):
-        trade_record(symbol, random.randint(1, 1000), random.choice(movement_indicator),
-                     round(random.uniform(0.1, 100.0), 2))
+    # A price computed since the last trade of the stock, whose oldest trade is still in the window, is given again
+    key = ('volume_weighted_stock_price', store.location(symbol), _VWSP_WINDOW_NS)
+    signature = store.signature(symbol)
+    cached = RESULT_CACHE.get(key, signature, now_ns)
+    if cached is not None:
+        return cached
 
-    # We read the file with the 10 trades written just now so as to gather the needed data
+    # The store sums the price times the quantity and the quantity of the trades in the window
     try:
-        with open("trade_{}.json".format(symbol), 'r') as fi:
-            timingread = json.load(fi)
+        totals = store.window_totals(symbol, cutoff)
     except IOError:
-        print('Error! The program attempted to read the file trade_{}.json but did not manage to.'.format(symbol))
+        print('Error! The program attempted to read the trades of {} but did not manage to.'.format(symbol))
         return False
 
-    # We iterate over the json to find out the data needed
-    for stamp in timingread:
-        # We reformat datetime format of the data we need
-        current_element_stamp = stamp['Timestamp']
-        new = current_element_stamp.replace('/', '-')
-        compare = datetime.datetime.strptime(new, '%Y-%m-%d %H:%M:%S')
-        # If the trades are from last 15 minutes, append to a list of the trade volumes of all the trades of the last 15 minutes (by multiplying price times quantity of the trade) and a list of the quantities of shares
-        if compare > delta:
-            price_current = stamp['Price']
-            quantity_current = stamp['Quantity']
-            current_volume = price_current * quantity_current
-            volumes_of_trades.append(current_volume)
-            quantities.append(quantity_current)
+    # Without trades in the last 15 minutes there is no price to weigh
+    if totals is None:
+        print('Error! No trades of {} have been recorded in the last 15 minutes.'.format(symbol))
+        return False
+
+    # Calculate the Volume Weighted Stock (the sum of the trade volumes, price times quantity, over the sum of the quantities) and return it as output, rounded up to 2 digits after the floating point)
+    traded_volume, quantity, oldest_ns = totals
+    volume_weighted_stock = round(traded_volume / quantity, 2)
+    RESULT_CACHE.put(key, signature, volume_weighted_stock, valid_until_ns=oldest_ns + _VWSP_WINDOW_NS)
+    return volume_weighted_stock
+
+
+def generate_trades(symbols, count, seed=None, rate=100.0, start_ns=None, price=('uniform', 0.1, 100.0),
+                    quantity=('uniform', 1, 1000), chunk_size=100000):
+    """
+    This function generates random trades for the sake of simulation and capacity testing. The trades are drawn with
+    NumPy in chunks, so millions of them can be generated without holding them all in memory.
+
+    :param symbols: The stock symbols to trade, each trade picks one at random
+    :param count: The number of trades to generate
+    :param seed: The seed of the random generator, the same seed gives the same trades
+    :param rate: The average number of trades per second over all stocks; the time between trades is exponential
+    :param start_ns: The time of the first trade in nanoseconds since the epoch; by default the trades end now
+    :param price: The distribution of the prices, ('uniform', low, high) or ('lognormal', mean, sigma)
+    :param quantity: The distribution of the quantities, ('uniform', low, high) or ('poisson', mean) (at least 1 share)
+    :param chunk_size: The number of trades drawn at once
+    :return: A generator of the trades as dictionaries, in time order, ready to be passed to record_trades()
+    """
+    symbols = [str(symbol) for symbol in symbols]
+    if not symbols:
+        raise ValueError('At least one stock symbol is needed to simulate trades')
+    if count < 0 or rate <= 0:
+        raise ValueError('The number of trades cannot be negative and the rate of trades must be positive')
+    if price[0] not in ('uniform', 'lognormal'):
+        raise ValueError('The price distribution must be either uniform or lognormal')
+    if quantity[0] not in ('uniform', 'poisson'):
+        raise ValueError('The quantity distribution must be either uniform or poisson')
+
+    generator = np.random.RandomState(seed)
+    if start_ns is None:
+        start_ns = time.time_ns() - int(count / rate * 10 ** 9)
+    movement_indicator = ['BUY', 'SELL']
+    clock_ns = start_ns
+
+    for chunk_start in range(0, count, chunk_size):
+        size = min(chunk_size, count - chunk_start)
+        gaps = np.cumsum(generator.exponential(10 ** 9 / rate, size)).astype(np.int64)
+        epochs = (clock_ns + gaps).tolist()
+        clock_ns = epochs[-1]
+        picked = generator.randint(0, len(symbols), size).tolist()
+        sides = generator.randint(0, 2, size).tolist()
+        if price[0] == 'uniform':
+            prices = generator.uniform(price[1], price[2], size)
+        else:
+            prices = generator.lognormal(price[1], price[2], size)
+        # Prices are quoted to the penny but never drop to 0
+        prices = np.maximum(np.round(prices, 2), 0.01).tolist()
+        if quantity[0] == 'uniform':
+            quantities = generator.randint(quantity[1], quantity[2] + 1, size)
+        else:
+            quantities = generator.poisson(quantity[1], size) + 1
+        quantities = quantities.tolist()
+
+        for position in range(size):
+            yield {
+                'Stock': symbols[picked[position]],
+                'Timestamp': epoch_ns_to_timestamp(epochs[position]),
+                'Quantity': quantities[position],
+                'Indicator': movement_indicator[sides[position]],
+                'Price': prices[position],
+                'Epoch_ns': epochs[position],
+            }
+
+
+def simulate_trades(symbols, count, seed=None, directory=None, chunk_size=100000, **distributions):
+    """
+    This function generates random trades with generate_trades() and records them through record_trades(), one batch
+    per chunk of trades
+
+    :param symbols: The stock symbols to trade
+    :param count: The number of trades to simulate
+    :param seed: The seed of the random generator
+    :param directory: The directory holding the trade records, the current working directory by default
+    :param chunk_size: The number of trades recorded per batch
+    :param distributions: The rate, start_ns, price and quantity arguments of generate_trades()
+    :return: A dictionary of the stock symbols and the number of trades recorded for each
+    """
+    recorded = collections.Counter()
+    trades = generate_trades(symbols, count, seed, chunk_size=chunk_size, **distributions)
+    while True:
+        batch = list(itertools.islice(trades, chunk_size))
+        if not batch:
+            break
+        recorded.update(record_trades(batch, directory))
+    return dict(recorded)
+
+
+class VWSPTracker(object):
+    """
+    This class keeps the Volume Weighted Stock Price of every stock up to date as trades arrive, instead of reading the
+    trades back from the journal for each calculation
+
+    For each stock the trades of the window are held in a deque together with the running sums of price x quantity and
+    of quantity, so that recording a trade, evicting the trades which fell out of the window and answering a query all
+    take constant (amortized) time. The formula is the one of volume_weighted_stock_price().
+    """
+
+    def __init__(self, window_seconds=15 * 60):
+        """
+        :param window_seconds: The length of the sliding window in seconds, 15 minutes by default
+        """
+        if window_seconds <= 0:
+            raise ValueError('The window of the Volume Weighted Stock Price must be longer than 0 seconds')
+        self.window_ns = int(window_seconds * 10 ** 9)
+        self._windows = {}
+
+    def add(self, symbol, quantity_of_shares, price, epoch_ns=None):
+        """
+        This method records a trade in the window of its stock
+
+        Trades are expected in time order; a trade older than the newest one of its stock is still counted as long as it
+        is inside the window, but it only leaves the window behind the trades in front of it.
+
+        :param symbol: The stock symbol of the trade
+        :param quantity_of_shares: Quantity of shares traded
+        :param price: The price of the trade
+        :param epoch_ns: The time of the trade in nanoseconds since the epoch, now by default
+        :return: The Volume Weighted Stock Price of the stock with this trade included
+        """
+        if epoch_ns is None:
+            epoch_ns = time.time_ns()
+        quantity_of_shares = int(quantity_of_shares)
+        price = float(price)
+        window = self._windows.get(symbol)
+        if window is None:
+            # The trades of the window, the sum of price x quantity, the sum of quantity and the newest trade time
+            window = self._windows[symbol] = [collections.deque(), 0.0, 0, epoch_ns]
+        window[3] = max(window[3], epoch_ns)
+        if epoch_ns > window[3] - self.window_ns:
+            window[0].append((epoch_ns, price * quantity_of_shares, quantity_of_shares))
+            window[1] += price * quantity_of_shares
+            window[2] += quantity_of_shares
+        return self.value(symbol)
+
+    def _evict(self, window, now_ns):
+        trades = window[0]
+        cutoff = now_ns - self.window_ns
+        while trades and trades[0][0] <= cutoff:
+            _, volume, quantity = trades.popleft()
+            window[1] -= volume
+            window[2] -= quantity
+        if not trades:
+            # We start the sums afresh so rounding errors do not build up over time
+            window[1] = 0.0
+            window[2] = 0
+
+    def value(self, symbol, now_ns=None):
+        """
+        This method gives the Volume Weighted Stock Price of a stock over the trades of the window
+
+        :param symbol: The stock symbol the user is interested in investigating
+        :param now_ns: The end of the window in nanoseconds since the epoch, the newest trade of the stock by default
+        :return: The Volume Weighted Stock Price rounded to 2 digits, or None if there is no trade in the window
+        """
+        window = self._windows.get(symbol)
+        if window is None:
+            return None
+        self._evict(window, window[3] if now_ns is None else now_ns)
+        if not window[2]:
+            return None
+        return round(window[1] / window[2], 2)
+
+    def symbols(self):
+        """
+        :return: The list of stock symbols the tracker has seen trades for
+        """
+        return list(self._windows)
+
+
+def stream_volume_weighted_stock_price(trades, tracker=None):
+    """
+    This function feeds a stream of trades to a VWSPTracker and gives back the updated Volume Weighted Stock Price after each one
+
+    :param trades: An iterable of trades as read by read_trade_batch(); trades without a timestamp are taken as happening now
+    :param tracker: The VWSPTracker to feed, a new one with the 15 minute window by default
+    :return: A generator of (stock symbol, time of the trade in nanoseconds since the epoch, Volume Weighted Stock Price)
+    """
+    if tracker is None:
+        tracker = VWSPTracker()
+    for trade in trades:
+        if isinstance(trade, dict):
+            symbol = str(trade['Stock'])
+            quantity_of_shares = trade['Quantity']
+            price = trade['Price']
+            epoch_ns = trade.get('Epoch_ns')
+            if epoch_ns is None and trade.get('Timestamp'):
+                epoch_ns = timestamp_to_epoch_ns(trade['Timestamp'])
+        else:
+            symbol = str(trade[0])
+            quantity_of_shares = trade[1]
+            price = trade[3]
+            epoch_ns = None
+        if epoch_ns is None:
+            epoch_ns = time.time_ns()
+        yield symbol, epoch_ns, tracker.add(symbol, quantity_of_shares, price, epoch_ns)
+
+
+# The resolutions of the bars, by name, in nanoseconds; bars start at whole multiples of their length since the epoch
+BAR_RESOLUTIONS = collections.OrderedDict([('1s', 10 ** 9), ('1m', 60 * 10 ** 9), ('5m', 5 * 60 * 10 ** 9),
+                                           ('15m', 15 * 60 * 10 ** 9), ('1h', 60 * 60 * 10 ** 9)])
+
+
+@functools.lru_cache(maxsize=None)
+def bar_dtype():
+    """
+    :return: The NumPy dtype of the bars of the bar files: the start of the bar, the times of its first and last trades,
+             open, high, low and close prices, the volume in shares, the sum of price x quantity, the bought and sold
+             shares and the number of trades
+    """
+    return np.dtype([('start', '<i8'), ('first_ns', '<i8'), ('last_ns', '<i8'), ('open', '<f8'), ('high', '<f8'),
+                     ('low', '<f8'), ('close', '<f8'), ('volume', '<i8'), ('notional', '<f8'), ('buy_volume', '<i8'),
+                     ('sell_volume', '<i8'), ('trades', '<i8')])
+
+Bars = collections.namedtuple('Bars', ['start', 'open', 'high', 'low', 'close', 'volume', 'vwap', 'imbalance', 'trades'])
+
+# The header of a bar file: the rows of the column file taken in, the finished bars held, the inode of the journal and
+# whether the bar still open follows the header (1) or not (0); the open bar takes one row of bar_dtype() after it
+_BARS_HEADER = struct.Struct('<qqQq')
+# The rows of the column file aggregated at once
+_BARS_CHUNK_ROWS = 1 << 20
 
-    # Calculate the Volume Weighted Stock and return it as output, rounded up to 2 digits after the floating point)
-    volume_weighted_stock = (sum(volumes_of_trades) / sum(quantities))
-    return round(volume_weighted_stock, 2)
 
+def bars_path(path, resolution):
+    """
+    :param path: The path to a trade journal
+    :param resolution: The name of a resolution of BAR_RESOLUTIONS
+    :return: The path to the bar file of the journal at that resolution
+    """
+    return '{}.bars.{}'.format(path, resolution)
+
+
+def _bars_from_trades(timestamps, prices, quantities, sides, length_ns):
+    # We aggregate trades into the bars of one resolution; trades out of time order are sorted first
+    starts = timestamps - timestamps % length_ns
+    if len(starts) > 1 and not (np.diff(timestamps) >= 0).all():
+        order = np.argsort(timestamps, kind='stable')
+        starts, timestamps, prices, quantities, sides = starts[order], timestamps[order], prices[order], quantities[order], sides[order]
+    heads = np.flatnonzero(np.diff(starts)) + 1
+    heads = np.concatenate(([0], heads)).astype(np.intp)
+    tails = np.append(heads[1:], len(starts)) - 1
+    bars = np.empty(len(heads), dtype=bar_dtype())
+    bars['start'] = starts[heads]
+    bars['first_ns'] = timestamps[heads]
+    bars['last_ns'] = timestamps[tails]
+    bars['open'] = prices[heads]
+    bars['close'] = prices[tails]
+    bars['high'] = np.maximum.reduceat(prices, heads)
+    bars['low'] = np.minimum.reduceat(prices, heads)
+    bars['volume'] = np.add.reduceat(quantities, heads)
+    bars['notional'] = np.add.reduceat(prices * quantities, heads)
+    bars['buy_volume'] = np.add.reduceat(np.where(sides > 0, quantities, 0), heads)
+    bars['sell_volume'] = np.add.reduceat(np.where(sides < 0, quantities, 0), heads)
+    bars['trades'] = tails - heads + 1
+    return bars
+
+
+def _combine_bars(bars):
+    # We merge bars of the same start into one; on equal times the open comes from the earlier bar of the list and the
+    # close from the later one, as the list follows the order the trades were recorded in
+    by_first = bars[np.lexsort((bars['first_ns'], bars['start']))]
+    by_last = bars[np.lexsort((bars['last_ns'], bars['start']))]
+    heads = np.concatenate(([0], np.flatnonzero(np.diff(by_first['start'])) + 1)).astype(np.intp)
+    tails = np.append(heads[1:], len(bars)) - 1
+    combined = np.empty(len(heads), dtype=bar_dtype())
+    combined['start'] = by_first['start'][heads]
+    combined['first_ns'] = by_first['first_ns'][heads]
+    combined['open'] = by_first['open'][heads]
+    combined['last_ns'] = by_last['last_ns'][tails]
+    combined['close'] = by_last['close'][tails]
+    combined['high'] = np.maximum.reduceat(by_first['high'], heads)
+    combined['low'] = np.minimum.reduceat(by_first['low'], heads)
+    for field in ('volume', 'notional', 'buy_volume', 'sell_volume', 'trades'):
+        combined[field] = np.add.reduceat(by_first[field], heads)
+    return combined
+
+
+def _read_bars_header(path, resolution):
+    # The header and the open bar of a bar file, None when there is no complete header yet
+    try:
+        with open(bars_path(path, resolution), 'rb') as bar_file:
+            header = bar_file.read(_BARS_HEADER.size + bar_dtype().itemsize)
+    except IOError:
+        return None
+    if len(header) < _BARS_HEADER.size + bar_dtype().itemsize:
+        return None
+    return _BARS_HEADER.unpack_from(header) + (np.frombuffer(header, dtype=bar_dtype(), count=1, offset=_BARS_HEADER.size).copy(),)
+
+
+def _write_bars(path, resolution, finished, open_bar, taken, inode, rebuild):
+    # Finished bars are appended behind the bars already held and the header, with the bar still open, is written last,
+    # so an interrupted refresh leaves the bars of the last header; a rebuilt file replaces the old one at once
+    bar_size = bar_dtype().itemsize
+    has_open = int(open_bar is not None)
+    open_row = open_bar if open_bar is not None else np.zeros(1, dtype=bar_dtype())
+    target = bars_path(path, resolution)
+    if rebuild or not os.path.isfile(target):
+        header = _BARS_HEADER.pack(taken, len(finished), inode, has_open) + open_row.tobytes()
+        _replace_file(target, header + finished.tobytes(), fsync=False)
+        return
+    with open(target, 'r+b') as bar_file:
+        count = _BARS_HEADER.unpack(bar_file.read(_BARS_HEADER.size))[1]
+        bar_file.seek(_BARS_HEADER.size + bar_size * (1 + count))
+        bar_file.truncate()
+        bar_file.write(finished.tobytes())
+        bar_file.flush()
+        bar_file.seek(0)
+        bar_file.write(_BARS_HEADER.pack(taken, count + len(finished), inode, has_open) + open_row.tobytes())
+
+
+def refresh_journal_bars(path):
+    """
+    This function brings the bar files of a journal up to date at every resolution of BAR_RESOLUTIONS in one pass over
+    the trades appended since they were last brought up to date. Each bar file holds the finished bars of a resolution
+    as rows of bar_dtype() and, in its header, the bar still open, which is the only bar the next trades can change. A
+    trade recorded late into a bar already finished has the bar file of that resolution rebuilt from all the trades.
+
+    :param path: The path to the trade journal
+    :return: The number of rows of the column file the bar files hold
+    """
+    with journal_lock(path):
+        rows, inode = refresh_journal_columns(path)[1:3]
+        columns = load_journal_columns(path)[0]
+        states = {}
+        for resolution in BAR_RESOLUTIONS:
+            header = _read_bars_header(path, resolution)
+            if header is None or header[2] != inode or header[0] > rows:
+                header = (0, 0, inode, 0, None)
+            taken, _, _, has_open, open_bar = header
+            states[resolution] = {'taken': taken, 'open': open_bar if has_open else None, 'finished': [],
+                                  'rebuild': header[0] == 0}
+        first = min(state['taken'] for state in states.values())
+
+        # Each chunk of the trades appended since is read once and aggregated at every resolution
+        for chunk_start in range(first, rows, _BARS_CHUNK_ROWS):
+            chunk_end = min(rows, chunk_start + _BARS_CHUNK_ROWS)
+            for resolution, length_ns in BAR_RESOLUTIONS.items():
+                state = states[resolution]
+                start = max(chunk_start, state['taken'])
+                if start >= chunk_end:
+                    continue
+                bars = _bars_from_trades(columns.timestamp[start:chunk_end], columns.price[start:chunk_end],
+                                         columns.quantity[start:chunk_end], columns.side[start:chunk_end], length_ns)
+                if state['open'] is not None:
+                    if bars['start'][0] < state['open']['start'][0]:
+                        # A late trade changes a finished bar: the resolution is rebuilt from all the trades
+                        bars = _bars_from_trades(columns.timestamp[:rows], columns.price[:rows],
+                                                 columns.quantity[:rows], columns.side[:rows], length_ns)
+                        state.update(finished=[bars[:-1]], open=bars[-1:], taken=rows, rebuild=True)
+                        continue
+                    bars = _combine_bars(np.concatenate((state['open'], bars)))
+                state['finished'].append(bars[:-1])
+                state['open'] = bars[-1:]
+                state['taken'] = chunk_end
+
+        for resolution, state in states.items():
+            if state['finished'] or state['rebuild'] or _read_bars_header(path, resolution) is None:
+                finished = np.concatenate(state['finished']) if state['finished'] else np.empty(0, dtype=bar_dtype())
+                _write_bars(path, resolution, finished, state['open'], state['taken'], inode, state['rebuild'])
+        return rows
+
+
+def _bars_columns(bars):
+    # The bars as the columns given to the callers, with the volume weighted average price and the buy/sell imbalance
+    volume = bars['volume'].astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        vwap = bars['notional'] / volume
+        imbalance = (bars['buy_volume'] - bars['sell_volume']) / volume
+    return Bars(bars['start'], bars['open'], bars['high'], bars['low'], bars['close'], bars['volume'], vwap, imbalance,
+                bars['trades'])
+
+
+def load_bars(symbol, resolution='1m', directory=None, start_ns=None, end_ns=None):
+    """
+    This function gives the bars of a stock at one resolution: open, high, low, close, volume, volume weighted average
+    price and buy/sell imbalance ((bought - sold) / volume). The finished bars are memory mapped from the bar file of
+    the journal, which is only brought up to date (at every resolution) when trades were appended since.
+
+    :param symbol: The stock symbol the user is interested in investigating
+    :param resolution: The name of a resolution of BAR_RESOLUTIONS
+    :param directory: The directory holding the trade records, the current working directory by default
+    :param start_ns: If given, only the bars starting at or after this time (nanoseconds since the epoch) are given
+    :param end_ns: If given, only the bars starting before this time are given
+    :return: A Bars of arrays, one element per bar in time order, starts in nanoseconds since the epoch
+    """
+    if resolution not in BAR_RESOLUTIONS:
+        raise ValueError('The resolution of the bars must be one of {}'.format(', '.join(BAR_RESOLUTIONS)))
+    legacy = legacy_path(symbol, directory)
+    journal = journal_path(symbol, directory)
+    if os.path.isfile(legacy):
+        # Trades left in a legacy file are aggregated on the fly, they are not cached
+        columns = load_trade_columns(symbol, directory)
+        if len(columns.timestamp):
+            bars = _bars_from_trades(columns.timestamp, columns.price, columns.quantity, columns.side, BAR_RESOLUTIONS[resolution])
+        else:
+            bars = np.empty(0, dtype=bar_dtype())
+    elif os.path.isfile(journal):
+        with journal_lock(journal):
+            header = _read_bars_header(journal, resolution)
+            columns_header = refresh_journal_columns(journal)
+            if header is None or header[0] != columns_header[1] or header[2] != columns_header[2]:
+                refresh_journal_bars(journal)
+                header = _read_bars_header(journal, resolution)
+            _, count, _, has_open, open_bar = header
+            if count:
+                finished = np.memmap(bars_path(journal, resolution), dtype=bar_dtype(), mode='r',
+                                     offset=_BARS_HEADER.size + bar_dtype().itemsize, shape=(count,))
+            else:
+                finished = np.empty(0, dtype=bar_dtype())
+        first = np.searchsorted(finished['start'], start_ns) if start_ns is not None else 0
+        last = np.searchsorted(finished['start'], end_ns) if end_ns is not None else len(finished)
+        bars = finished[first:last]
+        if has_open:
+            bars = np.concatenate((bars, open_bar))
+    else:
+        bars = np.empty(0, dtype=bar_dtype())
+    if start_ns is not None:
+        bars = bars[bars['start'] >= start_ns]
+    if end_ns is not None:
+        bars = bars[bars['start'] < end_ns]
+    return _bars_columns(bars)
+
+
+def all_bars(resolution='1m', directory=None, start_ns=None, end_ns=None):
+    """
+    :param resolution: The name of a resolution of BAR_RESOLUTIONS
+    :param directory: The directory holding the trade records, the current working directory by default
+    :param start_ns: If given, only the bars starting at or after this time (nanoseconds since the epoch) are given
+    :param end_ns: If given, only the bars starting before this time are given
+    :return: A dictionary of the stock symbols of the directory and their Bars as given by load_bars()
+    """
+    return {symbol: load_bars(symbol, resolution, directory, start_ns, end_ns) for symbol in trade_symbols(directory)}
+
+
+def trade_symbols(directory=None):
+    """
+    This function finds the stocks which have trades recorded in a directory, in a journal or in a legacy json file
+
+    :param directory: The directory holding the trade records, the current working directory by default
+    :return: The sorted list of the stock symbols
+    """
+    symbols = set()
+    for file_name in os.listdir(directory or os.getcwd()):
+        if not file_name.startswith('trade_'):
+            continue
+        for extension in ('.json', '.jsonl'):
+            if file_name.endswith(extension) and os.path.isfile(os.path.join(directory or os.getcwd(), file_name)):
+                symbols.add(file_name[len('trade_'):-len(extension)])
+    return sorted(symbols)
+
+
+# The prices of a journal are taken to the log domain this many at a time, so memory stays bounded for any journal
+_LOG_CHUNK_ROWS = 1 << 20
+
+
+def symbol_log_partial(symbol, directory=None):
+    """
+    This function gives the partial sums the All Share Index is made of for one stock: the sum of the logarithms of the
+    prices of all its trades and the number of trades. Partials of different stocks combine by adding them up.
 
-def gbce_all_share_index(dir_with_files):
+    :param symbol: The stock symbol the user is interested in investigating
+    :param directory: The directory holding the trade records, the current working directory by default
+    :return: A tuple (sum of the logarithms of the prices, number of prices)
     """
-    This function calculates the GBCE all share index by gathering from the local directory all the trade records files and taking from them the prices to which geometric mean will later be used.
+    partial_sums = []
+    count = 0
+    legacy = legacy_path(symbol, directory)
+    journal = journal_path(symbol, directory)
+    # A price of 0 gives a logarithm of -inf, which takes the geometric mean to 0
+    with np.errstate(divide='ignore'):
+        if os.path.isfile(legacy):
+            prices = _columns_from_records(read_trade_file(legacy))['price']
+            partial_sums.append(float(np.log(prices).sum()))
+            count += len(prices)
+        if os.path.isfile(journal):
+            prices = load_journal_columns(journal)[0].price
+            for chunk_start in range(0, len(prices), _LOG_CHUNK_ROWS):
+                chunk = prices[chunk_start:chunk_start + _LOG_CHUNK_ROWS]
+                partial_sums.append(float(np.log(chunk).sum()))
+            count += len(prices)
+    return math.fsum(partial_sums), count
+
+
+def gbce_all_share_index(dir_with_files, workers=None, use_processes=False, store=None):
+    """
+    This function calculates the GBCE all share index by gathering from the given directory all the trade records files and taking from them the prices to which geometric mean will later be used.
     The user must make sure to first use the functionality which writes down trades and then run this function as sufficient number of price data must be gathered.
+    The files of the different stocks are read concurrently; each gives the sum of the logarithms of its prices and their number, which are combined exactly, so the result does not depend on the number of workers.
 
     Reason: The definition of the All-Share-Index from the Cambridge Dictionary is as follows:
     a series of numbers which shows the changing average value of the share prices of all companies on a stock exchange, and which is used as a measure of how well a market is performing.
 
-
+    :param dir_with_files: The directory holding the trade records
+    :param workers: The number of stocks read at the same time, by default as many as the machine has processors; 1 reads them one after the other
+    :param use_processes: Whether the stocks are read by a pool of processes instead of a pool of threads
+    :param store: The TradeStore the trades are read from, by default TRADE_STORE or else the journals of the directory
     :return: All share index is returned as output
     """
-    # Variable initialization
-    price_collection = []
-    flag_file_dictionary = []
+    store = _trade_store(store, dir_with_files)
 
-    # Going over all the files in the current working directory where the python script is located
-    list_of_files_locally = [current_element for current_element in os.listdir(dir_with_files) if os.path.isfile(current_element)]
-    for individual_file in list_of_files_locally:
-        # Check if we have a valid named record file
-        if 'trade_' in individual_file and '.json' in individual_file:
-            flag_file_dictionary.append(individual_file)
+    # An index computed since the trades of the store last changed is given again
+    key = ('gbce_all_share_index', store.location(), None)
+    signature = store.signature()
+    cached = RESULT_CACHE.get(key, signature)
+    if cached is not None:
+        return cached
+
+    # Going over all the stocks traded in the store
+    symbols = store.symbols()
 
     # If there is an insufficient number of local simulated trades files, alert the user:
-    if len(flag_file_dictionary) < 2:
+    if len(symbols) < 2:
         raise ValueError(
             'Error! Insufficient number of trades recorded! Please run the trade record option at least twice for DIFFERENT stocks to acquire sufficient price data to calculate the All Share Index meaningfully\n')
         return False
 
+    stats = _STATS
+    if stats is not None:
+        started = time.perf_counter_ns()
 
-    for file in flag_file_dictionary:
-        # We attempt to read the files and more specifically, the prices of the trades placed
+    # We attempt to read the prices of the trades placed, one partial per stock
+    try:
+        partials = store.log_partials(symbols, workers, use_processes)
+    except IOError as error:
+        print('Error! The program attempted to read the trade records in {} but did not manage to: {}'.format(store, error))
+        return False
+    if stats is not None:
+        started = stats.lap('gbce.partials', started)
+
+    # We calculate the geometric mean of all the prices to get the All Share Index as required
+    price_count = sum(count for _, count in partials)
+    if not price_count:
+        raise ValueError('Error! The trade records files hold no trades to calculate the All Share Index from\n')
+    log_sum = math.fsum(log_partial for log_partial, _ in partials)
+    gbce_all_share_indx = math.exp(log_sum / price_count)
+    if stats is not None:
+        stats.lap('gbce.combine', started)
+        stats.count('gbce.symbols', len(symbols))
+        stats.count('gbce.records', price_count)
+
+    gbce_all_share_indx = round(gbce_all_share_indx, 2)
+    RESULT_CACHE.put(key, signature, gbce_all_share_indx)
+    return gbce_all_share_indx
+
+def _replace_file(path, data, fsync=True):
+    # We write the new contents aside and swap them in, so the file is either the old or the new one, never a mix
+    temporary = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    with open(temporary, 'wb') as fileobj:
+        fileobj.write(data)
+        if fsync:
+            fileobj.flush()
+            os.fsync(fileobj.fileno())
+    os.replace(temporary, path)
+
+
+def _log_price(price):
+    # A price of 0 takes the geometric mean to 0, as np.log does
+    return math.log(price) if price > 0 else -math.inf
+
+
+class AllShareIndex(object):
+    """
+    This class keeps the GBCE All Share Index of a directory up to date as trades are recorded, instead of reading all
+    the trade records files again for each calculation
+
+    For each stock it holds the sum of the logarithms of the prices of all its trades, their number and the latest
+    price, together with how much of the journal it has taken in. Trades at a price of 0 are counted apart from the sum,
+    as they have no logarithm, and they take the index to 0 for as long as they are recorded. The totals over all stocks
+    are kept as well, so the index is given in constant time. The state is saved to a small checkpoint file in the directory; when it is loaded,
+    only the trades appended to the journals since (by any process) are read, and a stock whose journal was replaced
+    or whose legacy file changed is taken in afresh.
+
+    As the checkpoint holds every stock, it is not saved with every trade taken in but once SAVE_EVERY_TRADES trades
+    have been taken in or SAVE_EVERY_SECONDS seconds have gone by since it was last saved, and when the process exits.
+    """
+
+    CHECKPOINT = 'gbce_index_checkpoint.json'
+    SAVE_EVERY_TRADES = 10000
+    SAVE_EVERY_SECONDS = 5.0
+
+    def __init__(self, directory=None):
+        """
+        :param directory: The directory holding the trade records, the current working directory by default
+        """
+        self.directory = os.path.abspath(directory or os.getcwd())
+        self.checkpoint = os.path.join(self.directory, self.CHECKPOINT)
+        self._stocks = {}
+        self._log_sum = 0.0
+        self._count = 0
+        self._zeros = 0
+        self._latest_log_sum = 0.0
+        self._latest_zeros = 0
+        self._traded = 0
+        # The signature of the trade records files of the directory when the state was last brought up to date
+        self._signature = None
+        # Trades of different stocks may be taken in by different threads at the same time
+        self._lock = threading.RLock()
+        # The number of trades taken in or dropped since the checkpoint was last saved, and when that was
+        self._unsaved = 0
+        self._saved_at = time.monotonic()
+
+    def _set(self, symbol, stock):
+        # We replace the state of a stock, moving the totals along
+        previous = self._stocks.get(symbol)
+        self._unsaved += abs((stock['count'] if stock is not None else 0) - (previous['count'] if previous is not None else 0))
+        if previous is not None:
+            self._log_sum -= previous['log_sum']
+            self._count -= previous['count']
+            self._zeros -= previous['zeros']
+            if previous['count']:
+                if previous['last_price'] > 0:
+                    self._latest_log_sum -= math.log(previous['last_price'])
+                else:
+                    self._latest_zeros -= 1
+                self._traded -= 1
+        if stock is None:
+            del self._stocks[symbol]
+            return
+        self._stocks[symbol] = stock
+        self._log_sum += stock['log_sum']
+        self._count += stock['count']
+        self._zeros += stock['zeros']
+        if stock['count']:
+            if stock['last_price'] > 0:
+                self._latest_log_sum += math.log(stock['last_price'])
+            else:
+                self._latest_zeros += 1
+            self._traded += 1
+
+    def _legacy_signature(self, symbol):
+        legacy = legacy_path(symbol, self.directory)
+        if not os.path.isfile(legacy):
+            return None
+        legacy_stat = os.stat(legacy)
+        return [legacy_stat.st_mtime_ns, legacy_stat.st_size]
+
+    def _take_in(self, stock, columns):
+        # We add a run of trades given as columns to the state of a stock
+        stock = dict(stock)
+        if len(columns.price):
+            positive = columns.price[columns.price > 0]
+            stock['log_sum'] += float(np.log(positive).sum())
+            stock['count'] += len(columns.price)
+            stock['zeros'] += len(columns.price) - len(positive)
+            newest = int(columns.timestamp.max())
+            if newest >= stock['last_epoch_ns']:
+                stock['last_epoch_ns'] = newest
+                stock['last_price'] = float(columns.price[np.flatnonzero(columns.timestamp == newest)[-1]])
+        return stock
+
+    def _take_in_trades(self, stock, prices, epochs):
+        # We add trades given as lists to the state of a stock; a few trades are cheaper to take in without NumPy
+        stock = dict(stock)
+        if prices:
+            positive = [price for price in prices if price > 0]
+            stock['log_sum'] += math.fsum(map(math.log, positive))
+            stock['count'] += len(prices)
+            stock['zeros'] += len(prices) - len(positive)
+            for price, epoch_ns in zip(prices, epochs):
+                if epoch_ns >= stock['last_epoch_ns']:
+                    stock['last_epoch_ns'] = epoch_ns
+                    stock['last_price'] = float(price)
+        return stock
+
+    def refresh(self, symbol=None):
+        """
+        This method takes in the trades recorded since the state was last brought up to date, reading only those
+
+        :param symbol: The stock to bring up to date, all the stocks of the directory by default
+        :return: Nothing, the state is updated in place
+        """
+        symbols = [symbol] if symbol is not None else trade_symbols(self.directory)
+        if symbol is None:
+            # Stocks whose trade records files are gone no longer count
+            with self._lock:
+                for stock_symbol in set(self._stocks) - set(symbols):
+                    self._set(stock_symbol, None)
+        for stock_symbol in symbols:
+            # The lock of the journal is always taken before the lock of the state, as the writers do
+            with journal_lock(journal_path(stock_symbol, self.directory)):
+                with self._lock:
+                    self._refresh(stock_symbol)
+
+    def _refresh(self, symbol):
+        # Both the journal of the stock and the state are locked by the caller
+        stock = self._stocks.get(symbol)
+        journal = journal_path(symbol, self.directory)
+        legacy_signature = self._legacy_signature(symbol)
+        if os.path.isfile(journal):
+            # A stock whose journal has not changed since it was taken in is left as it is, without any reading
+            journal_stat = os.stat(journal)
+            if (stock is not None and stock['legacy'] == legacy_signature and stock['inode'] == journal_stat.st_ino
+                    and stock['offset'] == journal_stat.st_size):
+                return
+            offset, rows, inode = refresh_journal_columns(journal)[:3]
+        else:
+            offset, rows, inode = 0, 0, 0
+        if (stock is None or stock['legacy'] != legacy_signature or stock['inode'] != inode
+                or stock['rows'] > rows or stock['offset'] > offset):
+            stock = {'log_sum': 0.0, 'count': 0, 'zeros': 0, 'last_price': 0.0, 'last_epoch_ns': _NO_TRADES,
+                     'offset': 0, 'rows': 0, 'inode': inode, 'legacy': legacy_signature}
+            if legacy_signature is not None:
+                legacy_rows = _columns_from_records(read_trade_file(legacy_path(symbol, self.directory)))
+                stock = self._take_in(stock, TradeColumns(legacy_rows['timestamp'], legacy_rows['price'], None, None))
+        if stock['rows'] < rows:
+            columns = load_journal_columns(journal)[0]
+            stock = self._take_in(stock, TradeColumns(columns.timestamp[stock['rows']:rows], columns.price[stock['rows']:rows], None, None))
+        stock['offset'] = offset
+        stock['rows'] = rows
+        self._set(symbol, stock)
+
+    def add_trades(self, symbol, prices, epochs, start_offset, end_offset, save=True):
+        """
+        This method takes in trades just appended to the journal of a stock. When the journal grew between what the
+        state has taken in and these trades (another process recorded trades meanwhile), the journal is read instead.
+
+        :param symbol: The stock symbol of the trades
+        :param prices: The prices of the trades
+        :param epochs: The times of the trades in nanoseconds since the epoch
+        :param start_offset: Where the journal ended before the trades were appended
+        :param end_offset: Where the journal ends after the trades were appended
+        :param save: Whether the checkpoint is saved if it is due (see save_if_due)
+        :return: Nothing, the state is updated in place
+        """
+        with journal_lock(journal_path(symbol, self.directory)), self._lock:
+            stock = self._stocks.get(symbol)
+            if stock is None or stock['offset'] != start_offset or not os.path.isfile(journal_path(symbol, self.directory)):
+                self._refresh(symbol)
+            else:
+                stock = self._take_in_trades(stock, prices, epochs)
+                stock['offset'] = end_offset
+                stock['rows'] += len(prices)
+                stock['inode'] = os.stat(journal_path(symbol, self.directory)).st_ino
+                self._set(symbol, stock)
+        if save:
+            self.save_if_due()
+
+    def value(self, latest=False):
+        """
+        This method gives the GBCE All Share Index, the geometric mean of the prices, in constant time once the trades
+        recorded by other processes since the state was last brought up to date are taken in (which a stat of the trade
+        records files tells)
+
+        :param latest: Whether only the latest price of each stock is taken instead of the prices of all the trades
+        :return: The All Share Index rounded to 2 digits
+        """
+        # The signature is taken before the refresh, so trades recorded during the refresh are taken in next time
+        signature = _directory_signature(self.directory)
+        if signature != self._signature:
+            self.refresh()
+            self._signature = signature
+            self.save_if_due()
+        if len(self._stocks) < 2 or not self._count:
+            raise ValueError(
+                'Error! Insufficient number of trades recorded! Please run the trade record option at least twice for DIFFERENT stocks to acquire sufficient price data to calculate the All Share Index meaningfully\n')
+        if latest:
+            if self._latest_zeros:
+                return 0.0
+            return round(math.exp(self._latest_log_sum / self._traded), 2)
+        if self._zeros:
+            return 0.0
+        return round(math.exp(self._log_sum / self._count), 2)
+
+    def load(self):
+        """
+        This method restores the state from the checkpoint, if there is one, and takes in the trades recorded since
+
+        :return: Nothing, the state is updated in place
+        """
         try:
-            with open(os.path.join(os.getcwd(), file), 'r') as file:
-                timingread = json.load(file)
-        except IOError:
-            print('Error! The program attempted to read the file trade_{}.json but did not manage to.'.format(symbol))
-            return False
+            with open(self.checkpoint, 'r') as fileobj:
+                stocks = json.load(fileobj)['stocks']
+        except (IOError, ValueError, KeyError):
+            stocks = {}
+        for symbol in stocks:
+            # A stock saved before trades at a price of 0 were counted apart is taken in afresh
+            if 'zeros' in stocks[symbol]:
+                self._set(symbol, stocks[symbol])
+        signature = _directory_signature(self.directory)
+        self.refresh()
+        self._signature = signature
+        self.save()
+
+    def save(self):
+        """
+        This method writes the state to the checkpoint file. It is not synced to disk: a checkpoint lost in a crash
+        only means the trade records files are read again when the state is loaded.
+        """
+        with self._lock:
+            data = json.dumps({'stocks': self._stocks}, separators=(',', ':')).encode('utf-8')
+            self._unsaved = 0
+            self._saved_at = time.monotonic()
+        _replace_file(self.checkpoint, data, fsync=False)
+
+    def save_if_due(self):
+        """
+        This method saves the checkpoint once SAVE_EVERY_TRADES trades have been taken in, or once trades have been
+        taken in and SAVE_EVERY_SECONDS seconds have gone by, since it was last saved
+        """
+        if self._unsaved and (self._unsaved >= self.SAVE_EVERY_TRADES
+                              or time.monotonic() - self._saved_at >= self.SAVE_EVERY_SECONDS):
+            self.save()
+
+
+# The running All Share Index of each directory used in this process
+_ALL_SHARE_INDEXES = {}
+_ALL_SHARE_INDEXES_GUARD = threading.Lock()
+
+
+def all_share_index(directory=None):
+    """
+    This function gives the running All Share Index of a directory, loading it from its checkpoint the first time
 
-    pricesinthisfile = [individual['Price'] for individual in timingread]
-    price_collection.append(pricesinthisfile)
+    :param directory: The directory holding the trade records, the current working directory by default
+    :return: The AllShareIndex of the directory
+    """
+    key = os.path.abspath(directory or os.getcwd())
+    with _ALL_SHARE_INDEXES_GUARD:
+        index = _ALL_SHARE_INDEXES.get(key)
+        if index is None:
+            index = AllShareIndex(key)
+            index.load()
+            _ALL_SHARE_INDEXES[key] = index
+    return index
+
+
+def _save_all_share_indexes():
+    # The running All Share Indexes of the process are saved with the trades taken in since their last checkpoint, when
+    # the process exits or the server stops; a directory which is gone by then has nothing to save
+    with _ALL_SHARE_INDEXES_GUARD:
+        indexes = list(_ALL_SHARE_INDEXES.values())
+    for index in indexes:
+        if index._unsaved:
+            try:
+                index.save()
+            except IOError:
+                pass
+
+
+atexit.register(_save_all_share_indexes)
+
+
+def _trade_row(trade):
+    # The time, price, quantity and indicator of a trade given as a Trade or as a trade record
+    if isinstance(trade, Trade):
+        return trade.epoch_ns, trade.price, trade.quantity, trade.indicator
+    return trade_epoch_ns(trade), trade['Price'], trade['Quantity'], trade['Indicator']
+
+
+# The trades of a stock are imported into a trade store this many at a time
+_IMPORT_CHUNK_ROWS = 100000
+
+
+def _stamp_trades(trades):
+    # Trades which came without a time are stamped now, which the stores do while they hold the lock of the stock, and
+    # the trades are put in time order
+    now_ns = time.time_ns()
+    timestamp = None
+    for trade in trades:
+        if isinstance(trade, Trade):
+            if trade.epoch_ns is None:
+                trade.epoch_ns = now_ns
+        elif trade.get('Epoch_ns') is None and not trade.get('Timestamp'):
+            timestamp = timestamp or epoch_ns_to_timestamp(now_ns)
+            trade['Epoch_ns'] = now_ns
+            trade['Timestamp'] = timestamp
+    trades.sort(key=lambda trade: _trade_row(trade)[0])
+
+
+class TradeStore(object):
+    """
+    This class is the interface of the storage backends of the trade history. trade_record(), record_trades(),
+    volume_weighted_stock_price() and gbce_all_share_index() validate the trades, cache the results and report errors;
+    the store they are given writes the trades and answers the window and index queries.
 
-    # We calculate the geometric mean of all the prices to get the All Share Index as required
-    single_list = [item for sub in price_collection for item in sub]
-    log_domain = np.log(single_list)
-    gbce_all_share_indx = np.exp(log_domain.sum()/len(log_domain))
+    JsonTradeStore keeps the trade_<SYMBOL>.jsonl journals of a directory, SQLiteTradeStore an embedded SQLite database.
+    """
+
+    def write_trades(self, grouped, fsync=False):
+        """
+        :param grouped: A dictionary of the stock symbols and lists of their validated trades, as Trade objects or
+                        dictionaries in the format of the trade records; the trades without a time (an Epoch_ns of
+                        None) are stamped with the time they are written at, and each stock's trades are written in
+                        time order
+        :param fsync: Whether the trades are synced to disk before returning
+        :return: A dictionary of the stock symbols and the number of trades written for each
+        """
+        raise NotImplementedError
+
+    def window_totals(self, symbol, after_ns):
+        """
+        :param symbol: The stock symbol the user is interested in investigating
+        :param after_ns: The start of the window, in nanoseconds since the epoch; only later trades are in it
+        :return: A tuple (sum of the prices times the quantities, sum of the quantities, time of the oldest trade) of
+                 the trades of the stock in the window, None when there are none
+        """
+        raise NotImplementedError
+
+    def log_partials(self, symbols, workers=None, use_processes=False):
+        """
+        :param symbols: The stock symbols the All Share Index is taken over
+        :param workers: The number of stocks read at the same time, for the stores which read them one by one
+        :param use_processes: Whether those stocks are read by a pool of processes instead of a pool of threads
+        :return: A list of the tuples (sum of the logarithms of the prices, number of prices), one per stock given
+        """
+        raise NotImplementedError
+
+    def symbols(self):
+        """
+        :return: The sorted list of the stock symbols which have trades in the store
+        """
+        raise NotImplementedError
+
+    def trade_count(self, symbol):
+        """
+        :param symbol: The stock symbol the user is interested in investigating
+        :return: The number of trades of the stock in the store
+        """
+        raise NotImplementedError
+
+    def iter_trades(self, symbol, after_ns=None):
+        """
+        :param symbol: The stock symbol the user is interested in investigating
+        :param after_ns: If given, only the trades which happened strictly after this time are returned
+        :return: A generator of the trades of the stock as dictionaries in the format of the trade records
+        """
+        raise NotImplementedError
+
+    def location(self, symbol=None):
+        """
+        :param symbol: A stock symbol, or None for the whole store
+        :return: What identifies the trades of the stock (or of the store) across the instances of the store, the key
+                 of their results in RESULT_CACHE
+        """
+        raise NotImplementedError
+
+    def signature(self, symbol=None):
+        """
+        :param symbol: A stock symbol, or None for the whole store
+        :return: A value which changes whenever trades of the stock (or of the store) are written, by any process
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def import_trade_files(self, directory=None):
+        """
+        This method imports the trades of the journals and legacy trade_<SYMBOL>.json files of a directory, a chunk of
+        trades at a time. With every chunk the store records how many trades of the stock it has imported from the
+        directory, so an import which was interrupted carries on where it stopped, an import is not taken in twice, and
+        the trades recorded in the store otherwise do not count as imported.
+
+        :param directory: The directory holding the trade records, the current working directory by default
+        :return: A dictionary of the stock symbols imported and the number of trades taken in for each
+        """
+        source = os.path.abspath(directory or os.getcwd())
+        imported = {}
+        for symbol in trade_symbols(directory):
+            rows = self._imported_rows(symbol, source)
+            records = itertools.islice(iter_trades(symbol, directory), rows, None)
+            while True:
+                chunk = list(itertools.islice(records, _IMPORT_CHUNK_ROWS))
+                if not chunk:
+                    break
+                rows += len(chunk)
+                self._write_import(symbol, source, chunk, rows)
+                imported[symbol] = imported.get(symbol, 0) + len(chunk)
+        return imported
+
+    def _imported_rows(self, symbol, source):
+        # The number of trades of the stock imported so far from the trade records files of the source directory
+        raise NotImplementedError
+
+    def _write_import(self, symbol, source, trades, rows):
+        # The trades of the stock imported from the source directory are written, and its first rows trades recorded as
+        # imported
+        raise NotImplementedError
+
+
+class JsonTradeStore(TradeStore):
+    """
+    This class stores the trades in the append-only journals of a directory, trade_<SYMBOL>.jsonl, one per stock, with
+    their column files, and keeps the running All Share Index of the directory up to date as trades are written.
+    Legacy trade_<SYMBOL>.json files are read as well.
+    """
+
+    def __init__(self, directory=None):
+        """
+        :param directory: The directory holding the trade records, the current working directory by default
+        """
+        self.directory = directory
+
+    def __str__(self):
+        return self.directory or os.getcwd()
+
+    def write_trades(self, grouped, fsync=False):
+        stats = _STATS
+        written = {}
+        # The running All Share Index is loaded before the appends, so it then takes in just these trades
+        index = all_share_index(self.directory)
+        for symbol in grouped:
+            path = journal_path(symbol, self.directory)
+            trades = grouped[symbol]
+            # The lock of the stock is held until the running All Share Index has taken the trades in as well
+            with journal_lock(path):
+                _stamp_trades(trades)
+                if stats is not None:
+                    started = time.perf_counter_ns()
+                with TradeJournal(path, fsync_every=len(trades) if fsync else 0) as journal:
+                    journal.extend(trades)
+                if stats is not None:
+                    started = stats.lap('journal.append', started)
+                    stats.count('journal.bytes_written', journal.offset - journal.start_offset)
+                rows = [_trade_row(trade) for trade in trades]
+                index.add_trades(symbol, [row[1] for row in rows], [row[0] for row in rows], journal.start_offset,
+                                 journal.offset, save=False)
+                if stats is not None:
+                    stats.lap('journal.all_share_index', started)
+            written[symbol] = len(trades)
+        # The checkpoint of the running All Share Index is saved once enough trades or time have gone by
+        index.save_if_due()
+        return written
+
+    def window_totals(self, symbol, after_ns):
+        stats = _STATS
+        if stats is not None:
+            started = time.perf_counter_ns()
+        # We take the trades as columns; in the rows in time order the window is found by binary search, so only its end
+        # of the memory mapped columns is read, and the rows before them are only masked when they can hold trades of
+        # the window. With a legacy file the whole time column is masked.
+        legacy = legacy_path(symbol, self.directory)
+        journal = journal_path(symbol, self.directory)
+        if os.path.isfile(journal) and not os.path.isfile(legacy):
+            _, rows, _, _, sorted_from, prefix_newest = refresh_journal_columns(journal)
+            columns = _mapped_columns(journal, rows)
+        else:
+            columns, sorted_from = load_trade_columns(symbol, self.directory), None
+        if stats is not None:
+            started = stats.lap('vwsp.load_columns', started)
+        if sorted_from is not None:
+            first = sorted_from + np.searchsorted(columns.timestamp[sorted_from:], after_ns, side='right')
+            if prefix_newest > after_ns:
+                window = np.concatenate([np.flatnonzero(columns.timestamp[:sorted_from] > after_ns), np.arange(first, rows)])
+            else:
+                window = slice(first, None)
+            timestamps = columns.timestamp[window]
+            prices = columns.price[window]
+            quantities = columns.quantity[window]
+        else:
+            in_window = columns.timestamp > after_ns
+            timestamps = columns.timestamp[in_window]
+            prices = columns.price[in_window]
+            quantities = columns.quantity[in_window]
+        if stats is not None:
+            started = stats.lap('vwsp.window', started)
+            stats.count('vwsp.records', len(columns.timestamp))
+            stats.count('vwsp.records_in_window', len(quantities))
+        if not len(quantities):
+            return None
+        traded_volume = float(np.dot(prices, quantities.astype(np.float64)))
+        quantity = int(quantities.sum())
+        if stats is not None:
+            stats.lap('vwsp.arithmetic', started)
+        return traded_volume, quantity, int(timestamps.min())
+
+    def log_partials(self, symbols, workers=None, use_processes=False):
+        # The files of the different stocks are read concurrently, each streamed in chunks
+        directories = [self.directory] * len(symbols)
+        if workers == 1:
+            return list(map(symbol_log_partial, symbols, directories))
+        import concurrent.futures
+        pool = concurrent.futures.ProcessPoolExecutor if use_processes else concurrent.futures.ThreadPoolExecutor
+        with pool(max_workers=workers or os.cpu_count()) as executor:
+            return list(executor.map(symbol_log_partial, symbols, directories))
+
+    def symbols(self):
+        return trade_symbols(self.directory)
+
+    def trade_count(self, symbol):
+        legacy = legacy_path(symbol, self.directory)
+        journal = journal_path(symbol, self.directory)
+        count = sum(1 for _ in read_trade_file(legacy)) if os.path.isfile(legacy) else 0
+        if os.path.isfile(journal):
+            count += refresh_journal_columns(journal)[1]
+        return count
+
+    def iter_trades(self, symbol, after_ns=None):
+        return iter_trades(symbol, self.directory, after_ns)
+
+    def location(self, symbol=None):
+        if symbol is None:
+            return os.path.abspath(str(self))
+        return os.path.abspath(journal_path(symbol, self.directory))
+
+    def signature(self, symbol=None):
+        # A journal only grows, so its size changes with every trade, and a replaced file has another inode
+        if symbol is None:
+            return _directory_signature(self.directory)
+        legacy = legacy_path(symbol, self.directory)
+        return _file_signature(journal_path(symbol, self.directory)), _file_signature(legacy)
+
+    def _imported_rows(self, symbol, source):
+        if source == self.location():
+            # The trade records files of the directory of the store are all in the store already
+            return self.trade_count(symbol)
+        try:
+            with open(journal_path(symbol, self.directory) + '.imports', 'r') as fileobj:
+                return json.load(fileobj).get(source, 0)
+        except (IOError, ValueError):
+            return 0
+
+    def _write_import(self, symbol, source, trades, rows):
+        # The progress of the imports of a stock is kept next to its journal, {source directory: rows}, and written
+        # while the lock of the stock is still held after the trades are appended; only if the process dies in between
+        # is the chunk taken in again
+        path = journal_path(symbol, self.directory)
+        with journal_lock(path):
+            progress = {}
+            if os.path.isfile(path + '.imports'):
+                with open(path + '.imports', 'r') as fileobj:
+                    progress = json.load(fileobj)
+            self.write_trades({symbol: trades})
+            progress[source] = rows
+            _replace_file(path + '.imports', json.dumps(progress).encode('utf-8'))
+
+
+# The statements creating the schema of a SQLite trade store
+_SQLITE_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS trades (symbol TEXT NOT NULL, seq INTEGER NOT NULL, epoch_ns INTEGER NOT NULL, '
+    'quantity INTEGER NOT NULL, indicator TEXT NOT NULL, price REAL NOT NULL, PRIMARY KEY (symbol, seq)) WITHOUT ROWID',
+    # The window of a stock is a range of this index, which holds all the columns the window query needs
+    'CREATE INDEX IF NOT EXISTS trades_symbol_time ON trades (symbol, epoch_ns, price, quantity)',
+    # The number of trades of each stock and the sum of the logarithms of their prices, kept with every write
+    'CREATE TABLE IF NOT EXISTS stocks (symbol TEXT PRIMARY KEY, trades INTEGER NOT NULL, log_sum REAL NOT NULL)',
+    # The number of trades of each stock imported from the trade records files of each directory
+    'CREATE TABLE IF NOT EXISTS imports (symbol TEXT NOT NULL, source TEXT NOT NULL, rows INTEGER NOT NULL, '
+    'PRIMARY KEY (symbol, source)) WITHOUT ROWID',
+)
+
+class SQLiteTradeStore(TradeStore):
+    """
+    This class stores the trades of all the stocks in one SQLite database, in write-ahead log (WAL) mode so readers
+    never wait for a writer. The trades written together are inserted in one transaction with executemany; each stock
+    gets the next sequence numbers of its trades as in the journals. A (symbol, epoch_ns) index answers the window of
+    the Volume Weighted Stock Price with one range query, and the number of trades and the sum of the logarithms of
+    the prices of each stock are updated in the same transaction, so the All Share Index is one query over the stocks.
+
+    Writers of different processes take turns on the database; they wait up to the timeout given for each other.
+    The connection is shared by the threads of the process.
+    """
 
+    def __init__(self, path='gbce_trades.db', timeout=30.0):
+        """
+        :param path: The path to the database file, created if it does not exist
+        :param timeout: The number of seconds a writer waits for the writer of another process
+        """
+        import sqlite3
+        self.path = path
+        self._lock = threading.RLock()
+        # Transactions are begun explicitly, so the autocommit mode of the module is used
+        self._connection = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        # In WAL mode a commit is durable once the log is synced at a checkpoint, and never corrupts the database
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        for statement in _SQLITE_SCHEMA:
+            self._connection.execute(statement)
+
+    def __str__(self):
+        return self.path
+
+    def write_trades(self, grouped, fsync=False):
+        return self._write_trades(grouped, fsync)
+
+    def _write_trades(self, grouped, fsync, imported=None):
+        # imported, a tuple (symbol, source directory, rows), is the progress of an import recorded with the trades
+        stats = _STATS
+        if stats is not None:
+            started = time.perf_counter_ns()
+        written = {}
+        with self._lock:
+            cursor = self._connection.cursor()
+            if fsync:
+                cursor.execute('PRAGMA synchronous=FULL')
+            # The write lock of the database is taken before the sequence numbers are read
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                for symbol in grouped:
+                    _stamp_trades(grouped[symbol])
+                    rows = [_trade_row(trade) for trade in grouped[symbol]]
+                    last_seq = self.trade_count(symbol)
+                    cursor.executemany(
+                        'INSERT INTO trades (symbol, seq, epoch_ns, quantity, indicator, price) VALUES (?, ?, ?, ?, ?, ?)',
+                        [(symbol, last_seq + position, epoch_ns, int(quantity), indicator, float(price))
+                         for position, (epoch_ns, price, quantity, indicator) in enumerate(rows, 1)])
+                    log_sum = math.fsum(_log_price(row[1]) for row in rows)
+                    cursor.execute('INSERT INTO stocks (symbol, trades, log_sum) VALUES (?, ?, ?) ON CONFLICT (symbol) '
+                                   'DO UPDATE SET trades = trades + excluded.trades, log_sum = log_sum + excluded.log_sum',
+                                   (symbol, len(rows), log_sum))
+                    written[symbol] = len(rows)
+                if imported is not None:
+                    cursor.execute('INSERT INTO imports (symbol, source, rows) VALUES (?, ?, ?) ON CONFLICT (symbol, source) '
+                                   'DO UPDATE SET rows = excluded.rows', imported)
+                cursor.execute('COMMIT')
+            except BaseException:
+                cursor.execute('ROLLBACK')
+                raise
+            finally:
+                # The next writes are synced at the checkpoints again
+                if fsync:
+                    cursor.execute('PRAGMA synchronous=NORMAL')
+        if stats is not None:
+            stats.lap('sqlite.insert', started)
+            stats.count('sqlite.rows_written', sum(written.values()))
+        return written
+
+    def window_totals(self, symbol, after_ns):
+        stats = _STATS
+        if stats is not None:
+            started = time.perf_counter_ns()
+        with self._lock:
+            traded_volume, quantity, oldest_ns, count = self._connection.execute(
+                'SELECT SUM(price * quantity), SUM(quantity), MIN(epoch_ns), COUNT(*) FROM trades '
+                'WHERE symbol = ? AND epoch_ns > ?', (symbol, after_ns)).fetchone()
+        if stats is not None:
+            stats.lap('vwsp.query', started)
+            stats.count('vwsp.records_in_window', count)
+        if not count:
+            return None
+        return traded_volume, quantity, oldest_ns
+
+    def log_partials(self, symbols, workers=None, use_processes=False):
+        with self._lock:
+            partials = dict((symbol, (log_sum, trades)) for symbol, trades, log_sum in
+                            self._connection.execute('SELECT symbol, trades, log_sum FROM stocks'))
+        return [partials.get(symbol, (0.0, 0)) for symbol in symbols]
+
+    def symbols(self):
+        with self._lock:
+            return [row[0] for row in self._connection.execute('SELECT symbol FROM stocks WHERE trades > 0 ORDER BY symbol')]
+
+    def trade_count(self, symbol):
+        with self._lock:
+            known = self._connection.execute('SELECT trades FROM stocks WHERE symbol = ?', (symbol,)).fetchone()
+        return known[0] if known else 0
+
+    def _imported_rows(self, symbol, source):
+        with self._lock:
+            known = self._connection.execute('SELECT rows FROM imports WHERE symbol = ? AND source = ?',
+                                             (symbol, source)).fetchone()
+        return known[0] if known else 0
+
+    def _write_import(self, symbol, source, trades, rows):
+        # The progress of the import is recorded in the transaction of its trades, so they are taken in exactly once
+        self._write_trades({symbol: trades}, False, (symbol, source, rows))
+
+    def iter_trades(self, symbol, after_ns=None):
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT seq, epoch_ns, quantity, indicator, price FROM trades WHERE symbol = ? AND epoch_ns > ? '
+                'ORDER BY seq', (symbol, _NO_TRADES if after_ns is None else after_ns)).fetchall()
+        for seq, epoch_ns, quantity, indicator, price in rows:
+            yield Trade(symbol, quantity, indicator, price, epoch_ns, seq).to_record()
+
+    def location(self, symbol=None):
+        return os.path.abspath(self.path), symbol
+
+    def signature(self, symbol=None):
+        # The trades are only ever added, so the number of trades changes with every write, whoever makes it
+        with self._lock:
+            if symbol is None:
+                return self._connection.execute('SELECT COUNT(*), SUM(trades) FROM stocks').fetchone()
+            return self._connection.execute('SELECT trades FROM stocks WHERE symbol = ?', (symbol,)).fetchone()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+# The store of the trades when none is given to the functions recording and querying them; None for the journals of
+# the directory given (see use_trade_store)
+TRADE_STORE = None
+
+_SQLITE_STORES = {}
+_SQLITE_STORES_GUARD = threading.Lock()
+
+
+def _trade_store(store, directory=None):
+    # The store given, or else the store of the engine, or else the journals of the directory
+    if store is not None:
+        return store
+    if TRADE_STORE is not None:
+        return TRADE_STORE
+    return JsonTradeStore(directory)
+
+
+def sqlite_trade_store(path):
+    """
+    This function gives the SQLite trade store of a database, opened once per process
 
-    return round(gbce_all_share_indx,2)
+    :param path: The path to the database file, created if it does not exist
+    :return: The SQLiteTradeStore of the database
+    """
+    key = os.path.abspath(path)
+    with _SQLITE_STORES_GUARD:
+        store = _SQLITE_STORES.get(key)
+        if store is None:
+            store = _SQLITE_STORES[key] = SQLiteTradeStore(path)
+    return store
 
-def main():
+
+def use_trade_store(store):
     """
-    Command Line Interface menu - argument parsing function
+    This function makes a store the one trade_record(), record_trades(), volume_weighted_stock_price() and
+    gbce_all_share_index() use when they are not given one; the directories they are given are then not read
 
-    :return: Nothing, this is a distribution of arguments type of function
+    :param store: A TradeStore, or None to go back to the journals of the directories given
+    :return: The store used until then
+    """
+    global TRADE_STORE
+    previous, TRADE_STORE = TRADE_STORE, store
+    return previous
+
+
+# The commands the engine server does not run for its clients (by the names of their handlers), as they need the standard
+# input of the client, would start another server, write or remove files at paths of the client's choosing, or run long
+# enough to hold up all the other clients, whose requests are answered one at a time
+_SERVER_REFUSED = ('_cli_vwsp_stream', '_cli_serve', '_cli_client', '_cli_price_file', '_cli_migrate', '_cli_trade_batch',
+                   '_cli_simulate')
+# The commands whose value is a directory, which the server only reads (and writes the caches of) under its working directory
+_SERVER_DIRECTORIES = ('_cli_all_share_index', '_cli_all_share_index_live')
+
+
+def _server_refusal(arguments):
+    # Why the engine server does not run a parsed command line for a client, None when it runs it
+    for flags, value_names, fewest, most, handler, help_text in _COMMANDS:
+        values = getattr(arguments, handler.__name__)
+        if values is None or values[:1] == ['h']:
+            continue
+        if handler.__name__ in _SERVER_REFUSED or '-' in values:
+            return '{} cannot be run through the engine server'.format(flags[0])
+        if handler.__name__ in _SERVER_DIRECTORIES and values:
+            working_directory = os.path.realpath(os.getcwd())
+            if os.path.commonpath([working_directory, os.path.realpath(values[0])]) != working_directory:
+                return 'the engine server only reads the directories under its working directory'
+    if arguments.stats:
+        return 'the engine server does not save profiles, --stats is only given without a file'
+    if arguments.store is not None:
+        return 'the trade store of the engine server is chosen when the server is started'
+    return None
+
+
+def _parse_address(address):
+    # host:port is a TCP address, anything else the path of a Unix socket
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit():
+        return 'tcp', (host, int(port))
+    return 'unix', address
+
+
+def serve_request(request):
+    """
+    This function runs one command line for a client of the engine server, in this process, so the stock registry, the
+    column files of the journals and the running All Share Indexes stay loaded from one request to the next
+
+    :param request: A dictionary with the command line as a list under argv, without the program name
+    :return: A dictionary with the status (0 for success) and the output of the command
+    """
+    argv = [str(argument) for argument in request.get('argv', [])]
+    import contextlib
+    import io
+    output = io.StringIO()
+    status = 0
+    # The usage errors of argparse are written to the standard error, which goes back to the client too
+    with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+        try:
+            refusal = _server_refusal(_cli_parser().parse_args(argv)) if argv else None
+            if refusal is None:
+                main(['engine.py'] + argv)
+            else:
+                print('Error! {}'.format(refusal))
+                status = 1
+        except SystemExit as error:
+            # The help messages leave through sys.exit
+            if isinstance(error.code, str):
+                print(error.code)
+            elif error.code:
+                status = 1
+        except Exception as error:
+            print('Error! {}'.format(error))
+            status = 1
+    return {'status': status, 'output': output.getvalue()}
+
+
+async def _serve_connection(reader, writer):
+    # A client sends one json request per line and gets one json response per line back, for as long as it stays connected
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                response = serve_request(json.loads(line))
+            except ValueError:
+                response = {'status': 1, 'output': 'Error! The request is not valid json\n'}
+            writer.write((json.dumps(response) + '\n').encode('utf-8'))
+            await writer.drain()
+    finally:
+        writer.close()
+
+
+async def _serve(address):
+    import asyncio
+    import signal
+    kind, where = _parse_address(address)
+    if kind == 'tcp':
+        server = await asyncio.start_server(_serve_connection, where[0], where[1])
+    else:
+        # A socket left behind by a server which did not shut down cleanly is replaced
+        if os.path.exists(where):
+            os.remove(where)
+        server = await asyncio.start_unix_server(_serve_connection, where)
+    print('Engine server listening on {}'.format(address), flush=True)
+    # The server stops cleanly when it is terminated
+    stopped = asyncio.get_running_loop().create_future()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopped.set_result, None)
+    async with server:
+        await stopped
+
+
+def serve(address='engine.sock'):
+    """
+    This function runs the engine server: a long running process which answers the command lines of its clients
+    (see client_request) without paying the start of the interpreter, the import of NumPy and the loading of the
+    reference data for each of them. The requests are handled one at a time by an asyncio event loop, which holds many
+    client connections open at once without a process per request.
+
+    :param address: host:port to listen on TCP, or the path of a Unix socket
+    :return: Nothing, it runs until interrupted
+    """
+    import asyncio
+    try:
+        asyncio.run(_serve(address))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        _save_all_share_indexes()
+        if _parse_address(address)[0] == 'unix' and os.path.exists(address):
+            os.remove(address)
+
+
+def client_request(address, argv, timeout=None):
     """
+    This function sends a command line to the engine server and waits for its response
 
-    if len(sys.argv[0:])<2:
-        sys.exit("""
+    :param address: The address the server listens on, host:port or the path of a Unix socket
+    :param argv: The command line as a list, without the program name, as in ['--d', 'POP', '149']
+    :param timeout: The number of seconds to wait for the server, forever by default
+    :return: A dictionary with the status (0 for success) and the output of the command
+    """
+    import socket
+    kind, where = _parse_address(address)
+    if kind == 'tcp':
+        connection = socket.create_connection(where, timeout)
+    else:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.settimeout(timeout)
+        connection.connect(where)
+    with connection:
+        connection.sendall((json.dumps({'argv': list(argv)}) + '\n').encode('utf-8'))
+        response = connection.makefile('rb').readline()
+    if not response:
+        raise IOError('The engine server at {} closed the connection without answering'.format(address))
+    return json.loads(response)
+
+
+_USAGE = """
         Super Simple Stock Market Engine v1.0
 
         The code supports the following functionality:
@@ -372,7 +3095,7 @@ def main():
 
         4. Volume Weighted Stock Price:
 
-        The volume weighted stock price creates a file (if the stock symbol has not already been used to produce a trade record) and the user receives a figure for the volume weighted stock price when the user passes the stock symbol desired.
+        The volume weighted stock price is calculated from the trades of the stock recorded in the last 15 minutes when the user passes the stock symbol desired. Nothing is written; use the trade record options or the simulation (--sim) to record trades first.
 
         Example:
         `python3 engine.py --vwsp TEA` or `python3 engine.py --volume-weighted-stock-price TEA`
@@ -382,61 +3105,324 @@ def main():
         Example:
         `python3 engine.py --asi <path_to_script_directory>` or `python3 engine.py --all-share-index <path_to_script_directory>`
 
+        6. Trade Journal Migration:
+
+        Trades are recorded in append-only journals named trade_<SYMBOL>.jsonl, one trade per line, stamped with the time in nanoseconds and a sequence number per stock. The legacy trade_<SYMBOL>.json files of a directory are converted to journals once with:
+
+        Example:
+        `python3 engine.py --migrate <path_to_script_directory>`
+
+        7. Batch Trade Recording:
+
+        Many trades are recorded at once from a CSV or JSONL file (or from the standard input with -). The whole batch is validated first and the journal of each stock is written once.
+
+        Example:
+        `python3 engine.py --tr-batch trades.csv` or `cat trades.jsonl | python3 engine.py --tr-batch -`
+
+        8. Streaming Volume Weighted Stock Price:
+
+        Trades are read from the standard input (CSV or JSONL as for --tr-batch) and the updated Volume Weighted Stock Price of the stock traded is written out as a json line after each trade. The window is 15 minutes unless another length in minutes is given.
+
+        Example:
+        `tail -f feed.jsonl | python3 engine.py --vwsp-stream` or `python3 engine.py --vwsp-stream 5 < trades.csv`
+
+        9. Trade Simulation:
+
+        Random trades are generated for the comma separated stock symbols given and recorded in their journals, ending now. The number of trades and optionally a seed are passed.
+
+        Example:
+        `python3 engine.py --sim TEA,POP,ALE 1000000 42`
+
+        10. Running All Share Index:
+
+        The All Share Index is kept up to date as trades are recorded and saved in the checkpoint gbce_index_checkpoint.json of the directory, so it is given without reading all the trade records files again. With latest, only the latest price of each stock is taken.
+
+        Example:
+        `python3 engine.py --asi-live <path_to_script_directory>` or `python3 engine.py --asi-live <path_to_script_directory> latest`
+
+        11. Bulk Pricing:
+
+        The dividend yield and the P/E ratio are calculated for every line of a CSV file of stock symbols and prices and written as CSV (to the standard output unless an output file is given). Zero divisions give nan.
+
+        Example:
+        `python3 engine.py --price-file prices.csv results.csv`
+
+        12. Engine Server:
+
+        A long running server keeps the reference data, the trade columns and the running All Share Index loaded and answers the command lines of its clients, on a Unix socket (engine.sock by default) or a TCP host:port. The client forwards the flags after the address to it.
+
+        Example:
+        `python3 engine.py --serve engine.sock` and then `python3 engine.py --client engine.sock --d POP 149`
+
+        13. Fast Startup:
+
+        NumPy and the other heavy modules are only imported by the commands needing them. Running the engine as a module loads its cached bytecode instead of compiling it. The start of every command is measured by the startup benchmark.
+
+        Example:
+        `python3 -m engine --d POP 149` or `python3 bench_engine.py startup`
+
+        14. Benchmarks:
+
+        The entry points of the engine are measured on generated histories of trades and compared with a baseline by the benchmark suite.
+
+        Example:
+        `python3 bench_engine.py engine --trades 1000,100000 --symbols 5,500 --baseline baseline.json`
+
+        15. Statistics and Profiling:
+
+        With --stats, the time spent in each stage of the command (reading the journals, parsing the records, finding the window, the arithmetic) and counters of the work done (bytes read, records parsed, records in the window, cache hits and misses) are written as json to the standard error. With a file, the command is profiled with cProfile and the profile is saved there.
+
+        Example:
+        `python3 engine.py --vwsp TEA --stats` or `python3 engine.py --vwsp TEA --stats vwsp.prof`
+
+        16. Bars:
+
+        The open, high, low, close, volume, volume weighted average price and buy/sell imbalance bars of the stocks are written as CSV at a resolution of 1s, 1m, 5m, 15m or 1h, over the last 24 hours unless another number of hours is given. All the resolutions are built in one pass over the trades recorded since the last query, and the finished bars are cached on disk next to the journals.
+
+        Example:
+        `python3 engine.py --bars 1m` or `python3 engine.py --bars 5m TEA,POP 8`
+
+        17. Trade Stores:
+
+        With --store, the trades are recorded in and read from a SQLite database (in WAL mode, indexed by stock and time) instead of the trade_<SYMBOL>.jsonl journals; the window of the Volume Weighted Stock Price and the All Share Index are then answered by SQL queries. With --migrate, the journals and legacy files of the directory are imported into the database.
+
+        Example:
+        `python3 engine.py --migrate <path_to_script_directory> --store trades.db` or `python3 engine.py --vwsp TEA --store trades.db`
+
         To run tests:
         `python3 test_engine.py`
 
-        """)
+        """
 
-    if sys.argv[1] == '--d' or sys.argv[1] == '--dividend-yield':
-        if sys.argv[2] == 'h':
-            sys.exit('Help: The dividend yield is calculated when the user passes the stock symbol and price desired. Example: python3 engine.py --d POP 149 ')
-        dividend = calculate_dividend_yield(sys.argv[2], sys.argv[3])
-        if not dividend:
-            print('Error! \n')
-        else:
-            print('The dividend yield is {}%'.format(dividend))
 
+def _cli_dividend_yield(values):
+    dividend = calculate_dividend_yield(values[0], values[1])
+    if not dividend:
+        print('Error! \n')
+    else:
+        print('The dividend yield is {}%'.format(dividend))
 
-    if sys.argv[1] == '--pe' or sys.argv[1] == '--p-to-e-ratio':
-        if sys.argv[2] == 'h':
-            sys.exit('Help: The P/E ratio is calculated when the user passes the stock symbol and price desired. Example: python3 engine.py --pe POP 140 or --p-to-e-ratio POP 140 ')
-        p_e_ratio_figure = p_to_e_ratio(sys.argv[2], sys.argv[3])
-        if not p_e_ratio_figure:
-            print('Error! \n')
-        else:
-            print('The P/E ratio is {}'.format(p_e_ratio_figure))
 
+def _cli_p_to_e_ratio(values):
+    p_e_ratio_figure = p_to_e_ratio(values[0], values[1])
+    if not p_e_ratio_figure:
+        print('Error! \n')
+    else:
+        print('The P/E ratio is {}'.format(p_e_ratio_figure))
 
-    if sys.argv[1] == '--tr' or sys.argv[1] == '--trade-record':
-        if sys.argv[2] == 'h':
-            sys.exit('Help: The trade record is created as a file and the user receives what information has been recorded when the user passes the stock, quantity of shares, indicator (BUY or SELL) and price. Example: python3 engine.py --tr JOE, 12, SELL, 22.8 or --trade-record JOE 12 SELL 22.8')
-        trade_recorded = trade_record(sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5])
-        if not trade_recorded:
-            print('Error! \n')
-        else:
-            print('Trade recorded:  {}'.format(trade_recorded))
 
+def _cli_trade_record(values):
+    trade_recorded = trade_record(values[0], values[1], values[2], values[3])
+    if not trade_recorded:
+        print('Error! \n')
+    else:
+        print('Trade recorded:  {}'.format(trade_recorded))
 
 
-    if sys.argv[1] == '--vwsp' or sys.argv[1] == '--volume-weighted-stock-price':
-        if sys.argv[2] == 'h':
-            sys.exit('Help: The volume weighted stock price creates a file (if the stock symbol has not already been used to produce a trade record) and the user receives a figure for the volume weighted stock price when the user passes the stock symbol desired. Example: python3 engine.py --vwsp TEA or --volume-weighted-stock-price TEA')
+def _cli_volume_weighted_stock_price(values):
+    vwsp = volume_weighted_stock_price(values[0])
+    if not vwsp:
+        print('Error! \n')
+    else:
+        print('Volume Weighted Stock price: {}'.format(vwsp))
 
-        vwsp = volume_weighted_stock_price(sys.argv[2])
-        if not vwsp:
-            print('Error! \n')
-        else:
-            print('Volume Weighted Stock price: {}'.format(vwsp))
 
-    if sys.argv[1] == '--asi' or sys.argv[1] == '--all-share-index':
-        if sys.argv[2] == 'h':
-            sys.exit('The Global Beverage Commerce Exchange All Share Inex will be automatically calculated, provided the user has recorded trades for MORE THAN 2 stock indices. No input from the user is required otherwise. Example: python3 engine.py --asi <path_to_script_directory> or python3 engine.py --all-share-index <path_to_script_directory>')
+def _cli_all_share_index(values):
+    gbce_asi = gbce_all_share_index(values[0])
+    if not gbce_asi:
+        print('Error! \n')
+    else:
+        print('GBCE All Share Index: {}'.format(gbce_asi))
 
-        gbce_asi = gbce_all_share_index(sys.argv[2])
-        if not gbce_asi:
-            print('Error! \n')
-        else:
-            print('GBCE All Share Index: {}'.format(gbce_asi))
+
+def _cli_all_share_index_live(values):
+    gbce_asi = all_share_index(values[0]).value(latest=values[1:] == ['latest'])
+    print('GBCE All Share Index: {}'.format(gbce_asi))
+
+
+def _cli_price_file(values):
+    price_file(values[0], values[1] if len(values) > 1 else None)
+
+
+def _cli_serve(values):
+    serve(values[0] if values else 'engine.sock')
+
+
+def _cli_client(values):
+    response = client_request(values[0], values[1:])
+    sys.stdout.write(response['output'])
+    if response['status']:
+        sys.exit(response['status'])
+
+
+def _cli_migrate(values):
+    if TRADE_STORE is not None:
+        imported = TRADE_STORE.import_trade_files(values[0] if values else None)
+        for symbol in imported:
+            print('Imported {} trades of {} into {}'.format(imported[symbol], symbol, TRADE_STORE))
+        return
+    migrated = migrate_trade_files(values[0] if values else None)
+    for symbol in migrated:
+        print('Migrated {} trades of {} to trade_{}.jsonl'.format(migrated[symbol], symbol, symbol))
+
+
+def _cli_trade_batch(values):
+    if values[0] == '-':
+        recorded = record_trades(read_trade_batch(sys.stdin))
+    else:
+        with open(values[0], 'r') as batch_file:
+            recorded = record_trades(read_trade_batch(batch_file))
+    for symbol in recorded:
+        print('Trades recorded for {}: {}'.format(symbol, recorded[symbol]))
+
+
+def _cli_vwsp_stream(values):
+    tracker = VWSPTracker(float(values[0]) * 60 if values else 15 * 60)
+    for symbol, epoch_ns, vwsp in stream_volume_weighted_stock_price(read_trade_batch(sys.stdin), tracker):
+        print(json.dumps({'Stock': symbol, 'Epoch_ns': epoch_ns, 'VWSP': vwsp}), flush=True)
+
+
+def _cli_bars(values):
+    if values[0] not in BAR_RESOLUTIONS:
+        print('Error! The resolution of the bars must be one of {}'.format(', '.join(BAR_RESOLUTIONS)))
+        return
+    symbols = values[1].split(',') if len(values) > 1 and values[1] != 'all' else trade_symbols()
+    hours = float(values[2]) if len(values) > 2 else 24
+    start_ns = time.time_ns() - int(hours * 3600 * 10 ** 9)
+    writer = csv.writer(sys.stdout, lineterminator='\n')
+    writer.writerow(['Stock', 'Start', 'Open', 'High', 'Low', 'Close', 'Volume', 'VWAP', 'Imbalance', 'Trades'])
+    for symbol in symbols:
+        bars = load_bars(symbol, values[0], start_ns=start_ns)
+        for position in range(len(bars.start)):
+            writer.writerow([symbol, epoch_ns_to_timestamp(int(bars.start[position])), bars.open[position],
+                             bars.high[position], bars.low[position], bars.close[position], bars.volume[position],
+                             round(float(bars.vwap[position]), 4), round(float(bars.imbalance[position]), 4),
+                             bars.trades[position]])
+
+
+def _cli_simulate(values):
+    seed = int(values[2]) if len(values) > 2 else None
+    recorded = simulate_trades(values[0].split(','), int(values[1]), seed)
+    for symbol in sorted(recorded):
+        print('Trades simulated for {}: {}'.format(symbol, recorded[symbol]))
+
+
+# The command line switches: flags, value names (optional ones in brackets), fewest and most values, handler, help
+_COMMANDS = (
+    (('--d', '--dividend-yield'), 'SYMBOL PRICE', 2, 2, _cli_dividend_yield,
+     'Help: The dividend yield is calculated when the user passes the stock symbol and price desired. Example: python3 engine.py --d POP 149 '),
+    (('--pe', '--p-to-e-ratio'), 'SYMBOL PRICE', 2, 2, _cli_p_to_e_ratio,
+     'Help: The P/E ratio is calculated when the user passes the stock symbol and price desired. Example: python3 engine.py --pe POP 140 or --p-to-e-ratio POP 140 '),
+    (('--tr', '--trade-record'), 'SYMBOL QUANTITY INDICATOR PRICE', 4, 4, _cli_trade_record,
+     'Help: The trade record is created as a file and the user receives what information has been recorded when the user passes the stock, quantity of shares, indicator (BUY or SELL) and price. Example: python3 engine.py --tr JOE, 12, SELL, 22.8 or --trade-record JOE 12 SELL 22.8'),
+    (('--vwsp', '--volume-weighted-stock-price'), 'SYMBOL', 1, 1, _cli_volume_weighted_stock_price,
+     'Help: The volume weighted stock price is calculated from the trades of the stock recorded in the last 15 minutes when the user passes the stock symbol desired. Nothing is written; use the trade record options or the simulation (--sim) to record trades first. Example: python3 engine.py --vwsp TEA or --volume-weighted-stock-price TEA'),
+    (('--asi', '--all-share-index'), 'DIRECTORY', 1, 1, _cli_all_share_index,
+     'The Global Beverage Commerce Exchange All Share Inex will be automatically calculated, provided the user has recorded trades for MORE THAN 2 stock indices. No input from the user is required otherwise. Example: python3 engine.py --asi <path_to_script_directory> or python3 engine.py --all-share-index <path_to_script_directory>'),
+    (('--asi-live',), 'DIRECTORY [latest]', 1, 2, _cli_all_share_index_live,
+     'Help: The All Share Index is kept up to date as trades are recorded and saved in the checkpoint gbce_index_checkpoint.json of the directory, so it is given without reading all the trade records files again. With latest, only the latest price of each stock is taken. Example: python3 engine.py --asi-live <path_to_script_directory> latest'),
+    (('--price-file',), 'INPUT [OUTPUT]', 1, 2, _cli_price_file,
+     'Help: The dividend yield and the P/E ratio are calculated for every line of a CSV file of stock symbols and prices (- for the standard input) and written as CSV to the output file given or the standard output. Example: python3 engine.py --price-file prices.csv results.csv'),
+    (('--serve',), '[ADDRESS]', 0, 1, _cli_serve,
+     'Help: A long running server answers the command lines of its clients on a Unix socket (engine.sock by default) or a TCP host:port, keeping the reference data and the trade state loaded. Example: python3 engine.py --serve engine.sock or python3 engine.py --serve 127.0.0.1:8765'),
+    (('--client',), 'ADDRESS FLAG...', 1, None, _cli_client,
+     'Help: The flags after the address are forwarded to the engine server listening there and its answer is printed. Example: python3 engine.py --client engine.sock --d POP 149'),
+    (('--migrate',), '[DIRECTORY]', 0, 1, _cli_migrate,
+     'Help: The legacy trade_<SYMBOL>.json files of the directory given are converted to append-only trade_<SYMBOL>.jsonl journals. With --store, the journals and legacy files are imported into the SQLite database instead. Example: python3 engine.py --migrate <path_to_script_directory> or python3 engine.py --migrate <path_to_script_directory> --store trades.db'),
+    (('--tr-batch',), 'FILE', 1, 1, _cli_trade_batch,
+     'Help: Many trades are recorded at once from a CSV file with the columns Stock, Quantity, Indicator, Price or from a JSONL file of trade records. Use - to read the standard input. Example: python3 engine.py --tr-batch trades.csv or cat trades.jsonl | python3 engine.py --tr-batch -'),
+    (('--vwsp-stream',), '[MINUTES]', 0, 1, _cli_vwsp_stream,
+     'Help: Trades are read from the standard input (CSV or JSONL) and the updated Volume Weighted Stock Price of the stock traded is written out as a json line after each trade. An optional window in minutes can be given, 15 by default. Example: tail -f feed.jsonl | python3 engine.py --vwsp-stream 5'),
+    (('--bars',), 'RESOLUTION [SYMBOLS] [HOURS]', 1, 3, _cli_bars,
+     'Help: The open, high, low, close, volume, volume weighted average price and buy/sell imbalance bars of the comma separated stocks given (all the stocks traded by default) over the last hours given (24 by default) are written as CSV. The resolutions are 1s, 1m, 5m, 15m and 1h; the finished bars of every resolution are cached on disk. Example: python3 engine.py --bars 1m TEA,POP 8'),
+    (('--sim', '--simulate'), 'SYMBOLS COUNT [SEED]', 2, 3, _cli_simulate,
+     'Help: Random trades are generated for the comma separated stock symbols given and recorded in their journals. The number of trades and optionally a seed are passed. Example: python3 engine.py --sim TEA,POP,ALE 1000000 42'),
+)
+
+
+@functools.lru_cache(maxsize=None)
+def _cli_parser():
+    """
+    Builds the argument parser of the command line switches once, argparse being imported only then
+
+    :return: The argparse.ArgumentParser with one mutually exclusive option per entry of _COMMANDS
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='engine.py', allow_abbrev=False,
+                                     description='Super Simple Stock Market Engine v1.0',
+                                     epilog='Run python3 engine.py without arguments for the full help, or give h as the value of a switch for its help.')
+    switches = parser.add_mutually_exclusive_group(required=True)
+    for flags, value_names, fewest, most, handler, help_text in _COMMANDS:
+        switches.add_argument(*flags, dest=handler.__name__, nargs='*', metavar='VALUE',
+                              help='{}: {}'.format(value_names, help_text.replace('Help: ', '', 1).replace('%', '%%')))
+    parser.add_argument('--stats', nargs='?', const='', metavar='PROFILE_FILE',
+                        help='The time spent in each stage and the counters of the work done are written as json to the standard error once the command has run; with a file, the command is profiled with cProfile and the profile is saved there as well')
+    parser.add_argument('--store', metavar='DATABASE',
+                        help='The trades are recorded in and read from this SQLite database instead of the trade_<SYMBOL>.jsonl journals, for --tr, --tr-batch, --sim, --vwsp and --asi (whose directory is then not read); with --migrate, the trade records files of the directory are imported into it')
+    return parser
+
+
+def _dispatch(parser, arguments):
+    # Runs the command line switch given, its help when its value is h
+    for flags, value_names, fewest, most, handler, help_text in _COMMANDS:
+        values = getattr(arguments, handler.__name__)
+        if values is None:
+            continue
+        if values[:1] == ['h']:
+            sys.exit(help_text)
+        if len(values) < fewest or (most is not None and len(values) > most):
+            parser.error('{} takes {}'.format(flags[0], value_names))
+        handler(values)
+
+
+def _run(parser, arguments):
+    # Runs the command, gathering its statistics with --stats
+    if arguments.stats is None:
+        _dispatch(parser, arguments)
+        return
+
+    # Statistics which were already enabled (by the server running with --stats) are kept on and given as they stand
+    enabled_here = _STATS is None
+    stats = enable_stats(profile=bool(arguments.stats))
+    try:
+        _dispatch(parser, arguments)
+    finally:
+        if enabled_here:
+            disable_stats()
+        if arguments.stats and stats.profiler is not None:
+            stats.profiler.dump_stats(arguments.stats)
+        sys.stderr.write(json.dumps(stats.snapshot(), indent=2) + '\n')
+
+
+def main(argv=None):
+    """
+    Command Line Interface menu - argument parsing function
+
+    :param argv: The command line to dispatch, program name first, sys.argv by default (the engine server passes the command lines of its clients)
+    :return: Nothing, this is a distribution of arguments type of function
+    """
+    if argv is None:
+        argv = sys.argv
+
+    if len(argv[0:])<2:
+        sys.exit(_USAGE)
+
+    # The client forwards its flags untouched to the server, so it is dispatched before argparse is even imported
+    if argv[1] == '--client' and len(argv) > 2 and argv[2] != 'h':
+        _cli_client(argv[2:])
+        return
+
+    parser = _cli_parser()
+    arguments = parser.parse_args(argv[1:])
+    # The store is used by this command only, or by all the requests of a server started with it
+    if arguments.store is not None:
+        previous_store = use_trade_store(sqlite_trade_store(arguments.store))
+    try:
+        _run(parser, arguments)
+    finally:
+        if arguments.store is not None:
+            use_trade_store(previous_store)
 
 
 if __name__ == "__main__":
@@ -8,10 +8,26 @@ This is a standalone script which tests the Super Simple Stock Market engine
 """
 
 import unittest
+import concurrent.futures
 import datetime
+import io
 import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import bench_engine
 import engine
 
+def record_in_batches(directory, symbols, batches):
+    # Records batches of trades from a separate process
+    for batch in range(batches):
+        engine.record_trades([(symbol, batch + 1, 'BUY', float(batch + 1)) for symbol in symbols for _ in range(5)], directory)
+
+
 class SuperSimple(unittest.TestCase):
 
     def test_main_data(self):
@@ -19,6 +35,26 @@ class SuperSimple(unittest.TestCase):
         self.assertEqual(engine.main_data('JOE'), JOE)
         self.assertRaises(ValueError, engine.main_data, 'NONEXISTANTSTOCK')
 
+    def test_stock_registry(self):
+        registry = engine.StockRegistry()
+        registry.load([{'Type': 'Common', 'Par_Value': 100, 'Stock_Symbol': 'XYZ', 'Fixed_Dividend': '', 'Last_Dividend': 5}])
+        self.assertEqual(registry.get('XYZ')['Last_Dividend'], 5)
+        self.assertEqual(registry.symbols(), ['XYZ'])
+        self.assertRaises(KeyError, registry.get, 'JOE')
+
+        # The table is reloaded when the file changes on disk
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'stocks.json')
+        with open(path, 'w') as fileobj:
+            json.dump([{'Stock_Symbol': 'AAA', 'Type': 'Common', 'Last_Dividend': 1, 'Fixed_Dividend': '', 'Par_Value': 1}], fileobj)
+        registry = engine.StockRegistry(path)
+        self.assertEqual(registry.get('AAA')['Last_Dividend'], 1)
+        with open(path, 'w') as fileobj:
+            json.dump([{'Stock_Symbol': 'AAA', 'Type': 'Common', 'Last_Dividend': 2, 'Fixed_Dividend': '', 'Par_Value': 1}], fileobj)
+        os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 10 ** 9))
+        self.assertEqual(registry.get('AAA')['Last_Dividend'], 2)
+
     def test_dividend_yield_common_type(self):
         self.assertEqual(engine.calculate_dividend_yield('POP', 149), 5.37)
         self.assertEqual(engine.calculate_dividend_yield('JOE', 0.01), 130000)
@@ -42,10 +78,7 @@ class SuperSimple(unittest.TestCase):
         trade = engine.trade_record('ALE', 100, 'SELL', 15)
         now = datetime.datetime.now()
         timestamp_current = now.strftime("%Y-%m-%d %H:%M")
-        with open('trade_ALE.json', 'r') as ale:
-            test_ale = json.load(ale)
-
-        for individual_record_item in test_ale:
+        for individual_record_item in engine.iter_trades('ALE'):
             price = individual_record_item['Price']
             indicator = individual_record_item['Indicator']
             stock = individual_record_item['Stock']
@@ -70,6 +103,598 @@ class SuperSimple(unittest.TestCase):
         self.assertIn(timestamp_current, timestamp_file)
         self.assertNotIn('JOE',trade)
 
+    def test_trade_journal_and_migration(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        legacy_trade = {'Stock': 'TEA', 'Timestamp': '2018-07-24 19:32:10', 'Quantity': 5, 'Indicator': 'BUY', 'Price': 10.0}
+        new_trade = {'Stock': 'TEA', 'Timestamp': '2018-07-25 10:00:00', 'Quantity': 7, 'Indicator': 'SELL', 'Price': 12.5,
+                     'Epoch_ns': engine.timestamp_to_epoch_ns('2018-07-25 10:00:00')}
+        with open(os.path.join(directory, 'trade_TEA.json'), 'w') as fileobj:
+            json.dump([legacy_trade], fileobj)
+        with engine.TradeJournal(engine.journal_path('TEA', directory), fsync_every=1) as journal:
+            journal.append(new_trade)
+
+        # Legacy trades are read before the journal, whose records carry their sequence number
+        self.assertEqual(list(engine.iter_trades('TEA', directory)), [legacy_trade, dict(new_trade, Seq=1)])
+
+        # An interrupted write leaves a partial last line which is skipped
+        with open(engine.journal_path('TEA', directory), 'a') as fileobj:
+            fileobj.write('{"Stock": "TE')
+        self.assertEqual(list(engine.iter_trades('TEA', directory)), [legacy_trade, dict(new_trade, Seq=1)])
+
+        # and cut off before the next record is appended
+        engine.record_trades([new_trade], directory)
+        self.assertEqual(list(engine.iter_trades('TEA', directory)), [legacy_trade, dict(new_trade, Seq=1), dict(new_trade, Seq=2)])
+        with open(engine.journal_path('TEA', directory), 'a') as fileobj:
+            fileobj.write('{"Stock": "TE')
+        with engine.TradeJournal(engine.journal_path('TEA', directory)) as journal:
+            journal.append(new_trade)
+        self.assertEqual([record.get('Seq') for record in engine.iter_trades('TEA', directory)], [None, 1, 2, 3])
+
+        with open(engine.journal_path('TEA', directory), 'w') as fileobj:
+            fileobj.write(json.dumps(new_trade) + '\n')
+        self.assertEqual(engine.migrate_trade_files(directory), {'TEA': 1})
+        self.assertFalse(os.path.exists(os.path.join(directory, 'trade_TEA.json')))
+        migrated = list(engine.iter_trades('TEA', directory))
+        self.assertEqual(migrated[0], dict(legacy_trade, Epoch_ns=engine.timestamp_to_epoch_ns(legacy_trade['Timestamp']), Seq=1))
+        self.assertEqual(migrated[1], dict(new_trade, Seq=2))
+
+    def test_record_trades_batch(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        batch = engine.read_trade_batch(io.StringIO('Stock,Quantity,Indicator,Price\nTEA,10,BUY,1.5\nPOP,3,SELL,2\nTEA,5,SELL,3.25\n'))
+        self.assertEqual(engine.record_trades(batch, directory), {'TEA': 2, 'POP': 1})
+        tea = list(engine.iter_trades('TEA', directory))
+        self.assertEqual([(trade['Quantity'], trade['Indicator'], trade['Price']) for trade in tea], [(10, 'BUY', 1.5), (5, 'SELL', 3.25)])
+
+        batch = list(engine.read_trade_batch(io.StringIO('{"Stock": "GIN", "Quantity": 1, "Indicator": "BUY", "Price": 4.0}\n')))
+        self.assertEqual(batch[0]['Stock'], 'GIN')
+        self.assertEqual(list(engine.read_trade_batch(io.StringIO('JOE,2,BUY,9.5\n'))), [('JOE', '2', 'BUY', '9.5')])
+
+        # A bad trade anywhere in the batch means nothing is written
+        self.assertRaises(ValueError, engine.record_trades, [('ALE', 1, 'BUY', 2.0), ('ALE', 0, 'BUY', 2.0)], directory)
+        self.assertRaises(ValueError, engine.record_trades, [('ALE', 1, 'HOLD', 2.0)], directory)
+        self.assertRaises(ValueError, engine.record_trades, [('ALE', 1, 'BUY', -2.0)], directory)
+        self.assertRaises(ValueError, engine.record_trades, engine.read_trade_batch(io.StringIO('Stock,Quantity,Indicator,Price,Epoch_ns\nALE,1,BUY,2.0,soon\n')), directory)
+        self.assertFalse(os.path.exists(engine.journal_path('ALE', directory)))
+
+        # The times of a CSV batch are taken as numbers, and an empty one is stamped when written
+        batch = engine.read_trade_batch(io.StringIO('Stock,Quantity,Indicator,Price,Epoch_ns\nALE,1,BUY,2.0,1532426400000000000\nALE,2,BUY,2.0,\n'))
+        self.assertEqual(engine.record_trades(batch, directory), {'ALE': 2})
+        ale = list(engine.iter_trades('ALE', directory))
+        self.assertEqual((ale[0]['Epoch_ns'], ale[0]['Timestamp']), (1532426400000000000, engine.epoch_ns_to_timestamp(1532426400000000000)))
+        self.assertGreater(ale[1]['Epoch_ns'], ale[0]['Epoch_ns'])
+
+    def test_time_window_query(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        block_bytes = engine.INDEX_BLOCK_BYTES
+        engine.INDEX_BLOCK_BYTES = 256
+        self.addCleanup(setattr, engine, 'INDEX_BLOCK_BYTES', block_bytes)
+
+        start = engine.timestamp_to_epoch_ns('2018-07-24 10:00:00')
+        trades = [{'Stock': 'POP', 'Timestamp': '', 'Quantity': 1, 'Indicator': 'BUY', 'Price': float(minute),
+                   'Epoch_ns': start + minute * 60 * 10 ** 9} for minute in range(200)]
+        # One trade recorded late, out of time order
+        trades[150]['Epoch_ns'] = start + 10 * 60 * 10 ** 9
+        path = engine.journal_path('POP', directory)
+        for chunk in range(0, 200, 50):
+            with engine.TradeJournal(path) as journal:
+                journal.extend(trades[chunk:chunk + 50])
+        times, offsets = engine.read_journal_index(path)
+        self.assertTrue(len(offsets) > 10)
+        self.assertEqual(times, sorted(times))
+
+        for minute in (-1, 5, 9, 99, 180, 199):
+            after_ns = start + minute * 60 * 10 ** 9
+            expected = [trade['Price'] for trade in trades if trade['Epoch_ns'] > after_ns]
+            self.assertEqual([trade['Price'] for trade in engine.iter_trades('POP', directory, after_ns)], expected)
+
+    def test_vwsp_tracker(self):
+        minute = 60 * 10 ** 9
+        tracker = engine.VWSPTracker(window_seconds=5 * 60)
+        self.assertIsNone(tracker.value('TEA'))
+        self.assertEqual(tracker.add('TEA', 10, 2.0, 0), 2.0)
+        self.assertEqual(tracker.add('TEA', 30, 4.0, 2 * minute), 3.5)
+        self.assertEqual(tracker.add('POP', 1, 100.0, 3 * minute), 100.0)
+        # The first trade of TEA leaves the 5 minute window
+        self.assertEqual(tracker.add('TEA', 10, 6.0, 5 * minute), 4.5)
+        self.assertEqual(tracker.value('TEA', now_ns=7 * minute), 6.0)
+        self.assertIsNone(tracker.value('TEA', now_ns=11 * minute))
+        self.assertEqual(sorted(tracker.symbols()), ['POP', 'TEA'])
+        self.assertRaises(ValueError, engine.VWSPTracker, 0)
+
+        feed = io.StringIO('{"Stock": "GIN", "Quantity": 2, "Indicator": "BUY", "Price": 1.0, "Epoch_ns": 0}\n'
+                           '{"Stock": "GIN", "Quantity": 2, "Indicator": "SELL", "Price": 3.0, "Epoch_ns": 60000000000}\n')
+        updates = list(engine.stream_volume_weighted_stock_price(engine.read_trade_batch(feed)))
+        self.assertEqual(updates, [('GIN', 0, 1.0), ('GIN', minute, 2.0)])
+
+    def test_simulation_and_volume_weighted_stock_price(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.assertFalse(engine.volume_weighted_stock_price('TEA', directory))
+
+        # 600 trades in the last minute for two stocks
+        recorded = engine.simulate_trades(['TEA', 'POP'], 600, seed=7, directory=directory, chunk_size=250, rate=10.0)
+        self.assertEqual(sum(recorded.values()), 600)
+        trades = list(engine.iter_trades('TEA', directory))
+        self.assertEqual(len(trades), recorded['TEA'])
+        expected = round(sum(trade['Price'] * trade['Quantity'] for trade in trades) / sum(trade['Quantity'] for trade in trades), 2)
+        self.assertEqual(engine.volume_weighted_stock_price('TEA', directory), expected)
+        # The calculation itself records nothing
+        self.assertEqual(len(list(engine.iter_trades('TEA', directory))), len(trades))
+
+        # The same seed gives the same trades
+        first = list(engine.generate_trades(['GIN'], 50, seed=3, start_ns=0, price=('lognormal', 1.0, 0.5), quantity=('poisson', 20)))
+        second = list(engine.generate_trades(['GIN'], 50, seed=3, start_ns=0, price=('lognormal', 1.0, 0.5), quantity=('poisson', 20)))
+        self.assertEqual(first, second)
+        self.assertTrue(all(trade['Quantity'] >= 1 and trade['Price'] > 0 for trade in first))
+        self.assertRaises(ValueError, list, engine.generate_trades([], 10))
+
+    def test_trade_columns(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = engine.journal_path('ALE', directory)
+        with engine.TradeJournal(path) as journal:
+            journal.extend([{'Stock': 'ALE', 'Timestamp': '', 'Quantity': 10, 'Indicator': 'BUY', 'Price': 2.5, 'Epoch_ns': 100},
+                            {'Stock': 'ALE', 'Timestamp': '', 'Quantity': 20, 'Indicator': 'SELL', 'Price': 3.5, 'Epoch_ns': 200}])
+        columns, ordered = engine.load_journal_columns(path)
+        self.assertTrue(ordered)
+        self.assertEqual(columns.timestamp.tolist(), [100, 200])
+        self.assertEqual(columns.price.tolist(), [2.5, 3.5])
+        self.assertEqual(columns.quantity.tolist(), [10, 20])
+        self.assertEqual(columns.side.tolist(), [1, -1])
+
+        # Only the trades appended since are parsed, and an older trade marks the columns as out of time order
+        with engine.TradeJournal(path) as journal:
+            journal.append({'Stock': 'ALE', 'Timestamp': '', 'Quantity': 5, 'Indicator': 'BUY', 'Price': 1.0, 'Epoch_ns': 150})
+        columns, ordered = engine.load_journal_columns(path)
+        self.assertFalse(ordered)
+        self.assertEqual(columns.timestamp.tolist(), [100, 200, 150])
+
+        # The rows are in time order again from the late trade on, and only the rows before it which are newer than the
+        # start of a window are searched
+        with engine.TradeJournal(path) as journal:
+            journal.extend([{'Stock': 'ALE', 'Timestamp': '', 'Quantity': 1, 'Indicator': 'BUY', 'Price': 4.0, 'Epoch_ns': 250},
+                            {'Stock': 'ALE', 'Timestamp': '', 'Quantity': 2, 'Indicator': 'BUY', 'Price': 4.0, 'Epoch_ns': 260}])
+        self.assertEqual(engine.refresh_journal_columns(path)[3:], (260, 2, 200))
+        store = engine.JsonTradeStore(directory)
+        self.assertEqual(store.window_totals('ALE', 200), (12.0, 3, 250))
+        self.assertEqual(store.window_totals('ALE', 120), (87.0, 28, 150))
+        self.assertIsNone(store.window_totals('ALE', 260))
+
+        # A replaced journal has its column file rebuilt aside, so the columns mapped before are still read
+        mapped = engine.load_journal_columns(path)[0]
+        os.remove(path)
+        with engine.TradeJournal(path) as journal:
+            journal.append({'Stock': 'ALE', 'Timestamp': '', 'Quantity': 1, 'Indicator': 'SELL', 'Price': 9.0, 'Epoch_ns': 300})
+        self.assertEqual(engine.load_trade_columns('ALE', directory).price.tolist(), [9.0])
+        self.assertEqual(mapped.timestamp.tolist(), [100, 200, 150, 250, 260])
+
+        # The columnar Volume Weighted Stock Price matches the formula over the trades in the window
+        now_ns = engine.datetime_to_epoch_ns(datetime.datetime.now())
+        engine.record_trades([{'Stock': 'GIN', 'Quantity': 4, 'Indicator': 'BUY', 'Price': 10.0, 'Epoch_ns': now_ns - 20 * 60 * 10 ** 9},
+                              {'Stock': 'GIN', 'Quantity': 1, 'Indicator': 'BUY', 'Price': 2.0, 'Epoch_ns': now_ns - 60 * 10 ** 9},
+                              {'Stock': 'GIN', 'Quantity': 3, 'Indicator': 'SELL', 'Price': 6.0, 'Epoch_ns': now_ns - 10 ** 9}], directory)
+        self.assertEqual(engine.volume_weighted_stock_price('GIN', directory), 5.0)
+        engine.record_trades([{'Stock': 'GIN', 'Quantity': 4, 'Indicator': 'SELL', 'Price': 1.0, 'Epoch_ns': now_ns - 2 * 10 ** 9}], directory)
+        self.assertEqual(engine.volume_weighted_stock_price('GIN', directory), 3.0)
+
+    def test_gbce_all_share_index(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        engine.record_trades([('TEA', 1, 'BUY', 2.0)], directory)
+        self.assertRaises(ValueError, engine.gbce_all_share_index, directory)
+        engine.record_trades([('POP', 1, 'BUY', 8.0)], directory)
+        self.assertEqual(engine.gbce_all_share_index(directory), 4.0)
+
+        # Every stock counts, legacy files included, whatever the current working directory
+        with open(os.path.join(directory, 'trade_GIN.json'), 'w') as fileobj:
+            json.dump([{'Stock': 'GIN', 'Timestamp': '2018-07-24 19:32:10', 'Quantity': 1, 'Indicator': 'BUY', 'Price': 4.0}], fileobj)
+        engine.simulate_trades(['ALE', 'JOE'], 5000, seed=11, directory=directory)
+        self.assertEqual(engine.trade_symbols(directory), ['ALE', 'GIN', 'JOE', 'POP', 'TEA'])
+        prices = [trade['Price'] for symbol in engine.trade_symbols(directory) for trade in engine.iter_trades(symbol, directory)]
+        reference = round(float(np.exp(np.log(prices).mean())), 2)
+        serial = engine.gbce_all_share_index(directory, workers=1)
+        self.assertEqual(serial, reference)
+        self.assertEqual(engine.gbce_all_share_index(directory, workers=4), serial)
+        self.assertEqual(engine.gbce_all_share_index(directory, workers=2, use_processes=True), serial)
+
+    def test_running_all_share_index(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        engine.simulate_trades(['TEA', 'POP', 'ALE'], 3000, seed=5, directory=directory)
+        index = engine.all_share_index(directory)
+        self.assertEqual(index.value(), engine.gbce_all_share_index(directory, workers=1))
+        self.assertTrue(os.path.isfile(os.path.join(directory, engine.AllShareIndex.CHECKPOINT)))
+
+        # Only the latest price of each stock
+        now_ns = engine.datetime_to_epoch_ns(datetime.datetime.now())
+        engine.record_trades([{'Stock': symbol, 'Quantity': 1, 'Indicator': 'BUY', 'Price': price, 'Epoch_ns': now_ns + 10 ** 9}
+                              for symbol, price in (('TEA', 2.0), ('POP', 4.0), ('ALE', 8.0))], directory)
+        self.assertEqual(index.value(latest=True), 4.0)
+        self.assertEqual(index.value(), engine.gbce_all_share_index(directory, workers=1))
+
+        # Trades recorded by someone else are taken in when the state is restored from the checkpoint
+        with engine.TradeJournal(engine.journal_path('GIN', directory)) as journal:
+            journal.append({'Stock': 'GIN', 'Timestamp': '', 'Quantity': 1, 'Indicator': 'SELL', 'Price': 16.0, 'Epoch_ns': now_ns + 10 ** 9})
+        with engine.TradeJournal(engine.journal_path('TEA', directory)) as journal:
+            journal.append({'Stock': 'TEA', 'Timestamp': '', 'Quantity': 1, 'Indicator': 'SELL', 'Price': 1.0, 'Epoch_ns': now_ns + 2 * 10 ** 9})
+        restored = engine.AllShareIndex(directory)
+        restored.load()
+        self.assertEqual(restored.value(), engine.gbce_all_share_index(directory, workers=1))
+        self.assertEqual(restored.value(latest=True), round(float(np.exp(np.log([1.0, 4.0, 8.0, 16.0]).mean())), 2))
+
+        # and by a running state before it answers
+        self.assertEqual(index.value(), restored.value())
+        subprocess.check_call([sys.executable, '-c', 'import engine; engine.record_trades([("TEA", 1, "BUY", 100.0)], {!r})'.format(directory)],
+                              cwd=os.path.dirname(os.path.abspath(engine.__file__)))
+        self.assertEqual(index.value(), engine.gbce_all_share_index(directory, workers=1))
+
+        # A trade at a price of 0 takes the index to 0, and further trades of the stock leave it there
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        engine.record_trades([('TEA', 1, 'BUY', 0.0), ('POP', 1, 'BUY', 4.0)], directory)
+        engine.record_trades([('TEA', 1, 'SELL', 5.0), ('POP', 1, 'SELL', 5.0)], directory)
+        index = engine.all_share_index(directory)
+        self.assertEqual(index.value(), engine.gbce_all_share_index(directory, workers=1))
+        self.assertEqual(index.value(), 0.0)
+        self.assertEqual(index.value(latest=True), 5.0)
+        restored = engine.AllShareIndex(directory)
+        restored.load()
+        self.assertEqual(restored.value(), 0.0)
+
+        # The checkpoint is not saved with every write, but once enough trades are taken in and when the process exits
+        with open(index.checkpoint, 'rb') as fileobj:
+            checkpoint = fileobj.read()
+        engine.record_trades([('TEA', 1, 'BUY', 6.0)], directory)
+        with open(index.checkpoint, 'rb') as fileobj:
+            self.assertEqual(fileobj.read(), checkpoint)
+        engine.record_trades([('POP', 1, 'BUY', 6.0)] * index.SAVE_EVERY_TRADES, directory)
+        with open(index.checkpoint, 'rb') as fileobj:
+            checkpoint = fileobj.read()
+        self.assertIn(str(index.SAVE_EVERY_TRADES + 2).encode('ascii'), checkpoint)
+        engine.record_trades([('TEA', 1, 'BUY', 6.0)], directory)
+        engine._save_all_share_indexes()
+        with open(index.checkpoint, 'rb') as fileobj:
+            self.assertNotEqual(fileobj.read(), checkpoint)
+
+    def test_pricing_arrays(self):
+        symbols = ['POP', 'JOE', 'GIN', 'ALE', 'TEA']
+        prices = [149, 0.01, 43, 100, 0.01]
+        self.assertEqual(engine.dividend_yield_array(symbols, prices).tolist(), [5.37, 130000.0, 4.65, 23.0, 0.0])
+        p_e_ratios = engine.p_to_e_ratio_array(symbols, prices)
+        self.assertEqual(p_e_ratios[:4].tolist(), [18.62, 0.0, 5.38, 4.35])
+        self.assertTrue(np.isnan(p_e_ratios[4]))
+        self.assertTrue(np.isnan(engine.dividend_yield_array('GIN', [0.0, 1.0])[0]))
+
+        # Every stock by every price
+        grid = engine.dividend_yield_array(np.array(symbols)[:, None], np.array([1.0, 43.0])[None, :])
+        self.assertEqual(grid.shape, (5, 2))
+        self.assertEqual(grid[2].tolist(), [engine.calculate_dividend_yield('GIN', 1), engine.calculate_dividend_yield('GIN', 43)])
+
+        self.assertRaises(ValueError, engine.dividend_yield_array, ['POP'], [-1])
+        self.assertRaises(ValueError, engine.p_to_e_ratio_array, ['NONEXISTANTSTOCK'], [1])
+
+    def test_engine_server(self):
+        self.assertEqual(engine.serve_request({'argv': ['--d', 'POP', '149']}), {'status': 0, 'output': 'The dividend yield is 5.37%\n'})
+        self.assertEqual(engine.serve_request({'argv': ['--vwsp-stream']})['status'], 1)
+        # Nothing is written at a path of the client's choosing, and no long command holds up the other clients
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        for argv in (['--price-file', 'prices.csv', os.path.join(directory, 'out.csv')], ['--d', 'POP', '149', '--stats=' + os.path.join(directory, 'p')],
+                     ['--migrate', directory], ['--vwsp', 'TEA', '--store', os.path.join(directory, 'db')], ['--asi-live', directory],
+                     ['--sim', 'TEA', '1000000'], ['--tr-batch', 'trades.csv']):
+            response = engine.serve_request({'argv': argv})
+            self.assertEqual(response['status'], 1)
+            self.assertIn('Error!', response['output'])
+        self.assertEqual(os.listdir(directory), [])
+        self.assertEqual(engine.serve_request({'argv': ['--d', 'NONEXISTANTSTOCK', '1']})['status'], 1)
+        self.assertIn('Help', engine.serve_request({'argv': ['--pe', 'h']})['output'])
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        address = os.path.join(directory, 'engine.sock')
+        server = subprocess.Popen([sys.executable, os.path.abspath(engine.__file__), '--serve', address],
+                                  stdout=subprocess.DEVNULL, cwd=os.path.dirname(os.path.abspath(engine.__file__)))
+        self.addCleanup(server.wait)
+        self.addCleanup(server.terminate)
+        for _ in range(100):
+            if os.path.exists(address):
+                break
+            time.sleep(0.05)
+        self.assertEqual(engine.client_request(address, ['--pe', 'ALE', '100'], timeout=10), {'status': 0, 'output': 'The P/E ratio is 4.35\n'})
+        self.assertEqual(engine.client_request(address, ['--d', 'GIN', '43'], timeout=10)['output'], 'The dividend yield is 4.65%\n')
+
+    def test_concurrent_recording(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=4) as executor:
+            futures = [executor.submit(record_in_batches, directory, ['TEA', 'POP'], 40) for _ in range(4)]
+            for future in futures:
+                future.result()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            futures = [executor.submit(record_in_batches, directory, [symbol], 40) for symbol in ('TEA', 'POP', 'GIN', 'JOE')]
+            for future in futures:
+                future.result()
+        store = engine.JsonTradeStore(directory)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            futures = [executor.submit(engine.trade_record, 'ALE', 1, 'BUY', 1.0, store) for _ in range(200)]
+            for future in futures:
+                future.result()
+
+        # No trade is lost or torn and the running All Share Index saw all of them
+        for symbol, expected in (('TEA', 1000), ('POP', 1000), ('GIN', 200), ('JOE', 200), ('ALE', 200)):
+            with open(engine.journal_path(symbol, directory), 'rb') as journal:
+                lines = journal.read().splitlines()
+            self.assertEqual(len(lines), expected)
+            self.assertTrue(all(json.loads(line)['Stock'] == symbol for line in lines))
+            # The trades are stamped under the lock of the stock, so the journal stays in time order
+            self.assertTrue(engine.load_journal_columns(engine.journal_path(symbol, directory))[1])
+        restored = engine.AllShareIndex(directory)
+        restored.load()
+        self.assertEqual(restored.value(), engine.gbce_all_share_index(directory, workers=1))
+        self.assertEqual(engine.all_share_index(directory).value(), restored.value())
+
+
+    def test_lazy_imports(self):
+        # The pricing commands run without NumPy and a command line of the wrong length is a usage error
+        probe = "import sys, engine; engine.main(['engine.py', '--d', 'POP', '149']); print('numpy' in sys.modules)"
+        output = subprocess.check_output([sys.executable, '-c', probe], cwd=os.path.dirname(os.path.abspath(engine.__file__)),
+                                         universal_newlines=True)
+        self.assertEqual(output.splitlines(), ['The dividend yield is 5.37%', 'False'])
+        response = engine.serve_request({'argv': ['--pe', 'POP']})
+        self.assertEqual(response['status'], 1)
+        self.assertIn('--pe takes SYMBOL PRICE', response['output'])
+
+
+    def test_benchmark_suite(self):
+        results = bench_engine.engine_benchmark(trades=[200], symbols=[5], calls=20, scans=1)
+        measured = results['scenarios'][0]['results']
+        self.assertEqual(sorted(measured), ['calculate_dividend_yield', 'gbce_all_share_index', 'gbce_all_share_index_cached',
+                                            'main_data', 'p_to_e_ratio', 'trade_record', 'volume_weighted_stock_price',
+                                            'volume_weighted_stock_price_cached'])
+        self.assertTrue(all(entry['p50_ms'] <= entry['p99_ms'] and entry['peak_kib'] > 0 for entry in measured.values()))
+
+        # A run compared with itself is unchanged, and one twice as slow is a regression
+        self.assertTrue(all(entry['verdict'] == 'unchanged' for entry in bench_engine.compare_to_baseline(results, results)))
+        faster = json.loads(json.dumps(results))
+        for entry in faster['scenarios'][0]['results'].values():
+            entry['p50_ms'] /= 2
+        self.assertEqual({entry['verdict'] for entry in bench_engine.compare_to_baseline(results, faster)}, {'slower'})
+
+        # The startup benchmark times every switch but --serve
+        timed = {argv[0] for argv in bench_engine.STARTUP_COMMANDS}
+        self.assertEqual({command[0][0] for command in engine._COMMANDS} - timed, {'--serve'})
+
+
+    def test_stats(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.addCleanup(engine.disable_stats)
+        engine.record_trades([('TEA', 10, 'BUY', 2.0), ('TEA', 30, 'SELL', 4.0), ('POP', 5, 'BUY', 1.0)], directory)
+        self.assertIsNone(engine.get_stats())
+
+        engine.enable_stats()
+        engine.record_trades([('TEA', 20, 'BUY', 3.0)], directory)
+        self.assertEqual(engine.volume_weighted_stock_price('TEA', directory), 3.33)
+        engine.volume_weighted_stock_price('TEA', directory)
+        engine.main_data('POP')
+        stats = engine.get_stats()
+        self.assertEqual(stats['counters']['columns.misses'], 1)
+        self.assertEqual(stats['counters']['columns.records_parsed'], 1)
+        self.assertEqual(stats['counters']['vwsp.records_in_window'], 3)
+        # The second query is answered by the result cache
+        self.assertEqual(stats['counters']['cache.hits'], 1)
+        self.assertEqual(stats['timers']['vwsp.arithmetic']['calls'], 1)
+        self.assertEqual(stats['timers']['main_data']['calls'], 1)
+        engine.reset_stats()
+        self.assertEqual(engine.get_stats(), {'timers': {}, 'counters': {}})
+        self.assertEqual(engine.disable_stats(), {'timers': {}, 'counters': {}})
+        self.assertIsNone(engine.get_stats())
+
+        # The command line gives them on the standard error, which the server sends back with the output
+        output = engine.serve_request({'argv': ['--d', 'POP', '149', '--stats']})['output']
+        self.assertIn('The dividend yield is 5.37%', output)
+        self.assertIn('main_data', json.loads(output[output.index('{'):])['timers'])
+        self.assertIsNone(engine.get_stats())
+
+
+    def test_binary_trades(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        trade = engine.Trade('TEA', 12, 'SELL', 22.8, engine.timestamp_to_epoch_ns('2018-07-24 10:00:00'))
+        self.assertFalse(hasattr(trade, '__dict__'))
+        record = trade.to_record()
+        self.assertEqual(record, {'Stock': 'TEA', 'Timestamp': '2018-07-24 10:00:00', 'Quantity': 12, 'Indicator': 'SELL',
+                                  'Price': 22.8, 'Epoch_ns': trade.epoch_ns})
+        self.assertEqual(engine.Trade.from_record(record), trade)
+        self.assertEqual(engine.Trade.from_record(dict(record, Epoch_ns=None)), trade)
+
+        # A binary row is laid out exactly as a row of the column files
+        self.assertEqual(len(trade.pack()), engine.trade_dtype().itemsize)
+        self.assertEqual(engine.Trade.unpack_from('TEA', b'\0' + trade.pack(), 1), trade)
+
+        # Trade objects are recorded like the records and come back from the column file
+        trades = [trade, engine.Trade('TEA', 5, 'BUY', 1.5, trade.epoch_ns + 1)]
+        engine.record_trades(trades, directory)
+        trade.seq = 1
+        trades[1].seq = 2
+        self.assertEqual([engine.Trade.from_record(record) for record in engine.iter_trades('TEA', directory)], trades)
+        self.assertEqual(list(engine.iter_binary_trades('TEA', directory)), trades)
+        self.assertEqual(list(engine.iter_binary_trades('POP', directory)), [])
+
+
+    def test_sequence_numbers(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        second = engine.timestamp_to_epoch_ns('2018-07-24 10:00:00')
+        self.assertEqual(engine.timestamp_to_epoch_ns('2018-07-24 10:00:00.25'), second + 250000000)
+        self.assertEqual(engine.timestamp_to_epoch_ns('2018/07/24 10:00:00.000000001'), second + 1)
+
+        # Trades of the same nanosecond keep the order they were recorded in, across batches
+        engine.record_trades([('POP', 1, 'BUY', 1.0), ('POP', 2, 'BUY', 2.0)], directory)
+        engine.record_trades([{'Stock': 'POP', 'Quantity': 3, 'Indicator': 'SELL', 'Price': 3.0, 'Epoch_ns': second}], directory)
+        records = list(engine.iter_trades('POP', directory))
+        self.assertEqual([record['Seq'] for record in records], [1, 2, 3])
+        self.assertEqual([record['Quantity'] for record in records], [1, 2, 3])
+        self.assertEqual(records[0]['Epoch_ns'], records[1]['Epoch_ns'])
+
+        # A journal written before the records carried a sequence number continues from its number of lines
+        path = engine.journal_path('GIN', directory)
+        with open(path, 'w') as fileobj:
+            for minute in range(3):
+                fileobj.write(json.dumps({'Stock': 'GIN', 'Timestamp': '2018-07-24 10:0{}:00'.format(minute), 'Quantity': 1,
+                                          'Indicator': 'BUY', 'Price': 1.0}) + '\n')
+        with engine.TradeJournal(path) as journal:
+            journal.append(engine.Trade('GIN', 1, 'BUY', 1.0, second))
+        with engine.TradeJournal(path) as journal:
+            journal.append(engine.Trade('GIN', 1, 'BUY', 1.0, second))
+        self.assertEqual([record.get('Seq') for record in engine.iter_trades('GIN', directory)], [None, None, None, 4, 5])
+
+
+    def test_bars(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        start = engine.timestamp_to_epoch_ns('2018-07-24 10:00:00')
+        second = 10 ** 9
+        engine.record_trades([{'Stock': 'TEA', 'Quantity': 10, 'Indicator': 'BUY', 'Price': 2.0, 'Epoch_ns': start},
+                              {'Stock': 'TEA', 'Quantity': 30, 'Indicator': 'SELL', 'Price': 4.0, 'Epoch_ns': start + 20 * second},
+                              {'Stock': 'TEA', 'Quantity': 20, 'Indicator': 'BUY', 'Price': 3.0, 'Epoch_ns': start + 70 * second}], directory)
+        bars = engine.load_bars('TEA', '1m', directory)
+        self.assertEqual(bars.start.tolist(), [start, start + 60 * second])
+        self.assertEqual(bars.open.tolist(), [2.0, 3.0])
+        self.assertEqual(bars.high.tolist(), [4.0, 3.0])
+        self.assertEqual(bars.close.tolist(), [4.0, 3.0])
+        self.assertEqual(bars.volume.tolist(), [40, 20])
+        self.assertEqual(bars.vwap.tolist(), [3.5, 3.0])
+        self.assertEqual(bars.imbalance.tolist(), [-0.5, 1.0])
+        self.assertEqual(engine.load_bars('TEA', '1h', directory).trades.tolist(), [3])
+
+        # Trades recorded since update the open bar and add bars, and a late trade into a finished bar is taken in too
+        engine.record_trades([{'Stock': 'TEA', 'Quantity': 10, 'Indicator': 'SELL', 'Price': 1.0, 'Epoch_ns': start + 80 * second},
+                              {'Stock': 'TEA', 'Quantity': 5, 'Indicator': 'BUY', 'Price': 9.0, 'Epoch_ns': start + 200 * second}], directory)
+        bars = engine.load_bars('TEA', '1m', directory)
+        self.assertEqual(bars.low.tolist(), [2.0, 1.0, 9.0])
+        self.assertEqual(bars.close.tolist(), [4.0, 1.0, 9.0])
+        engine.record_trades([{'Stock': 'TEA', 'Quantity': 5, 'Indicator': 'BUY', 'Price': 8.0, 'Epoch_ns': start + 30 * second}], directory)
+        bars = engine.load_bars('TEA', '1m', directory)
+        self.assertEqual(bars.high.tolist(), [8.0, 3.0, 9.0])
+        self.assertEqual(bars.close.tolist(), [8.0, 1.0, 9.0])
+        self.assertEqual(engine.load_bars('TEA', '1m', directory, start_ns=start + 60 * second, end_ns=start + 120 * second).volume.tolist(), [30])
+
+        # Every resolution matches the bars of all the trades aggregated at once
+        columns = engine.load_trade_columns('TEA', directory)
+        for resolution, length_ns in engine.BAR_RESOLUTIONS.items():
+            expected = engine._bars_from_trades(columns.timestamp, columns.price, columns.quantity, columns.side, length_ns)
+            self.assertEqual(engine.load_bars('TEA', resolution, directory).close.tolist(), expected['close'].tolist())
+        self.assertEqual(list(engine.all_bars('5m', directory)), ['TEA'])
+        self.assertRaises(ValueError, engine.load_bars, 'TEA', '2m', directory)
+
+
+    def test_result_cache(self):
+        cache = engine.ResultCache(maxsize=2, ttl=60)
+        cache.put(('f', 'A', None), 1, 'a')
+        cache.put(('f', 'B', None), 1, 'b')
+        self.assertEqual(cache.get(('f', 'A', None), 1), 'a')
+        cache.put(('f', 'C', None), 1, 'c')
+        # B was the least recently used, and an entry whose files changed or whose time has passed is dropped
+        self.assertIsNone(cache.get(('f', 'B', None), 1))
+        self.assertIsNone(cache.get(('f', 'A', None), 2))
+        cache.put(('f', 'D', None), 1, 'd', valid_until_ns=100)
+        self.assertEqual(cache.get(('f', 'D', None), 1, now_ns=99), 'd')
+        self.assertIsNone(cache.get(('f', 'D', None), 1, now_ns=100))
+        self.assertIsNone(engine.ResultCache(ttl=0).get(('f', 'C', None), 1))
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.addCleanup(engine.RESULT_CACHE.clear)
+        now_ns = time.time_ns()
+        engine.record_trades([{'Stock': 'TEA', 'Quantity': 1, 'Indicator': 'BUY', 'Price': 2.0, 'Epoch_ns': now_ns - 14 * 60 * 10 ** 9},
+                              ('TEA', 1, 'BUY', 4.0), ('POP', 1, 'BUY', 8.0)], directory)
+        self.assertEqual(engine.volume_weighted_stock_price('TEA', directory), 3.0)
+        self.assertEqual(engine.gbce_all_share_index(directory), 4.0)
+        key = ('volume_weighted_stock_price', os.path.abspath(engine.journal_path('TEA', directory)), engine._VWSP_WINDOW_NS)
+        # The price holds until the oldest trade leaves the window
+        self.assertEqual(engine.RESULT_CACHE._entries[key][3], now_ns + 60 * 10 ** 9)
+
+        # A new trade is seen at once by both queries
+        engine.record_trades([('TEA', 2, 'SELL', 1.0)], directory)
+        self.assertEqual(engine.volume_weighted_stock_price('TEA', directory), 2.0)
+        self.assertEqual(engine.gbce_all_share_index(directory), 2.83)
+
+
+    def test_trade_stores(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.addCleanup(engine.RESULT_CACHE.clear)
+        store = engine.SQLiteTradeStore(os.path.join(directory, 'trades.db'))
+        self.addCleanup(store.close)
+        self.assertEqual(store._connection.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+
+        # The same trades give the same results from the journals and from the database
+        now_ns = time.time_ns()
+        trades = [{'Stock': 'TEA', 'Quantity': 10, 'Indicator': 'BUY', 'Price': 2.0, 'Epoch_ns': now_ns - 20 * 60 * 10 ** 9},
+                  ('TEA', 10, 'BUY', 2.0), ('TEA', 30, 'SELL', 4.0), ('POP', 5, 'BUY', 8.0)]
+        journals = engine.JsonTradeStore(directory)
+        self.assertEqual(engine.record_trades(trades, store=store), {'TEA': 3, 'POP': 1})
+        engine.record_trades(trades, directory)
+        self.assertTrue(engine.trade_record('POP', 1, 'SELL', 1.0, store=store))
+        engine.trade_record('POP', 1, 'SELL', 1.0, store=journals)
+        for trade_store in (journals, store):
+            self.assertEqual(trade_store.symbols(), ['POP', 'TEA'])
+            self.assertEqual(engine.volume_weighted_stock_price('TEA', store=trade_store), 3.5)
+            self.assertEqual(engine.gbce_all_share_index(None, store=trade_store), 2.64)
+        self.assertEqual([record['Seq'] for record in store.iter_trades('POP')], [1, 2])
+        self.assertEqual([(record['Seq'], record['Quantity']) for record in store.iter_trades('TEA', now_ns - 60 * 10 ** 9)], [(2, 10), (3, 30)])
+
+        # The trade records files are imported once, and the command line uses the database given
+        imported = engine.SQLiteTradeStore(os.path.join(directory, 'imported.db'))
+        self.addCleanup(imported.close)
+        self.assertEqual(imported.import_trade_files(directory), {'POP': 2, 'TEA': 3})
+        self.assertEqual(imported.import_trade_files(directory), {})
+
+        # An interrupted import carries on where it stopped
+        interrupted = engine.SQLiteTradeStore(os.path.join(directory, 'interrupted.db'))
+        self.addCleanup(interrupted.close)
+        chunk_rows, engine._IMPORT_CHUNK_ROWS = engine._IMPORT_CHUNK_ROWS, 2
+        self.addCleanup(setattr, engine, '_IMPORT_CHUNK_ROWS', chunk_rows)
+        chunks = []
+        def write_two_chunks(symbol, source, trades, rows):
+            # The second chunk of TEA is interrupted
+            chunks.append(trades)
+            if len(chunks) > 2:
+                raise KeyboardInterrupt
+            return engine.SQLiteTradeStore._write_import(interrupted, symbol, source, trades, rows)
+        interrupted._write_import = write_two_chunks
+        self.assertRaises(KeyboardInterrupt, interrupted.import_trade_files, directory)
+        self.assertEqual(interrupted.trade_count('TEA'), 2)
+        del interrupted._write_import
+        self.assertEqual(interrupted.import_trade_files(directory), {'TEA': 1})
+        self.assertEqual(list(interrupted.iter_trades('TEA')), list(imported.iter_trades('TEA')))
+        self.assertEqual(list(imported.iter_trades('TEA')), list(journals.iter_trades('TEA')))
+
+        # The trades recorded in a store otherwise are not taken for imported ones, in the database or in journals
+        source = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, source)
+        engine.record_trades([('TEA', 1, 'BUY', float(price)) for price in range(1, 11)], source)
+        target = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, target)
+        for trade_store in (engine.SQLiteTradeStore(os.path.join(target, 'trades.db')), engine.JsonTradeStore(target)):
+            self.addCleanup(trade_store.close)
+            self.assertTrue(engine.trade_record('TEA', 1, 'SELL', 20.0, store=trade_store))
+            self.assertEqual(trade_store.import_trade_files(source), {'TEA': 10})
+            self.assertEqual(trade_store.import_trade_files(source), {})
+            self.assertEqual(trade_store.trade_count('TEA'), 11)
+        self.assertEqual(engine.JsonTradeStore(source).import_trade_files(source), {})
+        self.assertIsNone(engine.use_trade_store(imported))
+        self.addCleanup(engine.use_trade_store, None)
+        output = engine.serve_request({'argv': ['--vwsp', 'TEA']})['output']
+        self.assertIn('Volume Weighted Stock price: 3.5', output)
+        self.assertIs(engine.use_trade_store(None), imported)
+        output = subprocess.check_output([sys.executable, os.path.abspath(engine.__file__), '--vwsp', 'TEA', '--store', os.path.join(directory, 'imported.db')],
+                                         cwd=directory)
+        self.assertIn(b'Volume Weighted Stock price: 3.5', output)
 
 
 if __name__ == '__main__':